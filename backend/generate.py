@@ -9,6 +9,8 @@ import openai  # type: ignore
 from uuid import uuid4
 import sqlite3
 import random
+import threading
+from collections import OrderedDict
 
 from models import Endpoint
 
@@ -17,20 +19,34 @@ load_dotenv()
 openai.api_key = os.getenv('OPENAI_API_KEY')
 DB_NAME = 'generated/demo.sqlite3'
 CACHE_DIR = 'gpt_cache'
+# bounds of the memo, by number of entries and by (utf-8) size of the stored prompts and results
+MEMO_MAX_ENTRIES = int(os.getenv('MEMO_MAX_ENTRIES') or 4096)
+MEMO_MAX_BYTES = int(os.getenv('MEMO_MAX_BYTES') or 64 * 1024 * 1024)
+
+# in-memory LRU in front of the cache directory, so that a long-lived process
+# (e.g. the Manager) doesn't go to disk for repeated prompts; requests are served concurrently, hence the lock
+memo: 'OrderedDict[str, str]' = OrderedDict()
+memo_bytes = 0
+memo_lock = threading.Lock()
 
 
 def cached_gpt3(prompt: str, stop: str = '\n', use_cache: bool = True) -> str:
     if not os.path.exists(CACHE_DIR):
         os.mkdir(CACHE_DIR)
 
+    separator = '\n===========\n'
     if use_cache:
+        with memo_lock:
+            if prompt in memo:
+                memo.move_to_end(prompt)
+                return memo[prompt]
         # Check the cache
-        separator = '\n===========\n'
-        cache_files = [os.path.join(CACHE_DIR, p) for p in os.listdir(CACHE_DIR)]
+        cache_files = [os.path.join(CACHE_DIR, p) for p in os.listdir(CACHE_DIR) if not p.startswith('.tmp-')]
         for fn in cache_files:
             with open(fn, 'r') as f:
                 query, result = f.read().split(separator)
             if query == prompt:
+                remember(prompt, result)
                 return result
 
     response = openai.Completion.create(
@@ -43,14 +59,36 @@ def cached_gpt3(prompt: str, stop: str = '\n', use_cache: bool = True) -> str:
     result = response['choices'][0]['text']
     print('cache miss, using GPT3')
 
-    # Add to the cache
+    # Add to the cache (write to a temporary file first so readers never see a partial entry)
     cache_file = os.path.join(CACHE_DIR, str(uuid4()))
-    with open(cache_file, 'w') as f:
+    tmp_file = os.path.join(CACHE_DIR, '.tmp-' + str(uuid4()))
+    with open(tmp_file, 'w') as f:
         f.write(prompt + separator + result)
+    os.replace(tmp_file, cache_file)
+    remember(prompt, result)
 
     return result
 
 
+def memo_entry_size(prompt: str, result: str) -> int:
+    return len(prompt.encode('utf-8')) + len(result.encode('utf-8'))
+
+
+def remember(prompt: str, result: str) -> None:
+    global memo_bytes
+    size = memo_entry_size(prompt, result)
+    if MEMO_MAX_ENTRIES <= 0 or size > MEMO_MAX_BYTES:
+        return
+    with memo_lock:
+        if prompt in memo:
+            memo_bytes -= memo_entry_size(prompt, memo.pop(prompt))
+        memo[prompt] = result
+        memo_bytes += size
+        while len(memo) > MEMO_MAX_ENTRIES or memo_bytes > MEMO_MAX_BYTES:
+            old_prompt, old_result = memo.popitem(last=False)
+            memo_bytes -= memo_entry_size(old_prompt, old_result)
+
+
 def get_db_schema_text(db_name: str) -> str:
     """
     Get the schema of an SQL query.
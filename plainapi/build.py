@@ -0,0 +1,119 @@
+from typing import Any, Dict, Optional
+import os
+import hashlib
+import tempfile
+
+from plainapi.version import __version__
+
+
+BUILD_DIR = '.plain_build'
+
+_compiler_fingerprint: Optional[str] = None
+
+
+def compiler_fingerprint() -> str:
+    """
+    Identifies the compiler that produced a build artifact: the version plus a digest of
+    the package sources, so that any change to the compiler invalidates previous builds.
+    """
+
+    global _compiler_fingerprint
+    if _compiler_fingerprint is None:
+        h = hashlib.sha256(__version__.encode('utf-8'))
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(package_dir)):
+            if name.endswith('.py'):
+                with open(os.path.join(package_dir, name), 'rb') as f:
+                    h.update(name.encode('utf-8') + b'\0' + f.read() + b'\0')
+        _compiler_fingerprint = h.hexdigest()
+    return _compiler_fingerprint
+
+
+def block_fingerprint(block: str, schema_text: str, options: str = '') -> str:
+    h = hashlib.sha256()
+    for part in [compiler_fingerprint(), options, schema_text, block]:
+        h.update(part.encode('utf-8') + b'\0')
+    return h.hexdigest()
+
+
+def write_atomic(filename: str, text: str) -> None:
+    dirname = os.path.dirname(os.path.abspath(filename))
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_fn = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmp_fn, filename)
+    except BaseException:
+        os.remove(tmp_fn)
+        raise
+
+
+def write_if_changed(filename: str, text: str) -> bool:
+    """
+    Write the file only if its content changes (so that file watchers, like uvicorn's reloader, aren't triggered for nothing).
+    Returns whether the file was written.
+    """
+
+    if os.path.exists(filename):
+        with open(filename, 'r') as f:
+            if f.read() == text:
+                return False
+    write_atomic(filename, text)
+    return True
+
+
+class BuildCache:
+    """
+    Compiled endpoint blocks, stored as (versioned) IR under the fingerprint of their source.
+    With a `memory` dict (shared between builds of a long-lived process), the IR is also kept in memory.
+    """
+
+    def __init__(self, build_dir: str = BUILD_DIR, memory: Optional[Dict[str, str]] = None):
+        self.endpoints_dir = os.path.join(build_dir, 'endpoints')
+        self.memory = memory
+        # filled in by parse_application
+        self.reused = 0
+        self.compiled = 0
+
+    def path(self, fingerprint: str) -> str:
+        return os.path.join(self.endpoints_dir, fingerprint + '.json')
+
+    def load(self, fingerprint: str) -> Optional[Any]:
+        # imported here because plainapi.ir depends on parse_application, which uses the build cache
+        from plainapi.ir import loads_endpoint
+        try:
+            if self.memory is not None and fingerprint in self.memory:
+                return loads_endpoint(self.memory[fingerprint])
+            with open(self.path(fingerprint), 'r') as f:
+                text = f.read()
+            endpoint = loads_endpoint(text)
+            if self.memory is not None:
+                self.memory[fingerprint] = text
+            return endpoint
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            # a corrupted (or incompatible) artifact is simply rebuilt
+            return None
+
+    def save(self, fingerprint: str, endpoint: Any) -> None:
+        from plainapi.ir import dumps_endpoint
+        text = dumps_endpoint(endpoint)
+        write_atomic(self.path(fingerprint), text)
+        if self.memory is not None:
+            self.memory[fingerprint] = text
+
+    def prune(self, keep: set[str]) -> int:
+        """ Remove the artifacts of blocks that are no longer in the sources. Returns the number removed. """
+        if not os.path.isdir(self.endpoints_dir):
+            return 0
+        removed = 0
+        for name in os.listdir(self.endpoints_dir):
+            if name.endswith('.json') and name[:-len('.json')] not in keep:
+                os.remove(os.path.join(self.endpoints_dir, name))
+                removed += 1
+        if self.memory is not None:
+            for fingerprint in [f for f in self.memory if f not in keep]:
+                del self.memory[fingerprint]
+        return removed
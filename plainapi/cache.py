@@ -0,0 +1,515 @@
+from typing import Iterator, Optional, TypedDict
+import os
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+
+
+CACHE_SEPARATOR = '\n===========\n'
+KEY_SEPARATOR = '###'
+
+# Cache files are named after the sha256 of their key and sharded into
+# sub-directories by the first two hex digits. The marker file records that
+# the directory has been migrated away from the old random (uuid4) filenames.
+CACHE_LAYOUT_VERSION = '2'
+CACHE_LAYOUT_MARKER = '.layout'
+
+# Access times are only refreshed when they are older than this (in seconds),
+# so that a cache hit stays read-only in the common case.
+ACCESS_TIME_RESOLUTION = 60 * 60
+
+
+class CacheEntry(TypedDict):
+    engine: str
+    prompt: str
+    size: int
+    created_at: float
+    accessed_at: float
+
+
+class GCReport(TypedDict):
+    entries_before: int
+    bytes_before: int
+    removed_unreachable: int
+    removed_expired: int
+    removed_over_limit: int
+    entries_after: int
+    bytes_after: int
+
+
+def make_cache_key(engine: str, prompt: str) -> str:
+    return engine + KEY_SEPARATOR + prompt
+
+
+def split_cache_key(cache_key: str) -> tuple[str, str]:
+    if KEY_SEPARATOR not in cache_key:
+        # the backend cache (backend/generate.py) only uses davinci and doesn't prefix the engine
+        return 'davinci', cache_key
+    engine, prompt = cache_key.split(KEY_SEPARATOR, 1)
+    return engine, prompt
+
+
+def cache_key_hash(cache_key: str) -> str:
+    return hashlib.sha256(cache_key.encode('utf-8')).hexdigest()
+
+
+def read_cache_file(fn: str) -> tuple[str, str]:
+    """ The key and result of a cache file. Raises a ValueError for a malformed (e.g. truncated) file. """
+    with open(fn, 'r') as f:
+        text = f.read()
+    if CACHE_SEPARATOR not in text:
+        raise ValueError(f'Malformed cache file: {fn}')
+    query, result = text.split(CACHE_SEPARATOR, 1)
+    return query, result
+
+
+def write_cache_file(fn: str, cache_key: str, result: str) -> None:
+    """
+    Atomically write a cache file, so that concurrent readers never see a partially written entry.
+    """
+
+    dirname = os.path.dirname(fn)
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp_fn = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(cache_key + CACHE_SEPARATOR + result)
+        os.replace(tmp_fn, fn)
+    except BaseException:
+        os.remove(tmp_fn)
+        raise
+
+
+class CompletionCache:
+    """
+    Interface of a completion cache backend.
+    """
+
+    def get(self, engine: str, prompt: str, touch: bool = True) -> Optional[str]:
+        """ The cached result, or None. With touch=False, the entry's access time (which gc evicts by) is left alone. """
+        raise NotImplementedError()
+
+    def put(self, engine: str, prompt: str, result: str) -> None:
+        raise NotImplementedError()
+
+    def items(self) -> Iterator[tuple[str, str, str]]:
+        """ Yields (engine, prompt, result) for every entry in the cache. """
+        raise NotImplementedError()
+
+    def entries(self) -> Iterator[CacheEntry]:
+        """ Yields the size and timestamps of every entry in the cache. """
+        raise NotImplementedError()
+
+    def remove(self, engine: str, prompt: str) -> None:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+class ReadOnlyCache(CompletionCache):
+    """
+    A view of another cache that ignores writes and leaves access times alone (for dry runs).
+    """
+
+    def __init__(self, cache: CompletionCache):
+        self.cache = cache
+
+    def get(self, engine: str, prompt: str, touch: bool = True) -> Optional[str]:
+        return self.cache.get(engine, prompt, touch=False)
+
+    def put(self, engine: str, prompt: str, result: str) -> None:
+        pass
+
+    def items(self) -> Iterator[tuple[str, str, str]]:
+        return self.cache.items()
+
+    def entries(self) -> Iterator[CacheEntry]:
+        return self.cache.entries()
+
+    def remove(self, engine: str, prompt: str) -> None:
+        pass
+
+
+class DirectoryCache(CompletionCache):
+    """
+    One file per completion, named after the hash of the cache key.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self._checked = False
+        self._lock = threading.Lock()
+        # the files of a cache that has yet to be migrated, by key, for reads that mustn't migrate it
+        self._legacy: Optional[dict[str, str]] = None
+
+    def path(self, cache_key: str) -> str:
+        digest = cache_key_hash(cache_key)
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def migrate(self) -> int:
+        """
+        Move cache files written with the old layout (random filenames directly
+        inside the cache directory) to their content-addressed location.
+
+        Returns the number of migrated entries.
+
+        """
+
+        migrated = 0
+        for name in os.listdir(self.cache_dir):
+            fn = os.path.join(self.cache_dir, name)
+            if name == CACHE_LAYOUT_MARKER or not os.path.isfile(fn):
+                continue
+            try:
+                cache_key, result = read_cache_file(fn)
+            except FileNotFoundError:
+                # migrated by another process meanwhile
+                continue
+            except ValueError:
+                print(f'Skipping malformed cache file: {fn}')
+                continue
+            cache_key = make_cache_key(*split_cache_key(cache_key))
+            target = self.path(cache_key)
+            if not os.path.exists(target):
+                write_cache_file(target, cache_key, result)
+            try:
+                os.remove(fn)
+            except FileNotFoundError:
+                continue
+            migrated += 1
+        with open(os.path.join(self.cache_dir, CACHE_LAYOUT_MARKER), 'w') as f:
+            f.write(CACHE_LAYOUT_VERSION)
+        return migrated
+
+    def ensure(self) -> None:
+        if self._checked:
+            return
+        with self._lock:
+            if self._checked:
+                return
+            os.makedirs(self.cache_dir, exist_ok=True)
+            marker = os.path.join(self.cache_dir, CACHE_LAYOUT_MARKER)
+            if not os.path.exists(marker):
+                migrated = self.migrate()
+                if migrated > 0:
+                    print(f'Migrated {migrated} cache entries in {self.cache_dir} to the content-addressed layout.')
+            self._checked = True
+
+    def legacy_files(self) -> dict[str, str]:
+        """
+        The files of the old layout by key, when the cache has yet to be migrated (and mustn't be, e.g. for a dry run).
+        Read once, like a migration.
+        """
+
+        with self._lock:
+            if self._legacy is None:
+                self._legacy = {}
+                if os.path.isdir(self.cache_dir) and not os.path.exists(os.path.join(self.cache_dir, CACHE_LAYOUT_MARKER)):
+                    for name in os.listdir(self.cache_dir):
+                        fn = os.path.join(self.cache_dir, name)
+                        if not os.path.isfile(fn):
+                            continue
+                        try:
+                            cache_key, _ = read_cache_file(fn)
+                        except (FileNotFoundError, ValueError):
+                            continue
+                        self._legacy[make_cache_key(*split_cache_key(cache_key))] = fn
+            return self._legacy
+
+    def get(self, engine: str, prompt: str, touch: bool = True) -> Optional[str]:
+        if touch:
+            self.ensure()
+        cache_key = make_cache_key(engine, prompt)
+        fn = self.path(cache_key)
+        if not touch and not self._checked and not os.path.exists(fn):
+            fn = self.legacy_files().get(cache_key, fn)
+        try:
+            st = os.stat(fn)
+            query, result = read_cache_file(fn)
+        except (FileNotFoundError, ValueError):
+            # removed meanwhile, or truncated: a miss
+            return None
+        query = make_cache_key(*split_cache_key(query))
+        if query != cache_key:
+            # sha256 collision (or a corrupted file), treat it as a miss
+            return None
+        now = time.time()
+        if touch and now - st.st_atime > ACCESS_TIME_RESOLUTION:
+            # record the access explicitly, since the filesystem may be mounted with noatime
+            os.utime(fn, (now, st.st_mtime))
+        return result
+
+    def put(self, engine: str, prompt: str, result: str) -> None:
+        self.ensure()
+        cache_key = make_cache_key(engine, prompt)
+        write_cache_file(self.path(cache_key), cache_key, result)
+
+    def files(self) -> Iterator[str]:
+        if not os.path.isdir(self.cache_dir):
+            # nothing to list (and nothing to create for it)
+            return
+        self.ensure()
+        for shard in sorted(os.listdir(self.cache_dir)):
+            shard_dir = os.path.join(self.cache_dir, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            for name in sorted(os.listdir(shard_dir)):
+                if not name.startswith('.tmp-'):
+                    yield os.path.join(shard_dir, name)
+
+    def items(self) -> Iterator[tuple[str, str, str]]:
+        for fn in self.files():
+            try:
+                cache_key, result = read_cache_file(fn)
+            except (FileNotFoundError, ValueError):
+                continue
+            engine, prompt = split_cache_key(cache_key)
+            yield engine, prompt, result
+
+    def entries(self) -> Iterator[CacheEntry]:
+        for fn in self.files():
+            try:
+                st = os.stat(fn)
+                cache_key, _ = read_cache_file(fn)
+            except (FileNotFoundError, ValueError):
+                continue
+            engine, prompt = split_cache_key(cache_key)
+            yield CacheEntry(
+                engine=engine,
+                prompt=prompt,
+                size=st.st_size,
+                created_at=st.st_mtime,
+                accessed_at=max(st.st_atime, st.st_mtime)
+            )
+
+    def remove(self, engine: str, prompt: str) -> None:
+        try:
+            os.remove(self.path(make_cache_key(engine, prompt)))
+        except FileNotFoundError:
+            pass
+
+
+class SQLiteCache(CompletionCache):
+    """
+    All completions in a single SQLite database in WAL mode, so that concurrent
+    readers never block and writes are transactional.
+    """
+
+    def __init__(self, db_name: str):
+        self.db_name = db_name
+        self._local = threading.local()
+        con = self.connection()
+        with con:
+            con.execute('''
+                CREATE TABLE IF NOT EXISTS completions (
+                    engine TEXT NOT NULL,
+                    prompt_hash TEXT NOT NULL,
+                    prompt TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL DEFAULT 0,
+                    accessed_at REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (engine, prompt_hash)
+                );
+            ''')
+            columns = [row[1] for row in con.execute('PRAGMA table_info(completions);')]
+            for column in ['created_at', 'accessed_at']:
+                if column not in columns:
+                    # databases created before timestamps were tracked
+                    con.execute(f'ALTER TABLE completions ADD COLUMN {column} REAL NOT NULL DEFAULT 0;')
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads, so keep one per thread
+        con: Optional[sqlite3.Connection] = getattr(self._local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.db_name, timeout=30)
+            con.execute('PRAGMA journal_mode=WAL;')
+            con.execute('PRAGMA synchronous=NORMAL;')
+            self._local.con = con
+        return con
+
+    def get(self, engine: str, prompt: str, touch: bool = True) -> Optional[str]:
+        prompt_hash = cache_key_hash(prompt)
+        con = self.connection()
+        row = con.execute('''
+            SELECT prompt, result, accessed_at FROM completions WHERE engine = ? AND prompt_hash = ?;
+        ''', (engine, prompt_hash,)).fetchone()
+        if row is None or row[0] != prompt:
+            return None
+        now = time.time()
+        if touch and now - row[2] > ACCESS_TIME_RESOLUTION:
+            with con:
+                con.execute('''
+                    UPDATE completions SET accessed_at = ? WHERE engine = ? AND prompt_hash = ?;
+                ''', (now, engine, prompt_hash,))
+        return row[1]
+
+    def put(self, engine: str, prompt: str, result: str) -> None:
+        self.put_many([(engine, prompt, result)])
+
+    def put_many(self, entries: list[tuple[str, str, str]]) -> None:
+        con = self.connection()
+        now = time.time()
+        with con:
+            con.executemany('''
+                INSERT OR REPLACE INTO completions (engine, prompt_hash, prompt, result, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?);
+            ''', [(engine, cache_key_hash(prompt), prompt, result, now, now) for engine, prompt, result in entries])
+
+    def items(self) -> Iterator[tuple[str, str, str]]:
+        cur = self.connection().execute('''
+            SELECT engine, prompt, result FROM completions ORDER BY engine, prompt_hash;
+        ''')
+        for engine, prompt, result in cur:
+            yield engine, prompt, result
+
+    def entries(self) -> Iterator[CacheEntry]:
+        cur = self.connection().execute('''
+            SELECT engine, prompt, length(CAST(prompt AS BLOB)) + length(CAST(result AS BLOB)), created_at, accessed_at FROM completions;
+        ''')
+        for engine, prompt, size, created_at, accessed_at in cur:
+            yield CacheEntry(
+                engine=engine,
+                prompt=prompt,
+                size=size,
+                created_at=created_at,
+                accessed_at=max(created_at, accessed_at)
+            )
+
+    def remove(self, engine: str, prompt: str) -> None:
+        self.remove_many([(engine, prompt)])
+
+    def remove_many(self, keys: list[tuple[str, str]]) -> None:
+        con = self.connection()
+        with con:
+            con.executemany('''
+                DELETE FROM completions WHERE engine = ? AND prompt_hash = ?;
+            ''', [(engine, cache_key_hash(prompt)) for engine, prompt in keys])
+
+    def close(self) -> None:
+        con: Optional[sqlite3.Connection] = getattr(self._local, 'con', None)
+        if con is not None:
+            con.close()
+            self._local.con = None
+
+
+def open_cache(backend: str, path: str) -> CompletionCache:
+    if backend == 'directory':
+        return DirectoryCache(path)
+    elif backend == 'sqlite':
+        return SQLiteCache(path)
+    else:
+        raise ValueError(f'Invalid cache backend "{backend}" (expected "directory" or "sqlite")')
+
+
+def import_directory(cache: CompletionCache, cache_dir: str) -> int:
+    """
+    Copy every entry of a legacy cache directory (either layout) into the given cache.
+    Returns the number of imported entries.
+    """
+
+    if not os.path.isdir(cache_dir):
+        raise ValueError(f'Could not find cache directory: {cache_dir}')
+    entries: list[tuple[str, str, str]] = []
+    for root, _, names in os.walk(cache_dir):
+        for name in names:
+            if name == CACHE_LAYOUT_MARKER or name.startswith('.tmp-'):
+                continue
+            fn = os.path.join(root, name)
+            try:
+                cache_key, result = read_cache_file(fn)
+            except ValueError:
+                print(f'Skipping malformed cache file: {fn}')
+                continue
+            engine, prompt = split_cache_key(cache_key)
+            entries.append((engine, prompt, result))
+    if isinstance(cache, SQLiteCache):
+        cache.put_many(entries)
+    else:
+        for engine, prompt, result in entries:
+            cache.put(engine, prompt, result)
+    return len(entries)
+
+
+def export_directory(cache: CompletionCache, cache_dir: str) -> int:
+    """
+    Write every entry of the given cache into a (content-addressed) cache directory.
+    Returns the number of exported entries.
+    """
+
+    target = DirectoryCache(cache_dir)
+    count = 0
+    for engine, prompt, result in cache.items():
+        target.put(engine, prompt, result)
+        count += 1
+    return count
+
+
+def gc_cache(cache: CompletionCache,
+             max_bytes: Optional[int] = None,
+             max_entries: Optional[int] = None,
+             ttl: Optional[float] = None,
+             reachable: Optional[set[tuple[str, str]]] = None,
+             dry_run: bool = False) -> GCReport:
+    """
+    Evict entries from the cache, in this order:
+
+    1. if a set of reachable (engine, prompt) keys is given, every entry not in it
+    2. entries that haven't been accessed for more than `ttl` seconds
+    3. the least recently used entries, until the cache fits in `max_bytes` and `max_entries`
+
+    """
+
+    entries = list(cache.entries())
+    report = GCReport(
+        entries_before=len(entries),
+        bytes_before=sum(e['size'] for e in entries),
+        removed_unreachable=0,
+        removed_expired=0,
+        removed_over_limit=0,
+        entries_after=0,
+        bytes_after=0
+    )
+    evicted: list[CacheEntry] = []
+
+    if reachable is not None:
+        kept = []
+        for e in entries:
+            if (e['engine'], e['prompt']) in reachable:
+                kept.append(e)
+            else:
+                evicted.append(e)
+                report['removed_unreachable'] += 1
+        entries = kept
+
+    if ttl is not None:
+        deadline = time.time() - ttl
+        kept = []
+        for e in entries:
+            if e['accessed_at'] >= deadline:
+                kept.append(e)
+            else:
+                evicted.append(e)
+                report['removed_expired'] += 1
+        entries = kept
+
+    entries.sort(key=lambda e: e['accessed_at'], reverse=True)
+    total_bytes = sum(e['size'] for e in entries)
+    while len(entries) > 0 and ((max_entries is not None and len(entries) > max_entries) or
+                                (max_bytes is not None and total_bytes > max_bytes)):
+        e = entries.pop()
+        total_bytes -= e['size']
+        evicted.append(e)
+        report['removed_over_limit'] += 1
+
+    if not dry_run:
+        if isinstance(cache, SQLiteCache):
+            cache.remove_many([(e['engine'], e['prompt']) for e in evicted])
+        else:
+            for e in evicted:
+                cache.remove(e['engine'], e['prompt'])
+
+    report['entries_after'] = len(entries)
+    report['bytes_after'] = total_bytes
+    return report
@@ -0,0 +1,190 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+import math
+import random
+import re
+import threading
+import zlib
+
+from plainapi.cache import CompletionCache
+from plainapi.examples import PromptKind, prompt_kind
+from plainapi.gpt3 import configure_local_engine, get_cache
+from plainapi.packing import split_few_shot
+from plainapi.providers import CompletionProvider
+
+
+# The engine name to list in a stage's engines (e.g. "determine_code_block_type_engines = classifier, curie, davinci").
+CLASSIFIER_ENGINE = 'classifier'
+
+# Lowest probability of the predicted label for the classifier to answer.
+CONFIDENCE_THRESHOLD = 0.9
+
+# Prompts of a kind are classified once this many distinct labelled statements of the kind are cached...
+MIN_TRAINING = 20
+# ...and only if their answers fall into at most this many labels.
+MAX_LABELS = 8
+
+FEATURE_BITS = 18
+EPOCHS = 20
+LEARNING_RATE = 0.5
+L2 = 1e-4
+
+
+def label_of(answer: str) -> str:
+    """ The label of an answer: "else-if: the user is an admin" -> "else-if:" (an open label), "output" -> "output". """
+    answer = answer.strip()
+    return answer.split(':', 1)[0].strip() + ':' if ':' in answer else answer
+
+
+def is_open_label(label: str) -> bool:
+    """ Labels followed by text (like an else-if's condition) can be recognized, but not answered, by the classifier. """
+    return label.endswith(':')
+
+
+def features(text: str) -> List[int]:
+    """ The hashed word unigrams and bigrams of a statement, its first word, and the character trigrams of its words. """
+    words = re.findall(r'\{[^}]*\}|\w+|<-|[^\w\s]', text.lower())
+    grams = ['w:' + word for word in words]
+    grams += ['b:' + a + ' ' + b for a, b in zip(words, words[1:])]
+    if len(words) > 0:
+        grams.append('first:' + words[0])
+    for word in words:
+        padded = f'#{word}#'
+        grams += ['c:' + padded[i:i + 3] for i in range(len(padded) - 2)]
+    mask = (1 << FEATURE_BITS) - 1
+    # crc32 rather than hash(), which changes between runs
+    return sorted({zlib.crc32(gram.encode()) & mask for gram in grams})
+
+
+class LogisticRegression:
+    """
+    A multinomial logistic regression over sparse binary features, trained with stochastic gradient descent.
+    """
+
+    def __init__(self, labels: List[str]):
+        self.labels = labels
+        self.weights: List[Dict[int, float]] = [{} for _ in labels]
+        self.bias = [0.0] * len(labels)
+
+    def probabilities(self, x: List[int]) -> List[float]:
+        scores = [self.bias[k] + sum(w.get(i, 0.0) for i in x) for k, w in enumerate(self.weights)]
+        top = max(scores)
+        exps = [math.exp(score - top) for score in scores]
+        total = sum(exps)
+        return [e / total for e in exps]
+
+    def fit(self, xs: List[List[int]], ys: List[int], epochs: int = EPOCHS, learning_rate: float = LEARNING_RATE) -> None:
+        order = list(range(len(xs)))
+        rng = random.Random(0)
+        for epoch in range(epochs):
+            rng.shuffle(order)
+            rate = learning_rate / (1 + epoch)
+            for n in order:
+                x, y = xs[n], ys[n]
+                probs = self.probabilities(x)
+                for k, w in enumerate(self.weights):
+                    gradient = probs[k] - (1.0 if k == y else 0.0)
+                    self.bias[k] -= rate * gradient
+                    for i in x:
+                        w[i] = w.get(i, 0.0) * (1 - rate * L2) - rate * gradient
+
+    def predict(self, x: List[int]) -> Tuple[str, float]:
+        probs = self.probabilities(x)
+        best = max(range(len(probs)), key=lambda k: probs[k])
+        return self.labels[best], probs[best]
+
+
+def training_sets(entries: Iterable[Tuple[str, str, str]]) -> Dict[PromptKind, Dict[str, str]]:
+    """
+    The labelled statements of the cached few-shot completions, by kind of prompt.
+    Statements answered with different labels (e.g. by different engines) are left out.
+    """
+
+    labelled: Dict[PromptKind, Dict[str, Optional[str]]] = {}
+    for _, prompt, answer in entries:
+        parts = split_few_shot(prompt)
+        if parts is None or answer.strip() == '':
+            continue
+        _, query, label = parts
+        statements = labelled.setdefault(prompt_kind(prompt, label), {})
+        statement = query.split(':', 1)[1].strip()
+        answer_label = label_of(answer)
+        if statements.get(statement, answer_label) != answer_label:
+            statements[statement] = None
+        else:
+            statements[statement] = answer_label
+    return {kind: {s: l for s, l in statements.items() if l is not None} for kind, statements in labelled.items()}
+
+
+def train(statements: Dict[str, str]) -> Optional[LogisticRegression]:
+    """ A classifier for a kind of prompt, if there is enough data and the answers are a closed set of labels. """
+    labels = sorted(set(statements.values()))
+    if len(statements) < MIN_TRAINING or len(labels) < 2 or len(labels) > MAX_LABELS:
+        return None
+    model = LogisticRegression(labels)
+    ordered = sorted(statements.items())
+    model.fit([features(s) for s, _ in ordered], [labels.index(l) for _, l in ordered])
+    return model
+
+
+class ClassifierProvider(CompletionProvider):
+    """
+    Answers the closed-label few-shot prompts (such as the statement type) with local classifiers
+    trained from the cached completions, one per kind of prompt. Answers an empty string (which the
+    stage's check rejects, so the cascade moves on to the next engine) for prompts of other kinds,
+    and when the classifier isn't confident enough.
+    """
+
+    name = 'classifier'
+
+    def __init__(self, threshold: float = CONFIDENCE_THRESHOLD):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._cache: Optional[CompletionCache] = None
+        self._models: Dict[PromptKind, Optional[LogisticRegression]] = {}
+
+    def models(self) -> Dict[PromptKind, Optional[LogisticRegression]]:
+        """ The classifiers, trained from the completion cache on first use (and again if another cache is swapped in). """
+        with self._lock:
+            cache = get_cache()
+            if self._cache is not cache:
+                self._models = {kind: train(statements) for kind, statements in training_sets(cache.items()).items()}
+                self._cache = cache
+            return self._models
+
+    def classify(self, prompt: str) -> Optional[Tuple[str, float]]:
+        parts = split_few_shot(prompt)
+        if parts is None:
+            return None
+        _, query, label = parts
+        model = self.models().get(prompt_kind(prompt, label))
+        if model is None:
+            return None
+        return model.predict(features(query.split(':', 1)[1]))
+
+    def complete(self, prompt: str, engine: str, stop: str, max_tokens: int) -> str:
+        prediction = self.classify(prompt)
+        if prediction is None:
+            return ''
+        label, probability = prediction
+        if probability < self.threshold or is_open_label(label):
+            return ''
+        return ' ' + label
+
+
+_classifier = ClassifierProvider()
+
+
+def configure_classifier(threshold: float = CONFIDENCE_THRESHOLD) -> ClassifierProvider:
+    global _classifier
+    if not 0 < threshold <= 1:
+        raise ValueError(f'Expected a classifier threshold between 0 and 1, got {threshold}')
+    _classifier = ClassifierProvider(threshold)
+    configure_local_engine(CLASSIFIER_ENGINE, _classifier)
+    return _classifier
+
+
+def classifier_options() -> str:
+    return f'classifier_threshold={_classifier.threshold}'
+
+
+configure_local_engine(CLASSIFIER_ENGINE, _classifier)
@@ -0,0 +1,109 @@
+from typing import Any, Callable, Dict, Optional
+import io
+import os
+import json
+import signal
+import socket
+import contextlib
+import traceback
+import socketserver
+
+
+COMPILER_SOCKET = '.plain-compiler.sock'
+
+# Requests and responses are single JSON documents; the client ends its request by shutting down its side.
+Message = Dict[str, Any]
+
+
+def read_message(sock: socket.socket) -> Message:
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def request_compiler(socket_path: str, request: Message) -> Optional[Message]:
+    """ Send a request to the compiler daemon. Returns None if no daemon is listening on the socket. """
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # left behind by a daemon that didn't exit cleanly
+            return None
+        sock.sendall(json.dumps(request).encode('utf-8'))
+        sock.shutdown(socket.SHUT_WR)
+        return read_message(sock)
+    finally:
+        sock.close()
+
+
+def run_captured(run: Callable[[], None]) -> Message:
+    """ Run a command, returning what it printed, and its status (1 with the traceback if it raised). """
+    output = io.StringIO()
+    status = 0
+    with contextlib.redirect_stdout(output):
+        try:
+            run()
+        except Exception:
+            traceback.print_exc(file=output)
+            status = 1
+    return {'status': status, 'output': output.getvalue()}
+
+
+class CompilerServer(socketserver.UnixStreamServer):
+    """
+    Answers one request at a time (builds share the process-wide caches), until a request asks for a restart.
+    """
+
+    def __init__(self, socket_path: str, handle: Callable[[Message], Message]):
+        self.handle = handle
+        self.restart = False
+
+        class Handler(socketserver.BaseRequestHandler):
+
+            def handle(handler) -> None:
+                try:
+                    request = read_message(handler.request)
+                except ValueError as e:
+                    response: Message = {'status': 1, 'output': f'Invalid request: {e}\n'}
+                else:
+                    response = self.handle(request)
+                    self.restart = self.restart or response.get('restart', False)
+                handler.request.sendall(json.dumps(response).encode('utf-8'))
+
+        super().__init__(socket_path, Handler)
+
+
+def serve_compiler(socket_path: str, handle: Callable[[Message], Message]) -> bool:
+    """
+    Serve compiler requests on a Unix socket. Returns True when a request asked for a restart
+    (the caller should start over with fresh settings and code), False when interrupted.
+    """
+
+    if request_compiler(socket_path, {'command': 'ping'}) is not None:
+        raise ValueError(f'A compiler daemon is already listening on {socket_path}')
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = CompilerServer(socket_path, handle)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt()
+
+    # so that the socket is removed when the daemon is killed too
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        while not server.restart:
+            server.handle_request()
+        return True
+    except KeyboardInterrupt:
+        return False
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
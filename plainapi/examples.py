@@ -0,0 +1,227 @@
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import math
+import re
+import threading
+
+from plainapi.cache import CompletionCache
+from plainapi.gpt3 import cached_answer, cascade_complete, get_cache
+from plainapi.packing import split_few_shot
+
+
+# Number of examples picked from the cache for a few-shot prompt (0 keeps the fixed examples).
+FEW_SHOT_EXAMPLES = 0
+
+# The stages whose examples don't depend on the rest of the prompt (unlike the ones with variables in context).
+FEW_SHOT_STAGES = [
+    'parse_header',
+    'parse_requirements',
+    'determine_code_block_type',
+    'determine_else_or_elif',
+    'parse_exception',
+    'parse_assignment',
+    'parse_output',
+    'english2sql',
+]
+
+# A prompt's examples are only comparable with those of prompts with the same instruction and answer label.
+PromptKind = Tuple[str, str]
+
+
+class Example:
+
+    def __init__(self, query: str, answer: str, prompt: str):
+        self.query = query
+        self.answer = answer
+        # where the answer is cached
+        self.prompt = prompt
+
+
+def ngrams(text: str) -> set[str]:
+    """ The word unigrams and bigrams of a text, lowercased ({placeholders} count as words). """
+    words = re.findall(r'\{[^}]*\}|\w+', text.lower())
+    return set(words) | {a + ' ' + b for a, b in zip(words, words[1:])}
+
+
+def prompt_kind(prompt: str, label: str) -> PromptKind:
+    return prompt.strip().split('\n')[0], label
+
+
+class ExampleIndex:
+    """
+    The (query, answer) pairs of the cached few-shot completions, by kind of prompt,
+    with an inverted index of their n-grams to find the ones most similar to a query.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.examples: Dict[PromptKind, List[Example]] = {}
+        self.by_query: Dict[Tuple[PromptKind, str], List[Example]] = {}
+        self.postings: Dict[PromptKind, Dict[str, List[int]]] = {}
+        self.grams: Dict[PromptKind, List[set[str]]] = {}
+
+    def add(self, prompt: str, answer: str) -> None:
+        parts = split_few_shot(prompt)
+        if parts is None:
+            return
+        _, query, label = parts
+        kind = prompt_kind(prompt, label)
+        example = Example(query, answer, prompt)
+        with self._lock:
+            examples = self.examples.setdefault(kind, [])
+            same = self.by_query.setdefault((kind, query), [])
+            if any(e.answer == answer for e in same):
+                return
+            same.append(example)
+            grams = ngrams(query)
+            postings = self.postings.setdefault(kind, {})
+            for gram in grams:
+                postings.setdefault(gram, []).append(len(examples))
+            examples.append(example)
+            self.grams.setdefault(kind, []).append(grams)
+
+    def add_all(self, entries: Iterable[Tuple[str, str, str]]) -> None:
+        for _, prompt, answer in entries:
+            self.add(prompt, answer)
+
+    def exact(self, kind: PromptKind, query: str) -> List[Example]:
+        with self._lock:
+            return list(self.by_query.get((kind, query), []))
+
+    def similar(self, kind: PromptKind, query: str, k: int, validate: Callable[[str], bool]) -> List[Example]:
+        """ The k valid examples most similar to the query (by cosine similarity of their n-gram sets), most similar last. """
+        grams = ngrams(query)
+        with self._lock:
+            examples = self.examples.get(kind, [])
+            postings = self.postings.get(kind, {})
+            example_grams = self.grams.get(kind, [])
+            shared: Dict[int, int] = {}
+            for gram in grams:
+                for idx in postings.get(gram, []):
+                    shared[idx] = shared.get(idx, 0) + 1
+            scored = [(count / math.sqrt(len(grams) * len(example_grams[idx])), examples[idx]) for idx, count in shared.items()]
+        scored.sort(key=lambda pair: (-pair[0], pair[1].query, pair[1].answer))
+        picked: List[Example] = []
+        seen = {query}
+        for _, example in scored:
+            if example.query in seen or not validate(example.answer):
+                continue
+            seen.add(example.query)
+            picked.append(example)
+            if len(picked) == k:
+                break
+        # the most similar example goes right before the query
+        return list(reversed(picked))
+
+
+_index: Optional[ExampleIndex] = None
+_index_cache: Optional[CompletionCache] = None
+_index_lock = threading.Lock()
+_few_shot_examples = FEW_SHOT_EXAMPLES
+_few_shot_stages = list(FEW_SHOT_STAGES)
+
+
+def configure_examples(k: int = FEW_SHOT_EXAMPLES, stages: Optional[List[str]] = None) -> None:
+    global _few_shot_examples, _few_shot_stages, _index
+    _few_shot_examples = k
+    if stages is not None:
+        _few_shot_stages = stages
+    _index = None
+
+
+def examples_options() -> str:
+    """ The example selection settings, as a string (they are part of the fingerprint of compiled blocks). """
+    return f'examples={_few_shot_examples}:{"+".join(_few_shot_stages)}' if _few_shot_examples > 0 else 'examples=0'
+
+
+def get_index() -> ExampleIndex:
+    """ The example index, built from the completion cache on first use (and again if another cache is swapped in, e.g. by `dry_run`). """
+    global _index, _index_cache
+    with _index_lock:
+        cache = get_cache()
+        if _index is None or _index_cache is not cache:
+            _index = ExampleIndex()
+            _index.add_all(cache.items())
+            _index_cache = cache
+        return _index
+
+
+def is_example_block(block: str, final: str) -> bool:
+    """ Whether a block of a few-shot prompt is an example, i.e. starts like its final query block and has its answer label. """
+    query_prefix = final.split('\n')[0].split(':')[0] + ':'
+    label = final.split('\n')[-1]
+    return block.startswith(query_prefix) and ('\n' + label) in block
+
+
+def prompt_context(prompt: str, drop: List[str]) -> List[str]:
+    """ The blocks of a few-shot prompt other than its examples, its query and the ones in `drop`. """
+    blocks = prompt.split('\n\n')
+    dropped = [d.strip() for d in drop]
+    return [block for block in blocks[:-1] if block.strip() not in dropped and not is_example_block(block, blocks[-1])]
+
+
+def replace_examples(prompt: str, examples: List[Example], drop: List[str]) -> str:
+    """
+    Replace the example blocks of a few-shot prompt with the given examples,
+    and drop the blocks in `drop` (notes about the fixed examples).
+    """
+
+    blocks = prompt.split('\n\n')
+    final = blocks[-1]
+    label = final.split('\n')[-1]
+    dropped = [d.strip() for d in drop]
+    formatted: Optional[str] = '\n\n'.join(f'{e.query}\n{label}{e.answer}' for e in examples)
+    out = []
+    for block in blocks[:-1]:
+        if block.strip() in dropped:
+            continue
+        if is_example_block(block, final):
+            if formatted is not None:
+                out.append(formatted)
+                formatted = None
+            continue
+        out.append(block)
+    if formatted is not None:
+        out.append(formatted)
+    return '\n\n'.join(out + [final])
+
+
+def few_shot_complete(prompt: str,
+                      stage: str,
+                      validate: Callable[[str], bool],
+                      drop: Optional[List[str]] = None,
+                      accept: Optional[Callable[[str], bool]] = None) -> str:
+    """
+    Like cascade_complete, but with the prompt's fixed examples replaced by the most similar
+    valid (query, answer) pairs of the cache, when there are enough of them.
+    `accept` further restricts the answers that can serve as examples (e.g. to the tables of a schema).
+
+    A query answered before (with whichever examples, but the same instructions and schema)
+    is answered from the same cache entry, so that the prompts, and so the cache keys,
+    don't change as the cache grows.
+    """
+
+    parts = split_few_shot(prompt)
+    if _few_shot_examples <= 0 or stage not in _few_shot_stages or parts is None:
+        return cascade_complete(prompt, stage=stage, validate=validate)
+    _, query, label = parts
+    kind = prompt_kind(prompt, label)
+    index = get_index()
+
+    # e.g. answered by a prefetch, after the index was built
+    cached = cached_answer(prompt, stage, validate)
+    if cached is not None:
+        return cached
+
+    context = prompt_context(prompt, drop or [])
+    for example in index.exact(kind, query):
+        if validate(example.answer) and prompt_context(example.prompt, drop or []) == context:
+            return cascade_complete(example.prompt, stage=stage, validate=validate)
+
+    examples = index.similar(kind, query, _few_shot_examples,
+                             validate if accept is None else lambda answer: validate(answer) and accept(answer))
+    if len(examples) == _few_shot_examples:
+        prompt = replace_examples(prompt, examples, drop or [])
+    result = cascade_complete(prompt, stage=stage, validate=validate)
+    if validate(result):
+        index.add(prompt, result)
+    return result
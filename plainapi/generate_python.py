@@ -1,20 +1,10 @@
 from typing import TypedDict
-import os
-from dotenv import load_dotenv
-import openai  # type: ignore
 
 from plainapi.parse_endpoint import Endpoint
 from plainapi.parse_application import Application
 from plainapi.parse_code import AssignmentStatement, CodeBlock, ExceptionStatement, IfStatement, OutputStatement, PythonStatement, SQLStatement
 
 
-load_dotenv('./.env')
-OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
-if OPENAI_API_KEY is None:
-    raise ValueError('Expected OPENAI_API_KEY environment variable to be set or in `.env` file.')
-openai.api_key = OPENAI_API_KEY
-
-
 def url2endpoint_function_name(url: str) -> str:
     clean = ''.join(c if c.isalnum() else ' ' for c in url)
     parts = [s.strip() for s in clean.split(' ') if s.strip() != '']
@@ -53,7 +43,7 @@ def generate_sql_statement(block: SQLStatement):
 def generate_exception_statement(block: ExceptionStatement, indent=0):
     tab = ' ' * indent
     code = block['code'] or 400
-    message = block['message'] or 'An error has occurred.'
+    message = block['message'] or '"An error has occurred."'
     return f'{tab}raise HTTPException(status_code={code}, detail={message})\n'
 
 
@@ -1,7 +1,33 @@
-from plainapi.gpt3 import cached_complete
+from typing import Optional, Set
 
+from plainapi.examples import few_shot_complete
+from plainapi.gpt3 import cached_answer
+from plainapi.parse_sql import parse_schema, referenced_tables, summarize_schema, valid_sql
+from plainapi.templates import learn_translation
 
-def english2sql(english_query: str, schema_text: str) -> str:
+
+# Whether to send only the part of the schema relevant to each sentence.
+_prune_schema = True
+
+
+def configure_schema_pruning(enabled: bool) -> None:
+    global _prune_schema
+    _prune_schema = enabled
+
+
+def schema_pruning_enabled() -> bool:
+    return _prune_schema
+
+
+APPLES_NOTE = 'The first three examples will be about a table called "apples" with id, name, weight, and is_green, but the rest should refer to the above schema.'
+
+
+def english2sql_prompt(english_query: str, schema_text: str) -> str:
+
+    # with a pruned schema, the prompt (and so the cache key) only changes when the relevant tables do
+    summary = summarize_schema(schema_text, english_query) if _prune_schema else None
+    if summary is not None:
+        schema_text = summary
 
     prompt = \
 f"""
@@ -9,7 +35,7 @@ Turn the following English sentences into valid SQLite statements. Here's the da
 
 {schema_text}
 
-The first three examples will be about a table called "apples" with id, name, weight, and is_green, but the rest should refer to the above schema.
+{APPLES_NOTE}
 
 English: get all of the apples
 SQL: SELECT * FROM apples;
@@ -22,6 +48,24 @@ SQL: INSERT INTO apples (name, weight, is_green) VALUES (?, ?, false);
 
 English: {english_query.strip()}
 SQL:"""
+    return prompt
+
+
+def cached_sql(english_query: str, schema_text: str) -> Optional[str]:
+    """ The translation already cached for the sentence (by any engine), or None. """
+    return cached_answer(english2sql_prompt(english_query, schema_text), 'english2sql', valid_sql)
+
+
+def english2sql(english_query: str, schema_text: str) -> str:
 
-    response = cached_complete(prompt, engine='davinci')
+    # examples picked from the cache must be about the tables of this schema (any will do if it can't be parsed)
+    try:
+        table_names: Optional[Set[str]] = {table['name'].lower() for table in parse_schema(schema_text)}
+    except ValueError:
+        table_names = None
+    prompt = english2sql_prompt(english_query, schema_text)
+    response = few_shot_complete(prompt, stage='english2sql', validate=valid_sql, drop=[APPLES_NOTE],
+                                 accept=lambda sql: table_names is None or referenced_tables(sql) <= table_names)
+    if valid_sql(response):
+        learn_translation(english_query, response)
     return response
@@ -1,41 +1,730 @@
-import os
-from typing import Literal, Any, cast
-from uuid import uuid4
-import openai  # type: ignore
+from typing import Callable, Iterator, Optional, TypeVar, cast
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+import threading
+import time
+import heapq
+import random
+
+from plainapi.cache import CompletionCache, DirectoryCache, ReadOnlyCache, open_cache
+from plainapi.providers import CompletionCacheMiss, CompletionProvider, OpenAIProvider, StubProvider, TransientCompletionError
+from plainapi.stats import estimate_tokens, get_stats
+from plainapi.packing import PACKED_STOP, pack_prompt, split_few_shot, unpack_answers
 
 
 CACHE_DIR = 'gpt_cache'
+MEMO_MAX_ENTRIES = 4096
+MEMO_MAX_BYTES = 64 * 1024 * 1024
+BATCH_SIZE = 20
+MAX_TOKENS = 64
+MAX_RETRIES = 6
+# At most this many statements per packed prompt (0 or 1 sends every prompt on its own).
+PACK_SIZE = 0
+
+# Lower numbers are sent first when requests have to wait for the rate limit.
+# Classifying lines and parsing headers unlock the rest of the work on an endpoint.
+STAGE_PRIORITIES = {
+    'parse_header': 0,
+    'parse_requirements': 0,
+    'determine_code_block_type': 0,
+    'determine_else_or_elif': 0,
+}
+DEFAULT_PRIORITY = 1
+
+# The engines a stage tries, fastest first (see cascade_complete).
+ENGINES = ['curie', 'davinci']
+
+# Long enough for a valid answer of each stage; a truncated answer fails validation and is escalated.
+STAGE_MAX_TOKENS = {
+    'parse_header': 32,
+    'parse_requirements': 48,
+    'determine_code_block_type': 8,
+    'determine_else_or_elif': 32,
+    'parse_exception': 32,
+    'parse_assignment': 64,
+    'parse_output': 32,
+    'parse_python_statement': 64,
+    'parse_python_conditional_statement': 64,
+    'english2sql': 128,
+    'parse_outputs': 48,
+    'parse_inputs': 32,
+    'match_function_call': 64,
+}
+
+T = TypeVar('T')
+
+
+class LRUMemo:
+    """
+    A bounded in-memory LRU of completions that sits in front of the on-disk cache.
+    Bounded both by the number of entries and by the (utf-8) size of the stored prompts and results.
+    """
+
+    def __init__(self, max_entries: int = MEMO_MAX_ENTRIES, max_bytes: int = MEMO_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._entries: OrderedDict[tuple[str, str], str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def entry_size(engine: str, prompt: str, result: str) -> int:
+        return len(engine.encode('utf-8')) + len(prompt.encode('utf-8')) + len(result.encode('utf-8'))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, engine: str, prompt: str) -> Optional[str]:
+        key = (engine, prompt)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, engine: str, prompt: str, result: str) -> None:
+        size = self.entry_size(engine, prompt, result)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        key = (engine, prompt)
+        with self._lock:
+            if key in self._entries:
+                self.size_bytes -= self.entry_size(engine, prompt, self._entries.pop(key))
+            self._entries[key] = result
+            self.size_bytes += size
+            while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                (old_engine, old_prompt), old_result = self._entries.popitem(last=False)
+                self.size_bytes -= self.entry_size(old_engine, old_prompt, old_result)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+
+class _BatchGroup:
+
+    def __init__(self):
+        self.items: list[tuple[str, Future]] = []
+        self.full = threading.Event()
+
+
+class CompletionBatcher:
+    """
+    Collects cache misses for the same engine, stop sequence and max_tokens that arrive
+    within `window` seconds of each other (e.g. from concurrently compiled endpoints)
+    and sends them to the provider as one multi-prompt request of at most `max_size` prompts.
+    The first caller of a batch waits for the window and sends it; the others wait for their answer.
+    """
+
+    def __init__(self, max_size: int = BATCH_SIZE, window: float = 0.0):
+        self.max_size = max_size
+        self.window = window
+        self._groups: dict[tuple[str, str, int], _BatchGroup] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 1 and self.window > 0
+
+    def submit(self, prompt: str, engine: str, stop: str, max_tokens: int, priority: int = DEFAULT_PRIORITY) -> tuple[str, int]:
+        """ Returns the answer and the prompt characters sent for it (see send_completions). """
+        key = (engine, stop, max_tokens)
+        future: Future = Future()
+        with self._lock:
+            group = self._groups.get(key)
+            is_leader = group is None
+            if group is None:
+                group = _BatchGroup()
+                self._groups[key] = group
+            group.items.append((prompt, future))
+            if len(group.items) >= self.max_size:
+                # close the batch, the leader sends it right away
+                del self._groups[key]
+                group.full.set()
+        if is_leader:
+            group.full.wait(self.window)
+            with self._lock:
+                if self._groups.get(key) is group:
+                    del self._groups[key]
+            prompts = [p for p, _ in group.items]
+            try:
+                results, sent_chars = send_completions(prompts, engine=engine, stop=stop, max_tokens=max_tokens, priority=priority)
+            except BaseException as e:
+                for _, f in group.items:
+                    f.set_exception(e)
+            else:
+                for (_, f), result, chars in zip(group.items, results, sent_chars):
+                    f.set_result((result, chars))
+        return future.result()
+
+
+class TokenBucket:
+    """
+    A budget of `per_minute` units that refills continuously and can be spent in bursts of up to a minute's worth.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """ Seconds until `amount` can be spent (amounts larger than the capacity only need a full bucket). """
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def spend(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+
+class CompletionScheduler:
+    """
+    Sends provider requests within a requests-per-minute and tokens-per-minute budget.
+    Requests that have to wait are served in priority order (then first come, first served),
+    and transient errors are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 max_retries: int = MAX_RETRIES, base_delay: float = 1.0, max_delay: float = 60.0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._queue: list[tuple[int, int]] = []
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, tokens: int, priority: int) -> float:
+        """ Block until the request is at the head of the queue and fits the budget. Returns the time waited. """
+        if self.requests is None and self.tokens is None:
+            return 0.0
+        start = time.monotonic()
+        with self._cond:
+            self._seq += 1
+            ticket = (priority, self._seq)
+            heapq.heappush(self._queue, ticket)
+            while True:
+                timeout = None
+                if self._queue[0] == ticket:
+                    now = time.monotonic()
+                    timeout = 0.0
+                    for bucket, amount in [(self.requests, 1), (self.tokens, tokens)]:
+                        if bucket is not None:
+                            bucket.refill(now)
+                            timeout = max(timeout, bucket.wait_time(amount))
+                    if timeout <= 0:
+                        heapq.heappop(self._queue)
+                        if self.requests is not None:
+                            self.requests.spend(1)
+                        if self.tokens is not None:
+                            self.tokens.spend(tokens)
+                        self._cond.notify_all()
+                        return time.monotonic() - start
+                self._cond.wait(timeout)
+
+    def backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def run(self, fn: Callable[[], T], engine: str, tokens: int, priority: int = DEFAULT_PRIORITY) -> T:
+        stats = get_stats()
+        attempt = 0
+        while True:
+            waited = self.acquire(tokens, priority)
+            if waited > 0:
+                stats.record_throttle(engine, waited)
+            stats.record_request(engine)
+            try:
+                return fn()
+            except TransientCompletionError as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt, e.retry_after)
+                print(f'{engine}: {e} (retrying in {delay:.1f}s)')
+                stats.record_retry(engine)
+                stats.record_throttle(engine, delay)
+                time.sleep(delay)
+                attempt += 1
+
+
+def send_completions(prompts: list[str], engine: str, stop: str, max_tokens: int,
+                     priority: int = DEFAULT_PRIORITY) -> tuple[list[str], list[int]]:
+    """
+    Send prompts to the provider as one multi-prompt request. With packing enabled, the few-shot
+    prompts that share a preamble are first sent together as packed prompts (see packing.py), and
+    only the ones whose numbered answer is missing are sent on their own.
+    Returns the answers and the number of prompt characters sent for each of them.
+    """
+
+    provider = get_provider()
+    results: list[Optional[str]] = [None] * len(prompts)
+    sent_chars = [len(prompt) for prompt in prompts]
+    if _pack_size > 1 and stop == '\n':
+        groups: dict[tuple[str, str], list[tuple[int, str]]] = {}
+        for idx, prompt in enumerate(prompts):
+            parts = split_few_shot(prompt)
+            if parts is not None:
+                preamble, query, label = parts
+                groups.setdefault((preamble, label), []).append((idx, query))
+        for (preamble, label), items in groups.items():
+            for i in range(0, len(items), _pack_size):
+                chunk = items[i:i + _pack_size]
+                if len(chunk) < 2:
+                    continue
+                packed = pack_prompt(preamble, [query for _, query in chunk], label)
+                packed_max_tokens = max_tokens * len(chunk)
+                completion = _scheduler.run(lambda: provider.complete(packed, engine=engine, stop=PACKED_STOP, max_tokens=packed_max_tokens),
+                                            engine=engine, tokens=request_tokens([packed], packed_max_tokens), priority=priority)
+                for (idx, _), answer in zip(chunk, unpack_answers(completion, label, len(chunk))):
+                    if answer is not None:
+                        results[idx] = answer
+                        sent_chars[idx] = len(packed) // len(chunk)
+    rest = [idx for idx in range(len(prompts)) if results[idx] is None]
+    if len(rest) > 0:
+        rest_prompts = [prompts[idx] for idx in rest]
+        answers = _scheduler.run(lambda: provider.complete_many(rest_prompts, engine=engine, stop=stop, max_tokens=max_tokens),
+                                 engine=engine, tokens=request_tokens(rest_prompts, max_tokens), priority=priority)
+        for idx, answer in zip(rest, answers):
+            results[idx] = answer
+    return cast(list[str], results), sent_chars
+
+
+def request_tokens(prompts: list[str], max_tokens: int) -> int:
+    """ The tokens a request counts against the budget: its prompts plus the completions it may produce. """
+    return sum(estimate_tokens(prompt) + max_tokens for prompt in prompts)
+
+
+def stage_priority(stage: str) -> int:
+    return STAGE_PRIORITIES.get(stage, DEFAULT_PRIORITY)
+
+
+_cache: Optional[CompletionCache] = None
+_memo = LRUMemo()
+_scheduler = CompletionScheduler()
+_batcher = CompletionBatcher()
+_pack_size = PACK_SIZE
+_stage_engines: dict[str, list[str]] = {}
+_stage_max_tokens: dict[str, int] = dict(STAGE_MAX_TOKENS)
+_inflight: dict[tuple[str, str], Future] = {}
+_inflight_lock = threading.Lock()
+_provider: Optional[CompletionProvider] = None
+# engines answered in-process (e.g. the local classifier), never cached nor batched
+_local_engines: dict[str, CompletionProvider] = {}
+_recorded: Optional[set[tuple[str, str]]] = None
+_answer_source = ''
+
+
+def configure_provider(provider: CompletionProvider) -> CompletionProvider:
+    global _provider
+    _provider = provider
+    return _provider
+
+
+def get_provider() -> CompletionProvider:
+    global _provider
+    if _provider is None:
+        _provider = OpenAIProvider()
+    return _provider
+
+
+@contextmanager
+def use_provider(provider: CompletionProvider) -> Iterator[CompletionProvider]:
+    """ Temporarily answer cache misses with another provider (e.g. a ReplayProvider to work offline). """
+    global _provider
+    previous = _provider
+    _provider = provider
+    try:
+        yield provider
+    finally:
+        _provider = previous
+
+
+@contextmanager
+def use_cache(cache: CompletionCache) -> Iterator[CompletionCache]:
+    """ Temporarily read and write completions through another cache (with an empty memo in front of it). """
+    global _cache, _memo
+    saved = (_cache, _memo)
+    _cache = cache
+    _memo = LRUMemo(_memo.max_entries, _memo.max_bytes)
+    try:
+        yield cache
+    finally:
+        _cache, _memo = saved
+
+
+@contextmanager
+def record_requests() -> Iterator[set[tuple[str, str]]]:
+    """ Collects the (engine, prompt) key of every completion requested inside the block. """
+    global _recorded
+    previous = _recorded
+    _recorded = set()
+    try:
+        yield _recorded
+    finally:
+        _recorded = previous
+
+
+@contextmanager
+def dry_run() -> Iterator[None]:
+    """
+    Answer cache misses with placeholders (see `stub_answer`) that are neither cached on disk nor kept
+    in the memo afterwards, without waiting for rate limits: the stats then count the completions
+    that a real run would request, without requesting them.
+    """
+    global _cache, _memo, _provider, _scheduler, _batcher
+    saved = (_cache, _memo, _provider, _scheduler, _batcher)
+    _cache = ReadOnlyCache(get_cache())
+    _memo = LRUMemo()
+    _provider = StubProvider()
+    _scheduler = CompletionScheduler()
+    _batcher = CompletionBatcher()
+    try:
+        yield
+    finally:
+        _cache, _memo, _provider, _scheduler, _batcher = saved
+
+
+def configure_stage(stage: str, engines: Optional[list[str]] = None, max_tokens: Optional[int] = None) -> None:
+    """ Set the cascade policy of a stage: the engines to try in order, and the max_tokens of its completions. """
+    if engines is not None:
+        if len(engines) == 0:
+            raise ValueError(f'Expected at least one engine for stage {stage}')
+        _stage_engines[stage] = engines
+    if max_tokens is not None:
+        if max_tokens < 1:
+            raise ValueError(f'Expected a positive max_tokens for stage {stage}, got {max_tokens}')
+        _stage_max_tokens[stage] = max_tokens
+
+
+def stage_engines(stage: str) -> list[str]:
+    return _stage_engines.get(stage, ENGINES)
+
+
+def stage_max_tokens(stage: str) -> int:
+    return _stage_max_tokens.get(stage, MAX_TOKENS)
+
 
+def configure_local_engine(name: str, provider: CompletionProvider) -> None:
+    """ Let stages list `name` among their engines, to be answered by `provider` (in-process, uncached). """
+    _local_engines[name] = provider
 
-def cached_complete(prompt: str, stop: str = '\n', engine: Literal['davinci', 'curie'] = 'davinci', use_cache: bool = True) -> str:
-    if not os.path.exists(CACHE_DIR):
-        os.mkdir(CACHE_DIR)
 
-    cache_key = engine + '###' + prompt
+def is_local_engine(engine: str) -> bool:
+    return engine in _local_engines
+
+
+def local_complete(engine: str, prompt: str, stop: str = '\n', max_tokens: int = MAX_TOKENS) -> str:
+    return _local_engines[engine].complete(prompt, engine=engine, stop=stop, max_tokens=max_tokens)
+
+
+def configure_answer_source(source: str) -> None:
+    """ Set where the answers come from (see providers.answer_source), which compiled blocks depend on. """
+    global _answer_source
+    _answer_source = source
+
+
+def provider_options() -> str:
+    """ The source of the answers, as a string (it is part of the fingerprint of compiled blocks). """
+    return f'source={_answer_source or "openai"}'
+
+
+def cascade_options() -> str:
+    """ The cascade policies, as a string (they are part of the fingerprint of compiled blocks). """
+    stages = sorted(set(_stage_engines) | set(_stage_max_tokens))
+    return ','.join(f'{stage}={"+".join(stage_engines(stage))}/{stage_max_tokens(stage)}' for stage in stages)
+
+
+def configure_packing(max_size: int = PACK_SIZE) -> None:
+    global _pack_size
+    _pack_size = max_size
+
+
+def configure_memo(max_entries: int = MEMO_MAX_ENTRIES, max_bytes: int = MEMO_MAX_BYTES) -> LRUMemo:
+    global _memo
+    _memo = LRUMemo(max_entries=max_entries, max_bytes=max_bytes)
+    return _memo
+
+
+def get_memo() -> LRUMemo:
+    return _memo
+
+
+def configure_scheduler(requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                        max_retries: int = MAX_RETRIES) -> CompletionScheduler:
+    global _scheduler
+    _scheduler = CompletionScheduler(requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute,
+                                     max_retries=max_retries)
+    return _scheduler
+
+
+def get_scheduler() -> CompletionScheduler:
+    return _scheduler
+
+
+def configure_batching(max_size: int = BATCH_SIZE, window: float = 0.0) -> CompletionBatcher:
+    global _batcher
+    _batcher = CompletionBatcher(max_size=max_size, window=window)
+    return _batcher
+
+
+def get_batcher() -> CompletionBatcher:
+    return _batcher
+
+
+def configure_cache(backend: str = 'directory', path: str = CACHE_DIR) -> CompletionCache:
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = open_cache(backend, path)
+    _memo.clear()
+    return _cache
+
+
+def get_cache() -> CompletionCache:
+    global _cache
+    if _cache is None:
+        _cache = DirectoryCache(CACHE_DIR)
+    return _cache
+
+
+def lookup(engine: str, prompt: str, remember: bool = True) -> tuple[Optional[str], Optional[str]]:
+    """
+    Check the in-memory tier first, then the on-disk cache. Returns the result and where it was found.
+    A disk hit is kept in memory unless remember=False (for a peek whose result may not be used).
+    """
+    cached = _memo.get(engine, prompt)
+    if cached is not None:
+        return cached, 'memo'
+    cached = get_cache().get(engine, prompt)
+    if cached is not None:
+        if remember:
+            _memo.put(engine, prompt, cached)
+        return cached, 'disk'
+    return None, None
+
+
+def claim(engine: str, prompt: str) -> tuple[Future, bool]:
+    """
+    Single-flight: returns the future of the in-flight request for this key and whether
+    the caller owns it (and so must send the request and `release` the key) or should just wait.
+    """
+    key = (engine, prompt)
+    with _inflight_lock:
+        future = _inflight.get(key)
+        if future is not None:
+            return future, False
+        future = Future()
+        _inflight[key] = future
+        return future, True
+
+
+def release(engine: str, prompt: str, future: Future, result: Optional[str] = None, error: Optional[BaseException] = None) -> None:
+    with _inflight_lock:
+        del _inflight[(engine, prompt)]
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+def cached_complete(prompt: str, stop: str = '\n', engine: str = 'davinci', use_cache: bool = True, stage: str = 'unknown',
+                    max_tokens: int = MAX_TOKENS) -> str:
+    start = time.perf_counter()
+    try:
+        return _cached_complete(prompt, stop=stop, engine=engine, use_cache=use_cache, stage=stage, max_tokens=max_tokens)
+    finally:
+        get_stats().record_wait(engine, stage, time.perf_counter() - start)
+
+
+def _cached_complete(prompt: str, stop: str, engine: str, use_cache: bool, stage: str, max_tokens: int) -> str:
+    cache = get_cache()
+    stats = get_stats()
+
+    if _recorded is not None:
+        _recorded.add((engine, prompt))
 
-    separator = '\n===========\n'
     if use_cache:
-        # Check the cache
-        cache_files = [os.path.join(CACHE_DIR, p) for p in os.listdir(CACHE_DIR)]
-        for fn in cache_files:
-            with open(fn, 'r') as f:
-                query, result = f.read().split(separator)
-            if query == cache_key:
-                return result
-
-    response = cast(Any, openai.Completion.create(
-        engine=engine,
-        prompt=prompt,
-        max_tokens=64,
-        temperature=0,
-        stop=stop,
-    ))
-    result = response['choices'][0]['text']
-
-    # Add to the cache
-    cache_file = os.path.join(CACHE_DIR, str(uuid4()))
-    with open(cache_file, 'w') as f:
-        f.write(cache_key + separator + result)
-
-    print(engine, result)
+        start = time.perf_counter()
+        cached, hit = lookup(engine, prompt)
+        stats.record_lookup(engine, stage, prompt, time.perf_counter() - start, hit)
+        if cached is not None:
+            return cached
+    else:
+        stats.record_lookup(engine, stage, prompt, 0.0, None)
+
+    future, is_owner = claim(engine, prompt)
+    if not is_owner:
+        # an identical request is already in flight, wait for its answer
+        stats.record_coalesced(engine, stage)
+        return future.result()
+
+    try:
+        # it may have been answered between the lookup and the claim
+        result = _memo.get(engine, prompt) if use_cache else None
+        if result is None:
+            start = time.perf_counter()
+            if _batcher.enabled:
+                result, sent_chars = _batcher.submit(prompt, engine=engine, stop=stop, max_tokens=max_tokens, priority=stage_priority(stage))
+            else:
+                provider = get_provider()
+                result = _scheduler.run(lambda: provider.complete(prompt, engine=engine, stop=stop, max_tokens=max_tokens),
+                                        engine=engine, tokens=request_tokens([prompt], max_tokens), priority=stage_priority(stage))
+                sent_chars = len(prompt)
+            stats.record_remote(engine, stage, prompt, result, time.perf_counter() - start, prompt_chars=sent_chars)
+
+            # Add to the cache
+            cache.put(engine, prompt, result)
+            _memo.put(engine, prompt, result)
+
+            print(engine, result)
+    except BaseException as e:
+        release(engine, prompt, future, error=e)
+        raise
+    release(engine, prompt, future, result=result)
+    return result
+
+
+def cached_complete_many(prompts: list[str], stop: str = '\n', engine: str = 'davinci', stage: str = 'unknown',
+                         max_tokens: int = MAX_TOKENS) -> list[str]:
+    """
+    Like cached_complete for many prompts at once: the cache misses are sent to the provider
+    as multi-prompt (and, with packing, packed) requests of at most `batch size` prompts,
+    and every answer is cached individually.
+    """
+
+    start = time.perf_counter()
+    try:
+        return _cached_complete_many(prompts, stop=stop, engine=engine, stage=stage, max_tokens=max_tokens)
+    finally:
+        get_stats().record_wait(engine, stage, time.perf_counter() - start)
+
+
+def _cached_complete_many(prompts: list[str], stop: str, engine: str, stage: str, max_tokens: int) -> list[str]:
+    cache = get_cache()
+    stats = get_stats()
+    results: dict[str, str] = {}
+    misses: list[str] = []
+    for prompt in prompts:
+        if _recorded is not None:
+            _recorded.add((engine, prompt))
+        if prompt in results or prompt in misses:
+            continue
+        start = time.perf_counter()
+        cached, hit = lookup(engine, prompt)
+        stats.record_lookup(engine, stage, prompt, time.perf_counter() - start, hit)
+        if cached is not None:
+            results[prompt] = cached
+        else:
+            misses.append(prompt)
+
+    owned: list[tuple[str, Future]] = []
+    waiting: list[tuple[str, Future]] = []
+    for prompt in misses:
+        future, is_owner = claim(engine, prompt)
+        if is_owner:
+            owned.append((prompt, future))
+        else:
+            stats.record_coalesced(engine, stage)
+            waiting.append((prompt, future))
+
+    batch_size = max(_batcher.max_size, 1)
+    for i in range(0, len(owned), batch_size):
+        batch = owned[i:i + batch_size]
+        start = time.perf_counter()
+        batch_prompts = [p for p, _ in batch]
+        try:
+            answers, sent_chars = send_completions(batch_prompts, engine=engine, stop=stop, max_tokens=max_tokens, priority=stage_priority(stage))
+        except BaseException as e:
+            for prompt, future in owned[i:]:
+                release(engine, prompt, future, error=e)
+            raise
+        seconds = time.perf_counter() - start
+        for (prompt, future), result, chars in zip(batch, answers, sent_chars):
+            # each answer goes into its own (single prompt) cache entry, so that later lookups hit
+            stats.record_remote(engine, stage, prompt, result, seconds / len(batch), prompt_chars=chars)
+            cache.put(engine, prompt, result)
+            _memo.put(engine, prompt, result)
+            results[prompt] = result
+            release(engine, prompt, future, result=result)
+            print(engine, result)
+
+    for prompt, future in waiting:
+        results[prompt] = future.result()
+
+    return [results[prompt] for prompt in prompts]
+
+
+def peek_answer(prompt: str, stage: str, validate: Callable[[str], bool]) -> Optional[tuple[str, str, Optional[str]]]:
+    """
+    The engine, answer and tier of a valid answer already cached for any of the stage's (remote) engines,
+    or None. Nothing is counted nor kept in memory.
+    """
+
+    for engine in stage_engines(stage):
+        if is_local_engine(engine):
+            continue
+        cached, hit = lookup(engine, prompt, remember=False)
+        if cached is not None and validate(cached):
+            return engine, cached, hit
+    return None
+
+
+def cached_answer(prompt: str, stage: str, validate: Callable[[str], bool]) -> Optional[str]:
+    """
+    A valid answer already cached for any of the stage's (remote) engines, or None.
+    A hit is counted once, like a cache hit of cached_complete.
+    """
+
+    stats = get_stats()
+    start = time.perf_counter()
+    peeked = peek_answer(prompt, stage, validate)
+    if peeked is None:
+        return None
+    engine, cached, hit = peeked
+    seconds = time.perf_counter() - start
+    _memo.put(engine, prompt, cached)
+    if _recorded is not None:
+        _recorded.add((engine, prompt))
+    stats.record_lookup(engine, stage, prompt, seconds, hit)
+    stats.record_wait(engine, stage, seconds)
+    stats.record_cascade(stage, [engine], valid=True)
+    return cached
+
+
+def cascade_complete(prompt: str, stage: str, validate: Callable[[str], bool], stop: str = '\n') -> str:
+    """
+    Complete a prompt with the engines of the stage's policy, fastest first, escalating to the next
+    engine only when `validate` rejects the answer. A valid answer already cached for any of the
+    engines is used without asking the others. Local engines (see configure_local_engine) answer
+    in-process and decline with an invalid answer. When no engine gives a valid answer, the last answer
+    is returned (for the caller to report).
+    """
+
+    cached = cached_answer(prompt, stage, validate)
+    if cached is not None:
+        return cached
+
+    engines = stage_engines(stage)
+    max_tokens = stage_max_tokens(stage)
+    stats = get_stats()
+    result = ''
+    for idx, engine in enumerate(engines):
+        if is_local_engine(engine):
+            result = local_complete(engine, prompt, stop=stop, max_tokens=max_tokens)
+        else:
+            result = cached_complete(prompt, stop=stop, engine=engine, stage=stage, max_tokens=max_tokens)
+        if validate(result):
+            stats.record_cascade(stage, engines[:idx + 1], valid=True)
+            return result
+    stats.record_cascade(stage, engines, valid=False)
     return result
@@ -0,0 +1,90 @@
+from typing import Any, Callable, Dict, Tuple, cast
+import gzip
+import json
+
+from plainapi.version import __version__
+from plainapi.parse_application import Application
+from plainapi.parse_endpoint import Endpoint
+
+
+IR_FORMAT = 'plainapi-ir'
+IR_VERSION = 1
+IR_FILENAME = 'app.ir.json'
+
+# Upgrades a payload from version N to N + 1, keyed by N.
+UPGRADES: Dict[int, Callable[[Dict[str, Any]], Dict[str, Any]]] = {}
+
+
+def dumps_ir(kind: str, data: Any, **extra: Any) -> str:
+    """
+    Serialize a piece of IR (an application or an endpoint) with a versioned header, as compact JSON.
+    """
+
+    payload = {
+        'format': IR_FORMAT,
+        'version': IR_VERSION,
+        'compiler': __version__,
+        'kind': kind,
+        **extra,
+        kind: data,
+    }
+    return json.dumps(payload, separators=(',', ':'), sort_keys=True)
+
+
+def loads_ir(text: str, kind: str) -> Dict[str, Any]:
+    """
+    Parse and validate serialized IR, upgrading payloads written by older versions of the format.
+    """
+
+    payload = json.loads(text)
+    if not isinstance(payload, dict) or payload.get('format') != IR_FORMAT:
+        raise ValueError('Not a PlainAPI IR file')
+    if payload.get('kind') != kind:
+        raise ValueError(f'Expected IR of kind "{kind}", got "{payload.get("kind")}"')
+    version = payload.get('version')
+    if not isinstance(version, int) or version > IR_VERSION:
+        raise ValueError(f'Unsupported IR version {version} (this compiler supports up to {IR_VERSION})')
+    while version < IR_VERSION:
+        if version not in UPGRADES:
+            raise ValueError(f'Cannot upgrade IR from version {version}')
+        payload = UPGRADES[version](payload)
+        version += 1
+        payload['version'] = version
+    return payload
+
+
+def dump_application(application: Application, schema_text: str, filename: str = IR_FILENAME) -> None:
+    """
+    Write the parsed application (and the schema it was parsed against) to a file, gzipped if the name ends with .gz.
+    """
+
+    text = dumps_ir('application', application, schema_text=schema_text)
+    if filename.endswith('.gz'):
+        with gzip.open(filename, 'wt', encoding='utf-8') as f:
+            f.write(text)
+    else:
+        with open(filename, 'w') as f:
+            f.write(text)
+
+
+def load_application(filename: str = IR_FILENAME) -> Tuple[Application, str]:
+    """
+    Read an application written by dump_application. Returns the application and the schema text.
+    """
+
+    if filename.endswith('.gz'):
+        with gzip.open(filename, 'rt', encoding='utf-8') as f:
+            text = f.read()
+    else:
+        with open(filename, 'r') as f:
+            text = f.read()
+    payload = loads_ir(text, 'application')
+    return cast(Application, payload['application']), payload['schema_text']
+
+
+def dumps_endpoint(endpoint: Endpoint) -> str:
+    return dumps_ir('endpoint', endpoint)
+
+
+def loads_endpoint(text: str) -> Endpoint:
+    return cast(Endpoint, loads_ir(text, 'endpoint')['endpoint'])
@@ -0,0 +1,62 @@
+from typing import Optional
+import re
+
+
+# Packed answers span several lines, so they end at a blank line instead.
+PACKED_STOP = '\n\n'
+
+
+def split_few_shot(prompt: str) -> Optional[tuple[str, str, str]]:
+    """
+    Split a few-shot prompt whose last block is a single query line and a label,
+
+        ...examples...
+
+        Statement: user <- get a user
+        Type:
+
+    into its preamble, the query line and the label. Returns None for other prompts.
+    """
+
+    idx = prompt.rfind('\n\n')
+    if idx == -1:
+        return None
+    lines = prompt[idx + 2:].split('\n')
+    if len(lines) != 2 or not lines[1].endswith(':') or ':' not in lines[0]:
+        return None
+    return prompt[:idx], lines[0], lines[1]
+
+
+def pack_prompt(preamble: str, queries: list[str], label: str) -> str:
+    """
+    One prompt for many queries with the same preamble and label: the preamble once, then the
+    numbered queries, then the numbered answers to complete ("1. Type:" is already given).
+    """
+
+    numbered = '\n'.join(f'{i + 1}. {query}' for i, query in enumerate(queries))
+    return \
+f"""{preamble}
+
+Answer each of the following {len(queries)} numbered statements on its own numbered line.
+
+{numbered}
+
+1. {label}"""
+
+
+def unpack_answers(completion: str, label: str, count: int) -> list[Optional[str]]:
+    """
+    The answers of a packed completion, in the form of single completions (" assignment"),
+    or None for the ones that are missing.
+    """
+
+    answers: list[Optional[str]] = [None] * count
+    pattern = re.compile(r'^\s*(\d+)\.\s*' + re.escape(label) + r'(.*)$')
+    for line in (f'1. {label}' + completion).split('\n'):
+        m = pattern.match(line)
+        if m is None:
+            continue
+        number = int(m.group(1))
+        if 1 <= number <= count and answers[number - 1] is None:
+            answers[number - 1] = ' ' + m.group(2).strip()
+    return answers
@@ -1,9 +1,10 @@
-from typing import TypedDict
-import os
-from dotenv import load_dotenv
-import openai  # type: ignore
+from typing import Optional, TypedDict, cast
+from concurrent.futures import ThreadPoolExecutor
 
 from plainapi.parse_endpoint import parse_endpoint, Endpoint
+from plainapi.parse_code import prefetch_code_block_types, parser_options
+from plainapi.build import BuildCache, block_fingerprint
+from plainapi.stats import endpoint_scope
 
 
 class Application(TypedDict):
@@ -11,19 +12,67 @@ class Application(TypedDict):
     endpoints: list[Endpoint]
 
 
-def parse_application(endpoints_code: str, functions_code: str, schema_text: str) -> Application:
+def split_endpoints(endpoints_code: str) -> tuple[str, list[str]]:
+    """ Split the endpoints file into its title and its endpoint blocks. """
     blocks = [s.strip() for s in endpoints_code.split('\n\n') if s.strip() != '']
     if len(blocks) < 1:
         raise ValueError('Expected at least one block in the endpoints file (for the title).')
     title_block = blocks[0]
     title = title_block.split('\n')[0].strip()
-    endpoints: list[Endpoint] = []
-    for block in blocks[1:]:
+    return title, blocks[1:]
+
+
+def endpoint_label(block: str) -> str:
+    """ How an endpoint is referred to in the stats: its header line. """
+    return block.split('\n')[0].strip()
+
+
+def parse_application(endpoints_code: str, functions_code: str, schema_text: str, jobs: int = 1,
+                      build_cache: Optional[BuildCache] = None) -> Application:
+    """
+    Parse the endpoints file into an Application.
+    With jobs > 1, the (independent) endpoint blocks are compiled concurrently on that many threads;
+    the endpoints are still returned in the order of the file.
+    With a build cache, blocks whose fingerprint (source, schema, parser options and compiler) is unchanged
+    since the last build are loaded from it instead of being compiled again.
+    """
+
+    title, endpoint_blocks = split_endpoints(endpoints_code)
+    fingerprints = [block_fingerprint(block, schema_text, parser_options()) for block in endpoint_blocks]
+    compiled: dict[int, Endpoint] = {}
+    if build_cache is not None:
+        for idx, fingerprint in enumerate(fingerprints):
+            endpoint = build_cache.load(fingerprint)
+            if endpoint is not None:
+                compiled[idx] = cast(Endpoint, endpoint)
+        build_cache.reused = len(compiled)
+    todo = [idx for idx in range(len(endpoint_blocks)) if idx not in compiled]
+
+    # classify the statements of the whole file in a few batched requests up front
+    prefetch_code_block_types([line for idx in todo for line in endpoint_blocks[idx].split('\n')[2:]])
+
+    def parse_block(idx: int) -> Endpoint:
         offset = 1  # just being lazy
-        endpoint = parse_endpoint(endpoint_string=block, schema_text=schema_text, global_line_offset=offset)
-        endpoints.append(endpoint)
+        with endpoint_scope(endpoint_label(endpoint_blocks[idx])):
+            endpoint = parse_endpoint(endpoint_string=endpoint_blocks[idx], schema_text=schema_text, global_line_offset=offset)
+        if build_cache is not None:
+            build_cache.save(fingerprints[idx], endpoint)
+        return endpoint
+
+    if jobs > 1 and len(todo) > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for idx, endpoint in zip(todo, executor.map(parse_block, todo)):
+                compiled[idx] = endpoint
+    else:
+        for idx in todo:
+            compiled[idx] = parse_block(idx)
+
+    if build_cache is not None:
+        build_cache.compiled = len(todo)
+        build_cache.prune(set(fingerprints))
+
+    endpoints = [compiled[idx] for idx in range(len(endpoint_blocks))]
     return {
         'title': title,
         'endpoints': endpoints
     }
-
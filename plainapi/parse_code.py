@@ -1,9 +1,16 @@
 from typing import Literal, Optional, Tuple, List, TypedDict, Union, Dict, Any, cast
+from concurrent.futures import Future, ThreadPoolExecutor
+import contextvars
 import itertools
 import json
-
-from plainapi.gpt3 import cached_complete
-from plainapi.generate_sql import english2sql
+import re
+
+from plainapi.gpt3 import cascade_complete, cascade_options, cached_complete_many, is_local_engine, local_complete, peek_answer, provider_options, stage_engines, stage_max_tokens
+from plainapi.classifier import classifier_options
+from plainapi.examples import examples_options, few_shot_complete
+from plainapi.stats import get_stats
+from plainapi.generate_sql import cached_sql, english2sql, schema_pruning_enabled
+from plainapi.templates import match_sql_template, templates_options
 from plainapi.utils import get_db_schema_text
 
 
@@ -78,14 +85,70 @@ Statement = Union[
 
 CodeBlock = List[Statement]
 
+# How each kind of statement is parsed (for sql, the local parser is the templates of the cached translations):
+#   auto  - with the local (syntactic) parser, asking the model only for lines it doesn't recognize
+#   local - with the local parser only; an unrecognized line is an error
+#   llm   - always by the model
+ParserMode = Literal['auto', 'local', 'llm']
+PARSER_KINDS = ['assignment', 'exception', 'output', 'sql']
+_parser_modes: Dict[str, ParserMode] = {kind: 'auto' for kind in PARSER_KINDS}
+
+
+# Number of threads parsing the lines of one code block (1 parses them one after another).
+_statement_workers = 1
+
+
+def configure_statement_workers(workers: int) -> None:
+    global _statement_workers
+    if workers < 1:
+        raise ValueError(f'Expected a positive number of statement workers, got {workers}')
+    _statement_workers = workers
+
+
+def configure_parsers(**modes: str) -> None:
+    """ e.g. configure_parsers(exception='local', output='llm') """
+    for kind, mode in modes.items():
+        if kind not in PARSER_KINDS:
+            raise ValueError(f'Unknown statement kind "{kind}" (expected one of {", ".join(PARSER_KINDS)})')
+        if mode not in ['auto', 'local', 'llm']:
+            raise ValueError(f'Invalid parser mode "{mode}" for {kind} statements (expected "auto", "local" or "llm")')
+        _parser_modes[kind] = cast(ParserMode, mode)
+
+
+def parser_options() -> str:
+    """ The parser (cascade and example) configuration, as a string (it is part of the fingerprint of compiled blocks). """
+    options = [f'{kind}={_parser_modes[kind]}' for kind in PARSER_KINDS]
+    options.append(f'prune_schema={schema_pruning_enabled()}')
+    options.append(provider_options())
+    options.append(cascade_options())
+    options.append(examples_options())
+    options.append(templates_options())
+    options.append(classifier_options())
+    return ','.join(options)
+
+
+def parse_locally(kind: str, stage: str, text: str, match: Any) -> Optional[Any]:
+    """
+    Run a local parser according to the configured mode for this kind of statement.
+    Returns None when the model should be asked instead.
+    """
+
+    mode = _parser_modes[kind]
+    if mode == 'llm':
+        get_stats().record_path(stage, text, 'llm')
+        return None
+    result = match(text)
+    if result is not None:
+        get_stats().record_path(stage, text, 'local')
+        return result
+    if mode == 'local':
+        raise ValueError(f'Could not parse {kind} statement: {text.strip()}')
+    get_stats().record_path(stage, text, 'llm')
+    return None
 
-def determine_code_block_type(first_line: str) -> Literal['if', 'exception', 'assignment', 'output', 'something-else']:
-    first_line = first_line.strip()
-
-    if first_line.startswith('if'):
-        return 'if'
 
-    prompt = \
+def code_block_type_prompt(first_line: str) -> str:
+    return \
 f"""For each of the following statements, determine what kind of statement it would be if written in code. All statements must be one of the following:
 "exception"
 "assignment"
@@ -130,13 +193,100 @@ Reason: the "<-" arrow
 Statement: {first_line.strip()}
 Type:"""
 
-    result = cached_complete(prompt, engine='davinci').strip()
+
+def first_word(text: str) -> str:
+    words = text.strip().split()
+    if len(words) == 0:
+        return ''
+    return words[0].strip(',:').lower()
+
+
+def classify_statement_locally(first_line: str) -> Optional[Literal['if', 'exception', 'assignment', 'output']]:
+    """
+    Classify a statement from its lexical cues alone, or return None when the syntax doesn't decide it.
+
+    user <- get a user           -> assignment
+    let x be the oldest user     -> assignment
+    return {user}, output x      -> output
+    raise ..., throw ...         -> exception
+    report 400 ..., report "..." -> exception (but "report sql: ..." is ambiguous)
+
+    """
+
+    first_line = first_line.strip()
+    word = first_word(first_line)
+    if first_line.startswith('if'):
+        return 'if'
+    if '<-' in first_line or word == 'let':
+        return 'assignment'
+    if word in ['return', 'output']:
+        return 'output'
+    if word in ['raise', 'throw']:
+        return 'exception'
+    if word == 'report' and re.match(r'^report\s+(\d{3}\b|")', first_line, re.IGNORECASE):
+        return 'exception'
+    return None
+
+
+def valid_statement_type(result: str) -> bool:
+    return result.strip() in ['exception', 'assignment', 'output', 'something-else']
+
+
+def is_python(code: str, mode: str = 'eval') -> bool:
+    """ Whether the code is a Python expression (mode 'eval') or statement (mode 'exec'). """
+    try:
+        compile(code.strip(), '<completion>', mode)
+        return True
+    except (SyntaxError, ValueError):
+        return False
+
+
+def determine_code_block_type(first_line: str) -> Literal['if', 'exception', 'assignment', 'output', 'something-else']:
+    first_line = first_line.strip()
+
+    if first_line.startswith('if'):
+        return 'if'
+
+    local_type = classify_statement_locally(first_line)
+    if local_type is not None:
+        get_stats().record_path('determine_code_block_type', first_line, 'local')
+        return local_type
+    get_stats().record_path('determine_code_block_type', first_line, 'llm')
+
+    prompt = code_block_type_prompt(first_line)
+    result = few_shot_complete(prompt, stage='determine_code_block_type', validate=valid_statement_type).strip()
     if result == 'exception' or result == 'assignment' or result == 'output' or result == 'something-else':
         return result
     else:
         raise ValueError('Internal Error: failed to match')
 
 
+def prefetch_code_block_types(lines: List[str]) -> None:
+    """
+    Classify many lines at once (as batched completion requests), so that the
+    determine_code_block_type calls made while parsing them are cache hits.
+    """
+
+    prompts = []
+    for line in lines:
+        line = line.strip()
+        # "otherwise"/"else" lines are only ever given to determine_else_or_elif
+        if line == '' or classify_statement_locally(line) is not None or first_word(line) in ['otherwise', 'else', 'elif']:
+            continue
+        prompts.append(code_block_type_prompt(line))
+    stage = 'determine_code_block_type'
+    engines = stage_engines(stage)
+    # the lines that a local engine (see classifier.py) classifies cost nothing
+    local = [engine for engine in engines if is_local_engine(engine)]
+    prompts = [prompt for prompt in prompts if not any(valid_statement_type(local_complete(engine, prompt)) for engine in local)]
+    # and so do the ones any engine of the cascade has answered before (e.g. davinci, before curie was tried first)
+    prompts = [prompt for prompt in prompts if peek_answer(prompt, stage, valid_statement_type) is None]
+    remote = [engine for engine in engines if not is_local_engine(engine)]
+    if len(prompts) > 0 and len(remote) > 0:
+        # warms the cache for the first remote engine of the cascade
+        cached_complete_many(prompts, engine=remote[0], stage=stage, max_tokens=stage_max_tokens(stage))
+
+
 def match_function_call(code_string: str, available_functions: list[Function]) -> Union[str, None]:
     """ Returns either the code to execute a matching function call or None if there's no match. """
 
@@ -166,7 +316,7 @@ function name: n/a
 statement: {code_string.strip()}
 function name:"""
 
-    result = cached_complete(prompt, engine='curie').strip()
+    result = cascade_complete(prompt, stage='match_function_call', validate=lambda r: r.strip() == 'n/a' or is_python(r)).strip()
     first_paren_idx = result.find('(')
     if first_paren_idx == -1:
         raise ValueError(f'Internal Error: invalid function call {result}')
@@ -179,8 +329,41 @@ function name:"""
         raise ValueError('Internal Error: function name is not among the given names')
 
 
+ELSE_PATTERN = re.compile(r'^(?:else|otherwise)\s*[,:]?$', re.IGNORECASE)
+ELIF_PATTERN = re.compile(r'^(?:(?:else|otherwise)\s*,?\s*if|elif)\b\s*(.+?):?$', re.IGNORECASE)
+
+
+def match_else_or_elif(text: str) -> Optional[Tuple[Literal['else', 'elif', 'n/a'], Optional[str]]]:
+    """
+    Detect "else"/"otherwise", "otherwise, if <condition>" and plain statements locally,
+    or return None when the line needs the model.
+    """
+
+    text = text.strip()
+    if ELSE_PATTERN.match(text):
+        return 'else', None
+    m = ELIF_PATTERN.match(text)
+    if m is not None:
+        return 'elif', m.group(1).strip()
+    if first_word(text) not in ['else', 'otherwise', 'elif'] and classify_statement_locally(text) is not None:
+        # an if, assignment, output or exception statement is clearly not part of the previous if
+        return 'n/a', None
+    return None
+
+
+def valid_else_or_elif(result: str) -> bool:
+    result = result.strip()
+    return result in ['else', 'n/a'] or re.match(r'^else-if\s*:\s*\S', result) is not None
+
+
 def determine_else_or_elif(text: str) -> Tuple[Literal['else', 'elif', 'n/a'], Optional[str]]:
 
+    local = match_else_or_elif(text)
+    if local is not None:
+        get_stats().record_path('determine_else_or_elif', text, 'local')
+        return local
+    get_stats().record_path('determine_else_or_elif', text, 'llm')
+
     prompt = \
 f"""Determine if the following statements represent an "if" block, a terminal "else" code block, or an "else-if" code block. If it's an else block, put "else", if it's an if, put "if:" followed by the condition itself, and if it's an else-if, put "else-if: " followed by the condition. If neither of these make sense, put "n/a".
 
@@ -205,12 +388,13 @@ Type: n/a
 Statement: {text.strip()}
 Type:"""
 
-    result = cached_complete(prompt, engine='curie').strip()
+    result = few_shot_complete(prompt, stage='determine_else_or_elif', validate=valid_else_or_elif).strip()
     if result == 'else':
         return 'else', None
     elif result.startswith('else-if'):
-        parts = result.split(':')
-        assert len(parts) == 2
+        parts = result.split(':', 1)
+        if len(parts) != 2:
+            raise ValueError(f'Failed to parse else-if statement: {text.strip()} (got "{result}")')
         condition = parts[1].strip()
         return 'elif', condition
     else:
@@ -227,8 +411,62 @@ def count_leading_spaces(text: str) -> int:
     return cnt
 
 
+EXCEPTION_PATTERN = re.compile(r'^(?:report|raise|throw)\s+(?:(\d{3})\b\s*[:,]?\s*)?(.*)$', re.IGNORECASE)
+TRAILING_CODE_PATTERN = re.compile(r'^(".*"|\'.*\')\s*,\s*(\d{3})$')
+EXCEPTION_ANSWER_PATTERN = re.compile(r'^\s*code\s*=\s*(\d+|None)\s*,\s*message\s*=\s*(.*)$')
+PLAIN_MESSAGE_PATTERN = re.compile(r'^[\w][\w\s.,!?\'-]*$')
+
+
+def quote_message(message: str) -> str:
+    """ Exception messages are kept as Python string literals (as the model writes them). """
+    if len(message) >= 2 and message[0] == message[-1] and message[0] in ['"', "'"]:
+        message = message[1:-1]
+    return json.dumps(message)
+
+
+def match_exception(text: str) -> Optional[ExceptionStatement]:
+    """
+    Parse an exception statement of one of the forms:
+
+    report 400: "Forbidden"      (also raise/throw, with or without the colon)
+    report "Bad password"
+    raise 404
+    throw "Not enough data", 500
+    raise 403: Not allowed       (an unquoted message may only contain words and punctuation)
+
+    Returns None for anything else.
+    """
+
+    m = EXCEPTION_PATTERN.match(text.strip())
+    if m is None:
+        return None
+    code_str, rest = m.group(1), m.group(2).strip()
+    if code_str is None:
+        trailing = TRAILING_CODE_PATTERN.match(rest)
+        if trailing is not None:
+            rest, code_str = trailing.group(1), trailing.group(2)
+    if rest == '':
+        message = None
+    elif (rest[0] == '"' and rest.count('"') == 2 and rest.endswith('"')) \
+            or (rest[0] == "'" and rest.count("'") == 2 and rest.endswith("'")):
+        message = quote_message(rest)
+    elif code_str is not None and PLAIN_MESSAGE_PATTERN.match(rest):
+        message = quote_message(rest)
+    else:
+        return None
+    if code_str is None and message is None:
+        return None
+    return ExceptionStatement(
+        type='exception',
+        code=int(code_str) if code_str is not None else None,
+        message=message
+    )
+
+
 def parse_exception(text: str) -> ExceptionStatement:
-    pass
+    local = parse_locally('exception', 'parse_exception', text, match_exception)
+    if local is not None:
+        return cast(ExceptionStatement, local)
 
     prompt = \
 f"""The following statements represent exception statements. Parse them into form "code=<code>, message=<message>". If the code or message are not present, put "None" for that value.
@@ -248,25 +486,78 @@ Parsed: code=500, message="Not enough data"
 Statement: {text.strip()}
 Parsed:"""
 
-    result = cached_complete(prompt, engine='curie')
-    parts = result.split(',')
-    assert len(parts) == 2
-    code_parts = parts[0].split('=')
-    message_parts = parts[1].split('=')
-    assert len(code_parts) == 2
-    assert len(message_parts) == 2
-    assert code_parts[0].strip() == 'code'
-    assert message_parts[0].strip() == 'message'
-    code_str = code_parts[1].strip()
-    code = int(code_str) if code_str != 'None' else None
+    result = few_shot_complete(prompt, stage='parse_exception', validate=lambda r: EXCEPTION_ANSWER_PATTERN.match(r.strip()) is not None)
+    m = EXCEPTION_ANSWER_PATTERN.match(result.strip())
+    if m is None:
+        raise ValueError(f'Failed to parse exception statement: {text.strip()} (got "{result.strip()}")')
+    code_str, message = m.group(1), m.group(2).strip()
     return ExceptionStatement(
         type='exception',
-        code=code,
-        message=message_parts[1].strip()
+        code=int(code_str) if code_str != 'None' else None,
+        message=message if message not in ['', 'None'] else None
     )
 
 
+ARROW_ASSIGNMENT_PATTERN = re.compile(r'^(.+?)\s*<-\s*(.+)$')
+LET_ASSIGNMENT_PATTERN = re.compile(r'^let\s+(.+?)\s+(?:be|=)\s+(.+)$', re.IGNORECASE)
+
+
+def match_assignment(text: str) -> Optional[Tuple[str, str]]:
+    """
+    Split an assignment statement of the form "name <- value" or "let name be value"
+    into its name and value. Returns None for anything else.
+    """
+
+    text = text.strip()
+    m = ARROW_ASSIGNMENT_PATTERN.match(text) or LET_ASSIGNMENT_PATTERN.match(text)
+    if m is None:
+        return None
+    name, value = m.group(1).strip(), m.group(2).strip()
+    if len(name) >= 2 and name[0] == name[-1] and name[0] in ['"', "'"]:
+        name = name[1:-1].strip()
+    if name == '' or value == '' or '<-' in name:
+        return None
+    return name, value
+
+
 def parse_assignment(text: str, context: Context, schema_text: str) -> AssignmentStatement:
+    local = parse_locally('assignment', 'parse_assignment', text, match_assignment)
+    if local is not None:
+        name, value = local
+    else:
+        name, value = complete_assignment(text)
+    value_type = determine_python_or_sql_statement(value)
+    if value_type == 'sql':
+        sentence = strip_sql_prefix(value)
+        sql = None
+        if _parser_modes['sql'] == 'auto':
+            # a cached translation is used first: the templates are induced from the whole cache,
+            # which is only read (once per process) for sentences that haven't been translated yet
+            sql = cached_sql(sentence, schema_text)
+            if sql is not None:
+                get_stats().record_path('english2sql', sentence, 'llm')
+        if sql is None:
+            # sentences shaped like ones translated before are translated with their template
+            sql = parse_locally('sql', 'english2sql', sentence, lambda sentence: match_sql_template(sentence, schema_text))
+        if sql is None:
+            sql = english2sql(sentence, schema_text=schema_text)
+        value_stat = SQLStatement(
+            type='sql',
+            original=value,
+            sql=sql
+        )
+    elif value_type == 'python':
+        value_stat = parse_python_statement(text, context)
+    else:
+        raise ValueError('Internal Error')
+    return AssignmentStatement(
+        type='assignment',
+        name=name,
+        value=value_stat
+    )
+
+
+def complete_assignment(text: str) -> Tuple[str, str]:
 
     prompt = \
 f"""Each of the following statements represent assignment statements. For each, parse out the name of the variable from the value statement as a json.
@@ -286,26 +577,20 @@ Parsed: {{"name": "user", "value": "get a user with name equal to \"Jake\""}}
 Description: {text.strip()}
 Parsed:"""
 
-    result = cached_complete(prompt, engine='curie')
-    parsed = json.loads(result)
-    name = parsed['name']
-    value = parsed['value']
-    value_type = determine_python_or_sql_statement(text)
-    if value_type == 'sql':
-        value_stat = SQLStatement(
-            type='sql',
-            original=value,
-            sql=english2sql(text, schema_text=schema_text)
-        )
-    elif value_type == 'python':
-        value_stat = parse_python_statement(text, context)
-    else:
-        raise ValueError('Internal Error')
-    return AssignmentStatement(
-        type='assignment',
-        name=name,
-        value=value_stat
-    )
+    result = few_shot_complete(prompt, stage='parse_assignment', validate=lambda r: read_assignment_answer(r) is not None)
+    parsed = read_assignment_answer(result)
+    if parsed is None:
+        raise ValueError(f'Failed to parse assignment statement: {text.strip()} (got "{result.strip()}")')
+    return parsed
+
+
+def read_assignment_answer(result: str) -> Optional[Tuple[str, str]]:
+    """ The name and value of a completed assignment, {"name": ..., "value": ...}, or None if it is malformed. """
+    try:
+        parsed = json.loads(result)
+        return str(parsed['name']), str(parsed['value'])
+    except (ValueError, KeyError, TypeError):
+        return None
 
 
 def determine_python_or_sql_statement(text: str) -> Literal['python', 'sql']:
@@ -314,6 +599,16 @@ def determine_python_or_sql_statement(text: str) -> Literal['python', 'sql']:
     return 'python'
 
 
+def strip_sql_prefix(value: str) -> str:
+    """ The English of a SQL value: "sql: get a user" -> "get a user". """
+    value = value.strip()
+    if value.lower().startswith('sql'):
+        value = value[3:].lstrip()
+        if value.startswith(':'):
+            value = value[1:]
+    return value.strip()
+
+
 def parse_python_statement(text: str, context: Context) -> PythonStatement:
 
     context_string = ''
@@ -349,7 +644,7 @@ The next few examples will use the following variables:
 Statement: {text.strip()}
 Python:"""
 
-    result = cached_complete(prompt, engine='davinci').strip()
+    result = cascade_complete(prompt, stage='parse_python_statement', validate=lambda r: is_python(r) or is_python(r, 'exec')).strip()
     return PythonStatement(
         type='python',
         original=text,
@@ -403,7 +698,7 @@ The next few examples will use the following variables:
 Statement: {text}
 Python:"""
 
-    result = cached_complete(prompt, engine='davinci').strip()
+    result = cascade_complete(prompt, stage='parse_python_conditional_statement', validate=is_python).strip()
     return PythonConditionalStatement(
         type='python-conditional',
         original=text,
@@ -411,7 +706,22 @@ Python:"""
     )
 
 
+OUTPUT_PATTERN = re.compile(r'^(?:return|output)\s+(.+)$', re.IGNORECASE)
+
+
+def match_output(text: str) -> Optional[str]:
+    """ The value of an output statement of the form "return <value>" or "output <value>". """
+    m = OUTPUT_PATTERN.match(text.strip())
+    return m.group(1).strip() if m is not None else None
+
+
 def parse_output(text: str) -> OutputStatement:
+    local = parse_locally('output', 'parse_output', text, match_output)
+    if local is not None:
+        return OutputStatement(
+            type='output',
+            value=cast(str, local)
+        )
 
     prompt = \
 f"""For the following statements, parse out what should be returned.
@@ -425,7 +735,7 @@ Output: {{user}}
 Statement: {text.strip()}
 Output:"""
 
-    result = cached_complete(prompt, engine='curie')
+    result = few_shot_complete(prompt, stage='parse_output', validate=lambda r: r.strip() != '')
     stat = OutputStatement(
         type='output',
         value=result.strip()
@@ -433,112 +743,146 @@ Output:"""
     return stat
 
 
-def _parse_code_block(lines: List[str], context: Context, schema_text: str, global_line_offset: int, local_line_index: int, should_indent: bool) -> Tuple[CodeBlock, Context, int]:
-    assert local_line_index < len(lines)
-    original_indent = count_leading_spaces(lines[local_line_index])
-    prev_line = lines[local_line_index - 1]
-    prev_indent = count_leading_spaces(prev_line)
-    if should_indent and prev_indent >= original_indent:
-        raise ValueError(f'Expected indented block on line {global_line_offset + local_line_index}.')
+class LineNode(TypedDict):
+    index: int
+    text: str
+    children: List['LineNode']
 
-    block: CodeBlock = []
-    while local_line_index < len(lines):
-        current_indent = count_leading_spaces(lines[local_line_index])
-        if current_indent < original_indent:
-            break
-        line_type = determine_code_block_type(lines[local_line_index])
-        if line_type == 'if':
-            condition = lines[local_line_index][2:].strip()
-            condition_stat = parse_python_conditional_statement(condition, context)
-            if local_line_index == len(lines) - 1:
-                raise ValueError('Expected indented code block after "if" statement.')
-            case_true_block, context, local_line_index = _parse_code_block(
-                lines=lines,
-                context=context,
-                schema_text=schema_text,
-                global_line_offset=global_line_offset,
-                local_line_index=local_line_index + 1,
-                should_indent=True
-            )
-            # check if we reached the end
-            if local_line_index >= len(lines):
-                stat = IfStatement(
-                    type='if',
-                    condition=condition_stat,
-                    case_true=case_true_block,
-                    case_false=None
-                )
-                block.append(stat)
-            else:
-                # at this point, we have climbed out of any children of the if statement true case
-                indent = count_leading_spaces(lines[local_line_index])
-                if original_indent != indent:
-                    raise ValueError(f'Expected indent of else block on line {global_line_offset + local_line_index} to match original indent.')
-                next_statement_type, next_condition = determine_else_or_elif(lines[local_line_index])
-                if next_statement_type == 'else':
-                    if local_line_index == len(lines) - 1:
-                        raise ValueError('Expected indented block after "else" statement.')
-                    case_false_block, context, local_line_index = _parse_code_block(
-                        lines=lines,
-                        context=context,
-                        schema_text=schema_text,
-                        global_line_offset=global_line_offset,
-                        local_line_index=local_line_index + 1,
-                        should_indent=True
-                    )
-                    stat = IfStatement(
-                        type='if',
-                        condition=condition_stat,
-                        case_true=case_true_block,
-                        case_false=case_false_block
-                    )
-                    block.append(stat)
-                elif next_statement_type == 'elif':
-                    # TODO: implement else-if chains (leaving it out for now to reduce complexity)
-                    print(lines[local_line_index])
-                    raise ValueError('else-if chains are not implemented yet!')
-                else:
-                    stat = IfStatement(
-                        type='if',
-                        condition=condition_stat,
-                        case_true=case_true_block,
-                        case_false=None
-                    )
-                    block.append(stat)
-                    local_line_index -= 1
-
-        elif line_type == 'exception':
-            exception_stat = parse_exception(lines[local_line_index])
-            block.append(exception_stat)
-
-        elif line_type == 'assignment':
-            assignment_stat = parse_assignment(lines[local_line_index], context=context, schema_text=schema_text)
-            block.append(assignment_stat)
-
-        elif line_type == 'output':
-            output_stat = parse_output(lines[local_line_index])
-            block.append(output_stat)
-
-        elif line_type == 'something-else':
-            print(lines[local_line_index])
-            raise ValueError('TODO')
+class ParsedLine(TypedDict):
+    kind: Literal['if', 'else', 'elif', 'statement']
+    condition: Optional[PythonConditionalStatement]
+    statement: Optional[Statement]
 
+
+def build_line_tree(lines: List[str], global_line_offset: int) -> List[LineNode]:
+    """
+    Group the lines of a code block by indentation: the children of a line are the lines indented under it.
+    This decides the whole structure of the block without looking at what the lines say.
+    """
+
+    root: List[LineNode] = []
+    levels: List[Tuple[int, List[LineNode]]] = [(count_leading_spaces(lines[0]), root)]
+    for idx, line in enumerate(lines):
+        indent = count_leading_spaces(line)
+        if indent > levels[-1][0]:
+            levels.append((indent, levels[-1][1][-1]['children']))
         else:
-            raise ValueError(f'Invalid statement on line {global_line_offset + local_line_index}')
-    
-        local_line_index += 1
+            while indent < levels[-1][0]:
+                levels.pop()
+                if len(levels) == 0:
+                    raise ValueError(f'Unexpected unindent on line {global_line_offset + idx}.')
+            if indent != levels[-1][0]:
+                raise ValueError(f'Indent on line {global_line_offset + idx} does not match any enclosing block.')
+        levels[-1][1].append(LineNode(index=idx, text=line, children=[]))
+    return root
+
+
+def is_if_line(text: str) -> bool:
+    return text.strip().startswith('if')
+
+
+def parse_line(node: LineNode, follows_if: bool, context: Context, schema_text: str, global_line_offset: int) -> ParsedLine:
+    """ Parse a single line of a code block, independently of the others. """
+
+    text = node['text']
+    if is_if_line(text):
+        # the condition is everything after the "if" (this text is part of the cached prompts)
+        condition = parse_python_conditional_statement(text[2:].strip(), context)
+        return ParsedLine(kind='if', condition=condition, statement=None)
+    if follows_if:
+        else_type, else_condition = determine_else_or_elif(text)
+        if else_type == 'else':
+            return ParsedLine(kind='else', condition=None, statement=None)
+        elif else_type == 'elif':
+            return ParsedLine(kind='elif', condition=None, statement=None)
+
+    statement: Statement
+    line_type = determine_code_block_type(text)
+    if line_type == 'exception':
+        statement = parse_exception(text)
+    elif line_type == 'assignment':
+        statement = parse_assignment(text, context=context, schema_text=schema_text)
+    elif line_type == 'output':
+        statement = parse_output(text)
+    else:
+        raise ValueError(f'Could not determine the kind of statement on line {global_line_offset + node["index"]}: {text.strip()}')
+    return ParsedLine(kind='statement', condition=None, statement=statement)
 
-    return block, context, local_line_index
+
+def _assemble_code_block(nodes: List[LineNode], parsed: Dict[int, 'Future[ParsedLine]'], global_line_offset: int) -> CodeBlock:
+    block: CodeBlock = []
+    idx = 0
+    while idx < len(nodes):
+        node = nodes[idx]
+        # results are collected in line order, so the error reported is the first one in the block
+        line = parsed[node['index']].result()
+        if line['kind'] == 'if':
+            if len(node['children']) == 0:
+                raise ValueError(f'Expected indented code block after "if" statement on line {global_line_offset + node["index"]}.')
+            case_true = _assemble_code_block(node['children'], parsed, global_line_offset)
+            case_false = None
+            if idx + 1 < len(nodes):
+                next_node = nodes[idx + 1]
+                next_line = parsed[next_node['index']].result()
+                if next_line['kind'] == 'else':
+                    if len(next_node['children']) == 0:
+                        raise ValueError(f'Expected indented block after "else" statement on line {global_line_offset + next_node["index"]}.')
+                    case_false = _assemble_code_block(next_node['children'], parsed, global_line_offset)
+                    idx += 1
+                elif next_line['kind'] == 'elif':
+                    raise ValueError(f'else-if chains are not supported (line {global_line_offset + next_node["index"]}).')
+            block.append(IfStatement(
+                type='if',
+                condition=cast(PythonConditionalStatement, line['condition']),
+                case_true=case_true,
+                case_false=case_false
+            ))
+        else:
+            block.append(cast(Statement, line['statement']))
+            # lines indented under a plain statement belong to the same block
+            block.extend(_assemble_code_block(node['children'], parsed, global_line_offset))
+        idx += 1
+    return block
 
 
 def parse_code_block(lines: List[str], context: Context, schema_text: str, global_line_offset: int) -> CodeBlock:
-    assert len(lines) > 0
-    block, context, local_line_index = _parse_code_block(
-        lines=lines,
-        context=context,
-        schema_text=schema_text,
-        global_line_offset=global_line_offset,
-        local_line_index=0,
-        should_indent=False
-    )
-    return block
+    """
+    Parse a code block in two phases: first build its structure from the indentation alone,
+    then parse its lines (on `statement_workers` threads when there are more than one, so that the
+    completion requests of the whole block are in flight together) and assemble the CodeBlock.
+    """
+
+    if len(lines) == 0:
+        raise ValueError('Expected at least one line in the code block.')
+
+    tree = build_line_tree(lines, global_line_offset)
+    jobs: List[Tuple[LineNode, bool]] = []
+
+    def collect(nodes: List[LineNode]) -> None:
+        for idx, node in enumerate(nodes):
+            follows_if = idx > 0 and is_if_line(nodes[idx - 1]['text'])
+            jobs.append((node, follows_if))
+            collect(node['children'])
+
+    collect(tree)
+    if _statement_workers == 1:
+        # parsed in order on this thread, stopping at the first error
+        done: Dict[int, 'Future[ParsedLine]'] = {}
+        for node, follows_if in jobs:
+            future: 'Future[ParsedLine]' = Future()
+            future.set_result(parse_line(node, follows_if, context, schema_text, global_line_offset))
+            done[node['index']] = future
+        return _assemble_code_block(tree, done, global_line_offset)
+
+    executor = ThreadPoolExecutor(max_workers=_statement_workers)
+    try:
+        parsed = {
+            # each line runs in a copy of the caller's context (to keep its endpoint_scope)
+            node['index']: executor.submit(contextvars.copy_context().run, parse_line, node, follows_if, context, schema_text, global_line_offset)
+            for node, follows_if in jobs
+        }
+        return _assemble_code_block(tree, parsed, global_line_offset)
+    finally:
+        # after an error, the lines that haven't started yet are not worth parsing
+        executor.shutdown(wait=True, cancel_futures=True)
+
@@ -1,6 +1,8 @@
-from typing import Literal, Tuple, List, TypedDict, Union, Dict, Any, cast
+from typing import Literal, Optional, Tuple, List, TypedDict, Union, Dict, Any, cast
+import re
 
-from plainapi.gpt3 import cached_complete
+from plainapi.examples import few_shot_complete
+from plainapi.stats import get_stats
 from plainapi.parse_code import CodeBlock, Context, Variable, parse_code_block
 
 
@@ -30,24 +32,103 @@ class Endpoint(TypedDict):
     implementation: CodeBlock
 
 
-def parse_header(header_string: str) -> Header:
+HEADER_PATTERN = re.compile(r'^(GET|POST|PATCH|DELETE)\s+(?:at\s+)?(?:url\s+)?(/\S*)$', re.IGNORECASE)
+REQUIREMENTS_PATTERN = re.compile(r'^(?:requires|takes)\s+(.+?)(?:\s*[,.;]\s*returns\s+(.+))?$', re.IGNORECASE)
+RETURNS_ONLY_PATTERN = re.compile(r'^returns\s+(.+)$', re.IGNORECASE)
+PARAMETER_PATTERN = re.compile(r'^(?:an?\s+)?([A-Za-z_][A-Za-z0-9_]*)(?:\s*\((\w+)\))?$')
+TYPE_WORDS = {
+    'string': 'str',
+    'str': 'str',
+    'text': 'str',
+    'integer': 'int',
+    'int': 'int',
+    'number': 'int',
+    'boolean': 'bool',
+    'bool': 'bool',
+    'true/false': 'bool',
+}
+AUTH_WORDS = ['auth', 'authentication']
+NOTHING_WORDS = ['nothing', 'none']
 
-    if '\n' in header_string:
-        raise ValueError('Expected header string to be one line.')
 
-    prompt = \
-f"""For each of the following sentences describing HTTP endpoints, determine the method and url. Valid methods are GET, POST, PATCH, and DELETE.
+def strip_comment(line: str) -> str:
+    if '#' in line:
+        line = line[:line.index('#')]
+    return line.strip()
 
-description: GET at url /users/with-email/{{email}}
-method, url: GET /users/with-email/{{email}}
 
-description: post at url /users/signup
-method and url: POST /users/signup
+def match_header(header_string: str) -> Optional[str]:
+    """
+    Parse the canonical header form locally, e.g. "GET at url /users/{id}" or "post /users".
+    Returns "METHOD url" (the answer the model would give) or None for free-form headers.
+    """
 
-description: {header_string.strip()}
-method and url:"""
+    m = HEADER_PATTERN.match(strip_comment(header_string))
+    if m is None:
+        return None
+    return m.group(1).upper() + ' ' + m.group(2)
+
+
+def split_list(text: str) -> list[str]:
+    text = re.sub(r'\s+and\s+', ',', text.strip())
+    return [s.strip() for s in text.split(',') if s.strip() != '']
+
+
+def match_requirements(requirements_string: str) -> Optional[str]:
+    """
+    Parse the canonical requirements forms locally, e.g. "* requires auth *", "* requires nothing *",
+    "* requires email, password (string) *" or "requires id (integer), returns string".
+    Parameters without a type are strings. Returns the function stub the model would give
+    (e.g. "(auth: Any, id: int) -> (str)") or None for free-form requirements.
+    """
+
+    text = strip_comment(requirements_string).strip('*').strip()
+    m = REQUIREMENTS_PATTERN.match(text)
+    if m is not None:
+        inputs_text, outputs_text = m.group(1), m.group(2)
+    else:
+        m = RETURNS_ONLY_PATTERN.match(text)
+        if m is None:
+            return None
+        inputs_text, outputs_text = None, m.group(1)
+
+    if inputs_text is not None and inputs_text.strip().lower() in NOTHING_WORDS:
+        inputs_text = None
+    inputs = []
+    for parameter in split_list(inputs_text or ''):
+        if parameter.lower() in AUTH_WORDS:
+            inputs.append('auth: Any')
+            continue
+        pm = PARAMETER_PATTERN.match(parameter)
+        if pm is None:
+            return None
+        name, type_word = pm.group(1), pm.group(2)
+        if type_word is not None and type_word.lower() not in TYPE_WORDS:
+            return None
+        inputs.append(name + ': ' + (TYPE_WORDS[type_word.lower()] if type_word else 'str'))
+
+    outputs = []
+    if outputs_text is not None and outputs_text.strip().lower() not in NOTHING_WORDS:
+        for output in split_list(outputs_text):
+            output = re.sub(r'^an?\s+', '', output.strip().lower())
+            if output not in TYPE_WORDS:
+                return None
+            outputs.append(TYPE_WORDS[output])
+
+    return '(' + ', '.join(inputs) + ') -> (' + ', '.join(outputs) + ')'
 
-    result = cached_complete(prompt, engine='davinci').strip()
+
+def parse_header(header_string: str) -> Header:
+
+    if '\n' in header_string:
+        raise ValueError('Expected header string to be one line.')
+
+    result = match_header(header_string)
+    if result is not None:
+        get_stats().record_path('parse_header', header_string, 'local')
+    else:
+        get_stats().record_path('parse_header', header_string, 'llm')
+        result = complete_header(header_string)
     method_url = [s.strip() for s in result.split(' ')]
     if len(method_url) != 2:
         raise ValueError(f'Internal Error: Unexpected number of arguments in header: {result}')
@@ -62,33 +143,46 @@ method and url:"""
         raise ValueError(f'Invalid method {method}')
 
 
-def parse_requirements(requirements_string: str) -> FunctionTypeDefinition:
+def valid_header(result: str) -> bool:
+    """ Whether a completed header is of the form "METHOD /url". """
+    method_url = result.strip().split(' ')
+    return len(method_url) == 2 and method_url[0].upper() in ['GET', 'POST', 'PATCH', 'DELETE']
 
-    if '\n' in requirements_string:
-        raise ValueError('Expected requirements string to be one line.')
+
+def complete_header(header_string: str) -> str:
 
     prompt = \
-f"""For each of the following sentences describing a programming function, determine the input parameters and output types, where types are valid Python types.
-Note: "auth" is a special variable of type "Any".
+f"""For each of the following sentences describing HTTP endpoints, determine the method and url. Valid methods are GET, POST, PATCH, and DELETE.
 
-description: * requires auth *
-function stub: (auth: Any) -> ()
+description: GET at url /users/with-email/{{email}}
+method, url: GET /users/with-email/{{email}}
 
-description: requires email, password. returns number and a string
-function stub: (email: str, password: str) -> (int, str)
+description: post at url /users/signup
+method and url: POST /users/signup
 
-description: * requires authentication and an id (string)
-function stub: (auth: Any, id: str) -> ()
+description: {header_string.strip()}
+method and url:"""
+
+    return few_shot_complete(prompt, stage='parse_header', validate=valid_header).strip()
 
-description: {requirements_string.strip()}
-function stub:"""
+
+def parse_requirements(requirements_string: str) -> FunctionTypeDefinition:
+
+    if '\n' in requirements_string:
+        raise ValueError('Expected requirements string to be one line.')
+
+    result = match_requirements(requirements_string)
+    if result is not None:
+        get_stats().record_path('parse_requirements', requirements_string, 'local')
+    else:
+        get_stats().record_path('parse_requirements', requirements_string, 'llm')
+        result = complete_requirements(requirements_string)
 
     inputs: list[FunctionInput] = []
     outputs: list[FunctionOutput] = []
 
-    result = cached_complete(prompt, engine='curie').strip()
     inputs_string, outputs_string = [s.strip() for s in result.split('->')]
-    input_strings = [s.strip() for s in inputs_string[1:-1].split(',')]
+    input_strings = [s.strip() for s in inputs_string[1:-1].split(',') if s.strip() != '']
     output_strings = [s.strip() for s in outputs_string[1:-1].split(',')]
     for input in input_strings:
         name, type = [s.strip() for s in input.split(':')]
@@ -113,6 +207,36 @@ function stub:"""
     )
 
 
+def valid_requirements(result: str) -> bool:
+    """ Whether a completed function stub is of the form "(name: type, ...) -> (type, ...)". """
+    m = re.match(r'^\((.*)\)\s*->\s*\((.*)\)$', result.strip())
+    if m is None:
+        return False
+    inputs = [s.strip() for s in m.group(1).split(',') if s.strip() != '']
+    return all(len(s.split(':')) == 2 for s in inputs)
+
+
+def complete_requirements(requirements_string: str) -> str:
+
+    prompt = \
+f"""For each of the following sentences describing a programming function, determine the input parameters and output types, where types are valid Python types.
+Note: "auth" is a special variable of type "Any".
+
+description: * requires auth *
+function stub: (auth: Any) -> ()
+
+description: requires email, password. returns number and a string
+function stub: (email: str, password: str) -> (int, str)
+
+description: * requires authentication and an id (string)
+function stub: (auth: Any, id: str) -> ()
+
+description: {requirements_string.strip()}
+function stub:"""
+
+    return few_shot_complete(prompt, stage='parse_requirements', validate=valid_requirements).strip()
+
+
 def parse_endpoint(endpoint_string: str, schema_text: str, global_line_offset: int) -> Endpoint:
     lines = endpoint_string.split('\n')
     if len(lines) < 3:
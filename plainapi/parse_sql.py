@@ -1,6 +1,7 @@
-from typing import Tuple, List, TypedDict, Union, Dict, Any, cast
+from typing import Tuple, List, TypedDict, Union, Dict, Any, Optional, cast
+import re
 
-from plainapi.gpt3 import cached_complete
+from plainapi.gpt3 import cascade_complete
 
 
 class Input(TypedDict):
@@ -13,9 +14,16 @@ class Column(TypedDict):
     type: str
 
 
+class ForeignKey(TypedDict):
+    column: str
+    table: str
+    foreign_column: str  # empty when it refers to the primary key
+
+
 class Table(TypedDict):
     name: str
     columns: list[Column]
+    foreign_keys: list[ForeignKey]
 
 
 def tokenize_sql(text):
@@ -76,10 +84,13 @@ def consume_token(tokens, idx):
 def schema_type2type_hint(schema_type_text: str):
     """
     Map an SQLite type (from a schema) to a Python type hint.
+    Other types than the ones below follow SQLite's type affinity rules.
 
     VARCHAR(200) -> str
     INTEGER -> int
     BOOLEAN -> bool
+    TIMESTAMP -> str
+    REAL -> float
 
     """
 
@@ -97,6 +108,17 @@ def schema_type2type_hint(schema_type_text: str):
         return 'int'
     elif low == 'boolean':
         return 'bool'
+    elif 'int' in low:
+        return 'int'
+    elif 'char' in low or 'clob' in low or 'text' in low:
+        return 'str'
+    elif 'blob' in low:
+        return 'bytes'
+    elif low.startswith('date') or low.startswith('time'):
+        # dates are stored as ISO-8601 strings
+        return 'str'
+    elif 'real' in low or 'floa' in low or 'doub' in low or low in ['numeric', 'decimal']:
+        return 'float'
     else:
         raise ValueError(f'Invalid type "{tok}"')
 
@@ -146,44 +168,207 @@ Columns: users.email
 SQL: {sql.strip()}
 Columns:"""
 
-    result = cached_complete(prompt, engine='curie').strip()
+    result = cascade_complete(prompt, stage='parse_outputs',
+                              validate=lambda r: all(re.match(r'^\w+\.(\w+|\*)$', s.strip()) for s in r.split(','))).strip()
     columns = [s.strip() for s in result.split(',')]
     return columns
 
 
+IDENTIFIER = r'["`\[]?(\w+)["`\]]?'
+CREATE_TABLE_PATTERN = re.compile(r'^CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?' + IDENTIFIER + r'\s*\((.*)\)$', re.IGNORECASE | re.DOTALL)
+REFERENCES_PATTERN = re.compile(r'REFERENCES\s+' + IDENTIFIER + r'\s*(?:\(\s*' + IDENTIFIER + r'\s*\))?', re.IGNORECASE)
+TABLE_FOREIGN_KEY_PATTERN = re.compile(r'^FOREIGN\s+KEY\s*\(\s*' + IDENTIFIER + r'\s*\)\s*' + REFERENCES_PATTERN.pattern, re.IGNORECASE)
+TABLE_CONSTRAINT_WORDS = ['PRIMARY', 'UNIQUE', 'CHECK', 'CONSTRAINT']
+COLUMN_CONSTRAINT_WORDS = ['PRIMARY', 'NOT', 'NULL', 'UNIQUE', 'DEFAULT', 'REFERENCES', 'CHECK', 'COLLATE', 'CONSTRAINT', 'GENERATED']
+
+
+def split_top_level(text: str) -> list[str]:
+    """ Split on the commas that are not inside parentheses (as in DECIMAL(10, 2)). """
+    parts = []
+    depth = 0
+    current = ''
+    for c in text:
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        if c == ',' and depth == 0:
+            parts.append(current)
+            current = ''
+        else:
+            current += c
+    parts.append(current)
+    return parts
+
+
+SQL_KEYWORDS = ['SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE']
+
+
+def valid_sql(sql: str) -> bool:
+    """ Whether a completion looks like a single SQL statement: it tokenizes and starts with a statement keyword. """
+    try:
+        tokens = list(tokenize_sql(sql))
+    except ValueError:
+        return False
+    return len(tokens) > 0 and tokens[0].upper() in SQL_KEYWORDS
+
+
+TABLE_REFERENCE_PATTERN = re.compile(r'\b(?:FROM|JOIN|INTO|UPDATE)\s+' + IDENTIFIER, re.IGNORECASE)
+
+
+def referenced_tables(sql: str) -> set[str]:
+    """ The (lowercased) names of the tables that a statement reads or writes. """
+    return {name.lower() for name in TABLE_REFERENCE_PATTERN.findall(sql)}
+
+
 def parse_schema(schema_text: str) -> list[Table]:
     """
     An SQL parser that takes a database schema and return all the parsed tables.
+    Statements other than CREATE TABLE, and SQLite's internal tables, are skipped.
     """
 
-    tables_text = [s.strip() for s in schema_text.strip().split(';')]
-    tables_text = [s for s in tables_text if len(s) > 0]
+    schema_text = '\n'.join(line for line in schema_text.split('\n') if not line.strip().startswith('--'))
     tables: list[Table] = []
-    for text in tables_text:
-        if 'IF NOT EXISTS' in text:
-            # TODO: handle this case
+    for statement in schema_text.split(';'):
+        m = CREATE_TABLE_PATTERN.match(statement.strip())
+        if m is None:
+            continue
+        table_name = m.group(1)
+        if table_name.startswith('sqlite_'):
             continue
-        table_name = text.split(' ')[2].strip()
-        table_fields_text = ' '.join(text.split(' ')[3:])[1:-1].split(',')
-        table_fields_text = [s.strip() for s in table_fields_text]
-        table_fields_text = [s for s in table_fields_text if len(s) > 0]
         columns: list[Column] = []
-        for text in table_fields_text:
-            if text.startswith('FOREIGN'):
+        foreign_keys: list[ForeignKey] = []
+        for text in split_top_level(m.group(2)):
+            text = text.strip()
+            if len(text) == 0:
+                continue
+            first = text.split()[0].upper()
+            if first == 'FOREIGN':
                 # this is a foreign key constraint
+                fk = TABLE_FOREIGN_KEY_PATTERN.match(text)
+                if fk is not None:
+                    foreign_keys.append({'column': fk.group(1), 'table': fk.group(2), 'foreign_column': fk.group(3) or ''})
                 continue
-            tokens = text.split(' ')
-            name = tokens[0]
-            type = tokens[1]
-            attributes = ' '.join(tokens[2:])
+            if first in TABLE_CONSTRAINT_WORDS:
+                continue
+            tokens = text.split()
+            name = tokens[0].strip('"`[]')
+            if len(tokens) > 1 and tokens[1].upper() not in COLUMN_CONSTRAINT_WORDS:
+                type = schema_type2type_hint(tokens[1])
+            else:
+                # SQLite allows columns without a type
+                type = 'Any'
             columns.append({
                 'name': name,
-                'type': schema_type2type_hint(type)
+                'type': type
             })
-        tables.append({'name': table_name, 'columns': columns})
+            ref = REFERENCES_PATTERN.search(text)
+            if ref is not None:
+                foreign_keys.append({'column': name, 'table': ref.group(1), 'foreign_column': ref.group(2) or ''})
+        tables.append({'name': table_name, 'columns': columns, 'foreign_keys': foreign_keys})
     return tables
 
 
+def singular(word: str) -> str:
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith('sses') or word.endswith('xes') or word.endswith('ches') or word.endswith('shes'):
+        return word[:-2]
+    if word.endswith('s') and not word.endswith('ss') and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def name_words(name: str) -> list[str]:
+    """ The (singular, lowercase) words of an identifier or a sentence: "blog_posts" -> ["blog", "post"] """
+    name = re.sub(r'([a-z])([A-Z])', r'\1_\2', name)
+    return [singular(word) for word in re.findall(r'[a-z0-9]+', name.lower())]
+
+
+def relevant_tables(tables: list[Table], sentence: str) -> Optional[Dict[str, Optional[set[str]]]]:
+    """
+    The tables (and, for tables that are only there for their keys, the columns) relevant to a sentence:
+    the tables it names, the tables these refer to by foreign keys, and the tables linking two named tables.
+    When it names no table, the tables with the (distinctive) columns it names.
+    Returns a map from table name to the columns to keep (None for all of them), or None if nothing matched.
+    """
+
+    words = set(name_words(sentence))
+
+    def mentioned(name: str) -> bool:
+        parts = name_words(name)
+        return len(parts) > 0 and all(part in words for part in parts)
+
+    selected = [table['name'] for table in tables if mentioned(table['name'])]
+    if len(selected) == 0:
+        column_counts: Dict[str, int] = {}
+        for table in tables:
+            for column in table['columns']:
+                column_counts[column['name']] = column_counts.get(column['name'], 0) + 1
+        distinctive = [name for name, count in column_counts.items() if count == 1 or count * 2 <= len(tables)]
+        selected = [table['name'] for table in tables
+                    if any(column['name'] in distinctive and mentioned(column['name']) for column in table['columns'])]
+    if len(selected) == 0:
+        return None
+
+    keep: Dict[str, Optional[set[str]]] = {name: None for name in selected}
+    for table in tables:
+        if table['name'] in selected:
+            for fk in table['foreign_keys']:
+                if fk['table'] not in keep:
+                    keep[fk['table']] = set()
+                columns = keep[fk['table']]
+                if columns is not None and fk['foreign_column'] != '':
+                    columns.add(fk['foreign_column'])
+        elif len({fk['table'] for fk in table['foreign_keys'] if fk['table'] in selected}) >= 2:
+            keep[table['name']] = None
+    for table in tables:
+        columns = keep.get(table['name'])
+        if columns is not None:
+            # a table included for its keys keeps its first column (usually the primary key), its own keys, and the columns named
+            if len(table['columns']) > 0:
+                columns.add(table['columns'][0]['name'])
+            columns.update(fk['column'] for fk in table['foreign_keys'])
+            columns.update(column['name'] for column in table['columns'] if mentioned(column['name']))
+    return keep
+
+
+def summarize_schema(schema_text: str, sentence: str) -> Optional[str]:
+    """
+    A compact version of the schema, with only the tables and columns relevant to the sentence, one line per table:
+
+    users(id int, email str, is_admin bool)
+    posts(id int, user_id int -> users.id, value str)
+
+    Returns None when the schema can't be parsed, or the sentence doesn't match any of it.
+    """
+
+    try:
+        tables = parse_schema(schema_text)
+    except ValueError:
+        return None
+    keep = relevant_tables(tables, sentence)
+    if keep is None:
+        return None
+    lines = []
+    for table in tables:
+        if table['name'] not in keep:
+            continue
+        columns = keep[table['name']]
+        references = {fk['column']: fk for fk in table['foreign_keys']}
+        fields = []
+        for column in table['columns']:
+            if columns is not None and column['name'] not in columns:
+                continue
+            field = f'{column["name"]} {column["type"]}'
+            if column['name'] in references:
+                fk = references[column['name']]
+                field += f' -> {fk["table"]}' + (f'.{fk["foreign_column"]}' if fk['foreign_column'] != '' else '')
+            fields.append(field)
+        lines.append(f'{table["name"]}({", ".join(fields)})')
+    return '\n'.join(lines)
+
+
 def parse_inputs(sql: str, schema_text: str) -> list[str]:
 
     qms = sql.count('?')
@@ -209,7 +394,8 @@ SQL: {sql}
 Q: {question}
 A:"""
 
-    result = cached_complete(prompt, engine='curie')
+    result = cascade_complete(prompt, stage='parse_inputs',
+                              validate=lambda r: all(re.match(r'^\w+$', s.strip()) for s in r.split(',')))
     types = [s.strip() for s in result.split(',')]
     return types
 
@@ -1,43 +1,146 @@
 from typing import Optional
 import os
-from dotenv import load_dotenv
+import sys
+import json
+import time
 import configparser
 import argparse
 
-from plainapi.utils import get_db_schema_text
+from plainapi.utils import get_db_schema_text, parse_duration
 from plainapi.generate_python import generate_app
-from plainapi.parse_application import parse_application
+from plainapi.generate_sql import configure_schema_pruning
+from plainapi.examples import FEW_SHOT_EXAMPLES, configure_examples
+from plainapi.templates import MIN_SUPPORT, configure_templates
+from plainapi.classifier import CONFIDENCE_THRESHOLD, configure_classifier
+from plainapi.parse_application import Application, parse_application
+from plainapi.parse_code import PARSER_KINDS, configure_parsers, configure_statement_workers
+from plainapi.gpt3 import CACHE_DIR, BATCH_SIZE, MAX_RETRIES, PACK_SIZE, STAGE_MAX_TOKENS, MEMO_MAX_BYTES, MEMO_MAX_ENTRIES, configure_answer_source, configure_batching, configure_cache, configure_packing, configure_memo, configure_provider, configure_scheduler, configure_stage, record_requests, use_provider
+from plainapi.providers import CompletionCacheMiss, ReplayProvider, answer_source, make_provider, source_cache_path
+from plainapi.stub_server import serve_stub
+from plainapi.cache import GCReport, gc_cache, import_directory, export_directory
+from plainapi.stats import reset_stats, stats_summary
+from plainapi.build import BUILD_DIR, BuildCache, compiler_fingerprint, write_if_changed
+from plainapi.ir import IR_FILENAME, dump_application, load_application
+from plainapi.plan import PLAN_COLUMNS, REPORT_COLUMNS, format_summary, plan_application
+from plainapi.watch import WATCH_DEBOUNCE, WATCH_INTERVAL, AppServer, file_states, wait_for_changes
+from plainapi.daemon import COMPILER_SOCKET, Message, request_compiler, run_captured, serve_compiler
+
+
+def print_gc_report(report: GCReport, dry_run: bool = False) -> None:
+    removed = report['removed_unreachable'] + report['removed_expired'] + report['removed_over_limit']
+    verb = 'Would remove' if dry_run else 'Removed'
+    print(f'{verb} {removed} of {report["entries_before"]} cache entries '
+          f'({report["removed_unreachable"]} unreachable, {report["removed_expired"]} expired, {report["removed_over_limit"]} over the size limit).')
+    print(f'Cache size: {report["bytes_before"]} -> {report["bytes_after"]} bytes, {report["entries_after"]} entries.')
 
 
 def main():
     parser = argparse.ArgumentParser(description='Generate web APIs with plain English.')
-    parser.add_argument('command', choices=['init', 'gen', 'start', 'restart'], help='Base command')
+    parser.add_argument('command', choices=['init', 'gen', 'parse', 'codegen', 'watch', 'serve-compiler', 'start', 'restart', 'cache', 'stub-server'], help='Base command')
+    parser.add_argument('action', nargs='?', help='Sub-command (for "cache": import, export or gc), or the IR file for "parse" and "codegen"')
+    parser.add_argument('path', nargs='?', help='Path argument of the sub-command')
+    parser.add_argument('--max-bytes', type=int, help='cache gc: maximum total size of the cache in bytes')
+    parser.add_argument('--max-entries', type=int, help='cache gc: maximum number of cache entries')
+    parser.add_argument('--ttl', type=parse_duration, help='cache gc: evict entries not used for this long (e.g. 3600, 12h, 30d)')
+    parser.add_argument('--reachable', action='store_true', help='cache gc: evict entries that the current sources no longer request')
+    parser.add_argument('--dry-run', action='store_true', help='cache gc: only report what would be evicted')
+    parser.add_argument('--jobs', '-j', type=int, help='gen: number of endpoints to compile concurrently')
+    parser.add_argument('--force', action='store_true', help='gen: recompile every endpoint instead of reusing unchanged ones')
+    parser.add_argument('--plan', action='store_true', help='gen: only predict the completion calls and prompt tokens of the build, per stage, engine and endpoint')
+    parser.add_argument('--stats', metavar='PATH', help='gen: also write the completion statistics (with the paths taken by each line) as JSON to this file')
     settings_filename = 'plain.ini'
     args = parser.parse_args()
 
-    if args.command == 'gen':
-
-        if not os.path.exists(settings_filename):
-            raise ValueError(f'Could not find settings file: {settings_filename}')
-
-        config = configparser.ConfigParser()
+    config = configparser.ConfigParser()
+    if os.path.exists(settings_filename):
         config.read(settings_filename)
 
-        def read_setting(name: str) -> Optional[str]:
-            settings = config['default']
-            if name in settings:
-                return settings[name]
+    def read_setting(name: str) -> Optional[str]:
+        if 'default' not in config:
             return None
+        settings = config['default']
+        if name in settings:
+            return settings[name]
+        return None
+
+    # with a compiler daemon running (plain serve-compiler), gen only asks it to build
+    compiler_socket = read_setting('compiler_socket') or COMPILER_SOCKET
+    if args.command == 'gen' and not args.plan:
+        response = request_compiler(compiler_socket, {
+            'command': 'gen',
+            'cwd': os.getcwd(),
+            'compiler': compiler_fingerprint(),
+            'force': args.force,
+            'jobs': args.jobs,
+            'stats': os.path.abspath(args.stats) if args.stats else None,
+        })
+        if response is not None:
+            if response.get('restart', False):
+                print('The compiler daemon is restarting (the settings or the compiler changed); compiling in-process.')
+            else:
+                sys.stdout.write(response['output'])
+                sys.exit(response['status'])
+
+    provider_name = read_setting('provider') or 'openai'
+    stub_latency = float(read_setting('stub_latency') or '0')
+    openai_api_base = read_setting('openai_api_base')
+    source = answer_source(provider_name, openai_api_base)
+    configure_answer_source(source)
+
+    cache_backend = read_setting('cache_backend') or 'directory'
+    default_cache_path = CACHE_DIR if cache_backend == 'directory' else CACHE_DIR + '.sqlite3'
+    cache_path = source_cache_path(read_setting('cache_path') or default_cache_path, source)
+    cache = configure_cache(cache_backend, cache_path)
+    memo_max_entries = int(read_setting('memo_max_entries') or MEMO_MAX_ENTRIES)
+    memo_max_bytes = int(read_setting('memo_max_bytes') or MEMO_MAX_BYTES)
+    configure_memo(max_entries=memo_max_entries, max_bytes=memo_max_bytes)
+    batch_size = int(read_setting('batch_size') or BATCH_SIZE)
+    batch_window = float(read_setting('batch_window') or '0')
+    configure_batching(max_size=batch_size, window=batch_window)
+    configure_packing(int(read_setting('pack_size') or PACK_SIZE))
+    for stage in STAGE_MAX_TOKENS:
+        stage_engines = read_setting(f'{stage}_engines') or read_setting('engines')
+        stage_max_tokens = read_setting(f'{stage}_max_tokens')
+        configure_stage(stage,
+                        engines=[e.strip() for e in stage_engines.split(',') if e.strip() != ''] if stage_engines else None,
+                        max_tokens=int(stage_max_tokens) if stage_max_tokens else None)
+    few_shot_stages = read_setting('few_shot_stages')
+    configure_examples(int(read_setting('few_shot_examples') or FEW_SHOT_EXAMPLES),
+                       stages=[s.strip() for s in few_shot_stages.split(',') if s.strip() != ''] if few_shot_stages else None)
+    requests_per_minute = read_setting('requests_per_minute')
+    tokens_per_minute = read_setting('tokens_per_minute')
+    configure_scheduler(requests_per_minute=float(requests_per_minute) if requests_per_minute else None,
+                        tokens_per_minute=float(tokens_per_minute) if tokens_per_minute else None,
+                        max_retries=int(read_setting('max_retries') or MAX_RETRIES))
 
-        endpoints_filename = read_setting('endpoints_filename') or 'endpoints.plain'
-        migrations_filename = read_setting('migrations_filename') or 'migrations.plain'
-        functions_filename = read_setting('functions_filename') or 'functions.plain'
-        target_filename = read_setting('target_filename') or 'app.py'
-        db_name = read_setting('db_name') or 'my-app.sqlite3'
-        host = read_setting('host') or 'localhost'
-        port = read_setting('port') or '3000'
-        port = int(port)
+    configure_parsers(**{kind: read_setting(f'{kind}_parser') or 'auto' for kind in PARSER_KINDS})
+    configure_templates(int(read_setting('template_support') or MIN_SUPPORT))
+    configure_classifier(float(read_setting('classifier_threshold') or CONFIDENCE_THRESHOLD))
+    configure_statement_workers(int(read_setting('statement_workers') or '1'))
+    configure_schema_pruning(config.getboolean('default', 'prune_schema', fallback=True))
 
+    if args.command in ['gen', 'parse', 'watch', 'serve-compiler']:
+        configure_provider(make_provider(provider_name, latency=stub_latency, api_base=openai_api_base))
+
+    endpoints_filename = read_setting('endpoints_filename') or 'endpoints.plain'
+    migrations_filename = read_setting('migrations_filename') or 'migrations.plain'
+    functions_filename = read_setting('functions_filename') or 'functions.plain'
+    target_filename = read_setting('target_filename') or 'app.py'
+    db_name = read_setting('db_name') or 'my-app.sqlite3'
+    host = read_setting('host') or 'localhost'
+    port = read_setting('port') or '3000'
+    port = int(port)
+    jobs = args.jobs or int(read_setting('jobs') or '1')
+    build_dir = read_setting('build_dir') or BUILD_DIR
+    ir_filename = read_setting('ir_filename') or IR_FILENAME
+    if jobs < 1:
+        raise ValueError(f'Expected a positive number of jobs, got {jobs}')
+    # the compiled endpoints, kept in memory between the builds of watch and serve-compiler
+    build_memory: dict[str, str] = {}
+
+    def read_sources() -> tuple[str, str, str]:
+        if not os.path.exists(settings_filename):
+            raise ValueError(f'Could not find settings file: {settings_filename}')
         if not os.path.exists(endpoints_filename):
             raise ValueError(f'Could not find endpoints file: {endpoints_filename}')
         if not os.path.exists(migrations_filename):
@@ -51,20 +154,210 @@ def main():
             migrations_code = f.read()
         with open(functions_filename, 'r') as f:
             functions_code = f.read()
-        
+        return endpoints_code, migrations_code, functions_code
+
+    def build_application(force: bool = False, jobs: int = jobs) -> tuple[Application, str, Optional[BuildCache], set[tuple[str, str]]]:
+        """ Parse the sources, reusing the unchanged endpoints from the build directory unless forced. """
+        endpoints_code, migrations_code, functions_code = read_sources()
         schema_text = get_db_schema_text(db_name)
-        application = parse_application(endpoints_code=endpoints_code,
-                                        functions_code=functions_code,
-                                        schema_text=schema_text)
+        build_cache = None if force else BuildCache(build_dir, memory=build_memory)
+        with record_requests() as requested:
+            application = parse_application(endpoints_code=endpoints_code,
+                                            functions_code=functions_code,
+                                            schema_text=schema_text,
+                                            jobs=jobs,
+                                            build_cache=build_cache)
+        if build_cache is not None:
+            print(f'Compiled {build_cache.compiled} endpoints, reused {build_cache.reused} unchanged ones.')
+        return application, schema_text, build_cache, requested
 
+    def write_app(application: Application, schema_text: str) -> bool:
         code = generate_app(application=application,
                             schema_text=schema_text,
                             db_name=db_name,
                             host=host,
                             port=port)
-        
-        with open(target_filename, 'w') as f:
-            f.write(code)
+        written = write_if_changed(target_filename, code)
+        if not written:
+            print(f'{target_filename} is up to date.')
+        return written
+
+    def build(command: str, force: bool, stats_path: Optional[str], jobs: int = jobs) -> None:
+        """ gen or parse: compile the sources, write the app (or the IR), apply the cache policy and report the stats. """
+
+        reset_stats()
+        application, schema_text, build_cache, requested = build_application(force=force, jobs=jobs)
+
+        if command == 'parse':
+            dump_application(application, schema_text, args.action or ir_filename)
+        else:
+            write_app(application, schema_text)
+
+        # automatic cache policy
+        cache_max_bytes = read_setting('cache_max_bytes')
+        cache_max_entries = read_setting('cache_max_entries')
+        cache_ttl = read_setting('cache_ttl')
+        cache_gc_reachable = config.getboolean('default', 'cache_gc_reachable', fallback=False)
+        if cache_gc_reachable and build_cache is not None and build_cache.reused > 0:
+            # reused endpoints made no requests, so this run doesn't know all the reachable prompts
+            print('Skipping reachable cache eviction because some endpoints were reused from the build directory.')
+            cache_gc_reachable = False
+        if cache_max_bytes or cache_max_entries or cache_ttl or cache_gc_reachable:
+            report = gc_cache(cache,
+                              max_bytes=int(cache_max_bytes) if cache_max_bytes else None,
+                              max_entries=int(cache_max_entries) if cache_max_entries else None,
+                              ttl=parse_duration(cache_ttl) if cache_ttl else None,
+                              # this run compiled every source, so the requested prompts are exactly the reachable ones
+                              reachable=requested if cache_gc_reachable else None)
+            print_gc_report(report)
+
+        summary = stats_summary()
+        if stats_path:
+            with open(stats_path, 'w') as f:
+                f.write(json.dumps(summary, indent=2) + '\n')
+        print(format_summary(summary, REPORT_COLUMNS))
+
+    if args.command == 'gen' and args.plan:
+
+        endpoints_code, migrations_code, functions_code = read_sources()
+        schema_text = get_db_schema_text(db_name)
+        plan = plan_application(endpoints_code, schema_text, build_cache=None if args.force else BuildCache(build_dir))
+        print(format_summary(plan, PLAN_COLUMNS))
+        if len(plan['reused']) > 0:
+            print(f'\nUnchanged (would be reused): {", ".join(plan["reused"])}')
+        for label, error in plan['errors'].items():
+            print(f'\nCould not plan past an error in {label}: {error}')
+        if args.stats:
+            with open(args.stats, 'w') as f:
+                f.write(json.dumps(plan, indent=2) + '\n')
+
+    elif args.command in ['gen', 'parse']:
+
+        build(args.command, force=args.force, stats_path=args.stats)
+
+    elif args.command == 'codegen':
+
+        # code generation from a stored IR, without the completion layer
+        source = args.action or ir_filename
+        if not os.path.exists(source):
+            raise ValueError(f'Could not find IR file: {source} (run "plain parse" first)')
+        application, schema_text = load_application(source)
+        write_app(application, schema_text)
+
+    elif args.command == 'watch':
+
+        # recompile (incrementally) and restart the app whenever a source changes
+        watched = [endpoints_filename, functions_filename, migrations_filename, settings_filename]
+        watch_interval = float(read_setting('watch_interval') or WATCH_INTERVAL)
+        watch_debounce = float(read_setting('watch_debounce') or WATCH_DEBOUNCE)
+        server = AppServer(target_filename, host=host, port=port)
+        states = file_states(watched)
+        try:
+            try:
+                application, schema_text, _, _ = build_application(force=args.force)
+                write_app(application, schema_text)
+            except Exception as e:
+                # e.g. a parse error, a failed completion request, or the sqlite3 CLI failing: keep watching
+                print(f'Build failed: {type(e).__name__}: {e}')
+            if os.path.exists(target_filename):
+                server.start()
+                if server.wait_until_ready():
+                    print(f'Serving {target_filename} at http://{host}:{port}, watching {", ".join(watched)}')
+            while True:
+                states, changed, edited_at = wait_for_changes(states, interval=watch_interval, debounce=watch_debounce)
+                print(f'Changed: {", ".join(changed)}')
+                if settings_filename in changed:
+                    # settings are read once at startup, so start over
+                    server.stop()
+                    os.execv(sys.executable, [sys.executable, '-m', 'plainapi.plainapi'] + sys.argv[1:])
+                build_started = time.time()
+                try:
+                    application, schema_text, _, _ = build_application()
+                    written = write_app(application, schema_text)
+                except Exception as e:
+                    print(f'Build failed: {type(e).__name__}: {e}')
+                    continue
+                if not written and server.running():
+                    continue
+                restart_started = time.time()
+                server.restart()
+                if not server.wait_until_ready():
+                    print(f'The app at {target_filename} failed to start; waiting for changes.')
+                    continue
+                served = time.time()
+                print(f'Served {served - edited_at:.2f}s after the edit '
+                      f'(build {restart_started - build_started:.2f}s, restart {served - restart_started:.2f}s).')
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+
+    elif args.command == 'serve-compiler':
+
+        # keep the caches, the schema and the compiled endpoints in memory between the builds of "plain gen"
+        settings_state = file_states([settings_filename])
+        compiler = compiler_fingerprint()
+
+        def handle(request: Message) -> Message:
+            if request.get('command') == 'ping':
+                return {'status': 0, 'output': ''}
+            if request.get('command') != 'gen':
+                return {'status': 1, 'output': f'Unknown compiler request: {request.get("command")}\n'}
+            if request.get('cwd') != os.getcwd():
+                return {'status': 1, 'output': f'The compiler daemon on {compiler_socket} builds {os.getcwd()}, not {request.get("cwd")}\n'}
+            if file_states([settings_filename]) != settings_state or request.get('compiler') != compiler:
+                # settings are read once at startup (and the compiler is loaded once), so start over
+                return {'restart': True}
+            request_jobs = request.get('jobs') or jobs
+            return run_captured(lambda: build('gen', force=request.get('force', False), stats_path=request.get('stats'), jobs=request_jobs))
+
+        print(f'Compiler daemon listening on {compiler_socket}; "plain gen" in {os.getcwd()} now builds here.')
+        if serve_compiler(compiler_socket, handle):
+            os.execv(sys.executable, [sys.executable, '-m', 'plainapi.plainapi'] + sys.argv[1:])
+
+    elif args.command == 'cache':
+
+        if args.action == 'import':
+            source_dir = args.path or CACHE_DIR
+            if os.path.abspath(source_dir) == os.path.abspath(cache_path):
+                raise ValueError('Cannot import a cache directory into itself.')
+            count = import_directory(cache, source_dir)
+            print(f'Imported {count} entries from {source_dir} into {cache_path}.')
+        elif args.action == 'export':
+            if args.path is None:
+                raise ValueError('Expected a target directory: plain cache export <directory>')
+            if os.path.abspath(args.path) == os.path.abspath(cache_path):
+                raise ValueError('Cannot export a cache into itself.')
+            count = export_directory(cache, args.path)
+            print(f'Exported {count} entries from {cache_path} into {args.path}.')
+        elif args.action == 'gc':
+            reachable = None
+            if args.reachable:
+                # re-walk the current sources, answering only from the cache
+                endpoints_code, migrations_code, functions_code = read_sources()
+                schema_text = get_db_schema_text(db_name)
+                try:
+                    with use_provider(ReplayProvider()), record_requests() as reachable:
+                        parse_application(endpoints_code=endpoints_code,
+                                          functions_code=functions_code,
+                                          schema_text=schema_text)
+                except CompletionCacheMiss:
+                    raise ValueError('The cache does not cover the current sources (run "plain gen" first), '
+                                     'so reachable entries cannot be determined.')
+            report = gc_cache(cache,
+                              max_bytes=args.max_bytes,
+                              max_entries=args.max_entries,
+                              ttl=args.ttl,
+                              reachable=reachable,
+                              dry_run=args.dry_run)
+            print_gc_report(report, dry_run=args.dry_run)
+        else:
+            raise ValueError(f'Invalid cache action \'{args.action}\' (expected import, export or gc)')
+
+    elif args.command == 'stub-server':
+        stub_host = read_setting('stub_host') or 'localhost'
+        stub_port = int(read_setting('stub_port') or '8700')
+        serve_stub(host=stub_host, port=stub_port, latency=stub_latency)
 
     else:
         raise ValueError(f'Command \'{args.command}\' is not implemented yet!')
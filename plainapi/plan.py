@@ -0,0 +1,104 @@
+from typing import Any, Dict, List, Optional, Tuple
+import io
+import contextlib
+
+from plainapi.gpt3 import dry_run
+from plainapi.stats import endpoint_scope, reset_stats, stats_summary
+from plainapi.build import BuildCache, block_fingerprint
+from plainapi.parse_code import parser_options
+from plainapi.parse_endpoint import parse_endpoint
+from plainapi.parse_application import endpoint_label, split_endpoints
+
+
+PLAN_COLUMNS: List[Tuple[str, str]] = [
+    ('calls', 'calls'),
+    ('cached', 'cached'),
+    ('misses', 'to send'),
+    ('prompt_tokens', 'prompt tok'),
+    ('remote_prompt_tokens', 'tok to send'),
+]
+
+REPORT_COLUMNS: List[Tuple[str, str]] = [
+    ('calls', 'calls'),
+    ('cached', 'cached'),
+    ('misses', 'sent'),
+    ('prompt_tokens', 'prompt tok'),
+    ('remote_prompt_tokens', 'sent tok'),
+    ('completion_tokens', 'compl tok'),
+    ('wait_seconds', 'wait s'),
+    ('remote_seconds', 'remote s'),
+]
+
+CASCADE_COLUMNS: List[Tuple[str, str]] = [
+    ('calls', 'calls'),
+    ('escalated', 'escalated'),
+    ('failed', 'failed'),
+    ('escalation_rate', 'rate'),
+]
+
+
+def plan_application(endpoints_code: str, schema_text: str, build_cache: Optional[BuildCache] = None) -> Dict[str, Any]:
+    """
+    Predict the completions that building the endpoints would request, without requesting any:
+    the endpoints are parsed against the cache, answering misses with placeholders (see `dry_run`).
+    Since the parse goes on from a placeholder, what follows a miss is an estimate.
+    Endpoints that the build cache would reuse request nothing.
+
+    Returns the stats of the walk, with the endpoints that would be reused and those that failed to parse.
+    """
+
+    title, endpoint_blocks = split_endpoints(endpoints_code)
+    reused: List[str] = []
+    errors: Dict[str, str] = {}
+    reset_stats()
+    # the completion layer prints every answer it receives, placeholders included
+    with dry_run(), contextlib.redirect_stdout(io.StringIO()):
+        for block in endpoint_blocks:
+            label = endpoint_label(block)
+            if build_cache is not None and build_cache.load(block_fingerprint(block, schema_text, parser_options())) is not None:
+                reused.append(label)
+                continue
+            with endpoint_scope(label):
+                try:
+                    parse_endpoint(endpoint_string=block, schema_text=schema_text, global_line_offset=1)
+                except ValueError as e:
+                    errors[label] = str(e)
+    summary = stats_summary()
+    summary['reused'] = reused
+    summary['errors'] = errors
+    return summary
+
+
+def format_table(title: str, rows: Dict[str, Dict[str, Any]], columns: List[Tuple[str, str]]) -> str:
+    """ Format some groups of counters (from the stats summary) as a text table. """
+
+    def cell(counters: Dict[str, Any], name: str) -> str:
+        if name == 'cached':
+            value = counters['memo_hits'] + counters['disk_hits']
+        else:
+            value = counters[name]
+        if isinstance(value, float) and not value.is_integer():
+            return f'{value:.2f}'
+        return str(int(value))
+
+    header = [title] + [label for _, label in columns]
+    lines = [header] + [[name] + [cell(counters, column) for column, _ in columns] for name, counters in rows.items()]
+    widths = [max(len(line[i]) for line in lines) for i in range(len(header))]
+    return '\n'.join(
+        '  '.join(value.ljust(widths[i]) if i == 0 else value.rjust(widths[i]) for i, value in enumerate(line))
+        for line in lines
+    )
+
+
+def format_summary(summary: Dict[str, Any], columns: List[Tuple[str, str]]) -> str:
+    """ Tables per stage, engine and endpoint, then the total. """
+    sections = [
+        format_table('stage', summary['stages'], columns),
+        format_table('engine', summary['engines'], columns),
+    ]
+    if len(summary['endpoints']) > 0:
+        sections.append(format_table('endpoint', summary['endpoints'], columns))
+    sections.append(format_table('', {'total': summary['total']}, columns))
+    if len(summary['cascades']) > 0:
+        sections.append(format_table('cascade', summary['cascades'], CASCADE_COLUMNS))
+    return '\n\n'.join(sections)
@@ -0,0 +1,215 @@
+from typing import Any, Optional, cast
+from urllib.parse import urlparse
+import os
+import re
+import time
+
+
+class CompletionCacheMiss(ValueError):
+    """ Raised when a completion is not in the cache and the provider can't (or mustn't) produce it. """
+
+
+class TransientCompletionError(Exception):
+    """ A provider error worth retrying (rate limits, timeouts, overloaded servers, dropped connections). """
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CompletionProvider:
+    """
+    Interface of a text-completion backend. Providers are only called on cache misses.
+    """
+
+    name = 'base'
+
+    def complete(self, prompt: str, engine: str, stop: str, max_tokens: int) -> str:
+        raise NotImplementedError()
+
+    def complete_many(self, prompts: list[str], engine: str, stop: str, max_tokens: int) -> list[str]:
+        return [self.complete(prompt, engine=engine, stop=stop, max_tokens=max_tokens) for prompt in prompts]
+
+
+class OpenAIProvider(CompletionProvider):
+    """
+    Completions from the OpenAI API (or from an API-compatible server given by `api_base`).
+    """
+
+    name = 'openai'
+
+    def __init__(self, api_key: Optional[str] = None, api_base: Optional[str] = None):
+        import openai  # type: ignore
+        from dotenv import load_dotenv
+
+        if api_key is None:
+            load_dotenv('./.env')
+            api_key = os.getenv('OPENAI_API_KEY')
+        if api_key is None:
+            if api_base is None:
+                raise ValueError('Expected OPENAI_API_KEY environment variable to be set or in `.env` file.')
+            # a local API-compatible server doesn't check the key
+            api_key = 'none'
+        openai.api_key = api_key
+        if api_base is not None:
+            openai.api_base = api_base
+        self.openai = openai
+        # the set of error classes differs between versions of the openai package
+        transient_names = ['RateLimitError', 'APIConnectionError', 'Timeout', 'ServiceUnavailableError', 'TryAgain', 'APIError']
+        self.transient_errors = tuple(getattr(openai.error, name) for name in transient_names if hasattr(openai.error, name))
+
+    def create(self, prompt: Any, engine: str, stop: str, max_tokens: int) -> Any:
+        try:
+            return self.openai.Completion.create(
+                engine=engine,
+                prompt=prompt,
+                max_tokens=max_tokens,
+                temperature=0,
+                stop=stop,
+            )
+        except self.transient_errors as e:
+            retry_after = None
+            headers = getattr(e, 'headers', None) or {}
+            if 'retry-after' in headers:
+                try:
+                    retry_after = float(headers['retry-after'])
+                except ValueError:
+                    pass
+            raise TransientCompletionError(f'{type(e).__name__}: {e}', retry_after=retry_after) from e
+
+    def complete(self, prompt: str, engine: str, stop: str, max_tokens: int) -> str:
+        response = cast(Any, self.create(prompt, engine=engine, stop=stop, max_tokens=max_tokens))
+        return response['choices'][0]['text']
+
+    def complete_many(self, prompts: list[str], engine: str, stop: str, max_tokens: int) -> list[str]:
+        response = cast(Any, self.create(prompts, engine=engine, stop=stop, max_tokens=max_tokens))
+        results = [''] * len(prompts)
+        for choice in response['choices']:
+            results[choice['index']] = choice['text']
+        return results
+
+
+class ReplayProvider(CompletionProvider):
+    """
+    Serves nothing: every completion must already be in the cache, and a miss fails fast.
+    """
+
+    name = 'replay'
+
+    def complete(self, prompt: str, engine: str, stop: str, max_tokens: int) -> str:
+        raise CompletionCacheMiss(f'No cached {engine} completion for prompt:\n{prompt}')
+
+
+# Answers that commit to nothing, given when no example statement resembles the query.
+NEUTRAL_ANSWERS = ['n/a', 'something-else']
+
+
+def stub_words(text: str) -> set[str]:
+    return set(re.findall(r'\w+', text.lower()))
+
+
+def stub_answer(prompt: str) -> str:
+    """
+    A deterministic stand-in for a real completion of a few-shot prompt: the answer given to the
+    example whose statement shares the most words with the query (the first one on a tie), or a
+    neutral answer (like "n/a") when the prompt offers one and no example shares a word.
+
+    ...
+    Statement: report 400 "Forbidden"
+    Type: exception
+    ...
+    Statement: report 404 "Not found"
+    Type:               ->  " exception"
+
+    A packed prompt (see packing.py) gets an answer for each of its numbered statements.
+    """
+
+    blocks = prompt.rstrip().split('\n\n')
+    label = blocks[-1].split('\n')[-1].strip()
+    if not label.endswith(':'):
+        return ''
+    packed = re.match(r'^1\. (.*:)$', label)
+    if packed is not None:
+        label = packed.group(1)
+
+    # (statement, answer) of each example: the first line of a block, and the line with the label
+    examples: list[tuple[set[str], str]] = []
+    for block in blocks[:-1]:
+        lines = block.split('\n')
+        for line in lines[1:]:
+            if line.startswith(label):
+                examples.append((stub_words(lines[0].split(':', 1)[-1]), line[len(label):]))
+                break
+
+    def answer(query: str) -> str:
+        if len(examples) == 0:
+            return ''
+        words = stub_words(query)
+        scores = [len(words & statement) / max(len(words | statement), 1) for statement, _ in examples]
+        best = max(range(len(examples)), key=lambda i: (scores[i], -i))
+        if scores[best] == 0:
+            neutral = [a for _, a in examples if a.strip() in NEUTRAL_ANSWERS]
+            if len(neutral) > 0:
+                return neutral[0]
+        return examples[best][1]
+
+    if packed is not None:
+        queries = [re.sub(r'^\d+\. ', '', line) for line in blocks[-2].split('\n') if re.match(r'^\d+\. ', line)]
+        answers = [answer(query.split(':', 1)[-1]) for query in queries]
+        return answers[0] + ''.join(f'\n{i + 1}. {label}{a}' for i, a in enumerate(answers) if i > 0)
+    return answer(blocks[-1].split('\n')[0].split(':', 1)[-1])
+
+
+class StubProvider(CompletionProvider):
+    """
+    An offline provider for benchmarking the pipeline: answers every prompt with
+    `stub_answer` after sleeping for `latency` seconds (per request).
+    """
+
+    name = 'stub'
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def complete(self, prompt: str, engine: str, stop: str, max_tokens: int) -> str:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return stub_answer(prompt)
+
+    def complete_many(self, prompts: list[str], engine: str, stop: str, max_tokens: int) -> list[str]:
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return [stub_answer(prompt) for prompt in prompts]
+
+
+def make_provider(name: str, latency: float = 0.0, api_base: Optional[str] = None) -> CompletionProvider:
+    if name == 'openai':
+        return OpenAIProvider(api_base=api_base)
+    elif name == 'replay':
+        return ReplayProvider()
+    elif name == 'stub':
+        return StubProvider(latency=latency)
+    else:
+        raise ValueError(f'Invalid completion provider "{name}" (expected "openai", "replay" or "stub")')
+
+
+def answer_source(name: str, api_base: Optional[str] = None) -> str:
+    """
+    Where a provider's answers come from: "" for the OpenAI API (replayed answers included), "stub" for
+    placeholders, or the host of another API server (e.g. a stub server). Answers of different sources
+    are cached apart, so that placeholders are never served as real completions.
+    """
+
+    if name == 'stub':
+        return 'stub'
+    if name == 'openai' and api_base:
+        return re.sub(r'[^\w.-]', '-', urlparse(api_base).netloc or api_base)
+    return ''
+
+
+def source_cache_path(path: str, source: str) -> str:
+    """ The cache of a source's answers, next to the OpenAI one: gpt_cache -> gpt_cache.stub, gpt_cache.sqlite3 -> gpt_cache.stub.sqlite3 """
+    if source == '':
+        return path
+    root, ext = os.path.splitext(path)
+    return f'{root}.{source}{ext}'
@@ -0,0 +1,202 @@
+from typing import Any, Dict, Iterator, Optional
+from contextlib import contextmanager
+from contextvars import ContextVar
+import threading
+
+
+MAX_REPORTED_LINES = 50
+
+COUNTER_NAMES = [
+    'calls',
+    'memo_hits',
+    'disk_hits',
+    'misses',
+    'coalesced',
+    'remote_requests',
+    'retries',
+    'throttled_seconds',
+    'lookup_seconds',
+    'wait_seconds',
+    'remote_seconds',
+    'max_remote_seconds',
+    'prompt_chars',
+    'remote_prompt_chars',
+    'completion_chars',
+]
+
+
+def estimate_tokens(text: str) -> int:
+    """ A rough estimate of the number of GPT tokens in some text (about 4 characters per token). """
+    return (len(text) + 3) // 4
+
+
+def empty_counters() -> Dict[str, float]:
+    return {name: 0 for name in COUNTER_NAMES}
+
+
+# The endpoint being compiled in the current thread (or task), to attribute completions to it.
+_endpoint: ContextVar[Optional[str]] = ContextVar('endpoint', default=None)
+
+
+@contextmanager
+def endpoint_scope(label: str) -> Iterator[None]:
+    token = _endpoint.set(label)
+    try:
+        yield
+    finally:
+        _endpoint.reset(token)
+
+
+class CompletionStats:
+    """
+    Thread-safe counters and timers of the completion layer, aggregated in total, per engine, per calling stage
+    and per endpoint (the one of the enclosing endpoint_scope).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.total = empty_counters()
+            self.engines: Dict[str, Dict[str, float]] = {}
+            self.stages: Dict[str, Dict[str, float]] = {}
+            self.endpoints: Dict[str, Dict[str, float]] = {}
+            self.paths: Dict[str, Dict[str, Any]] = {}
+            self.cascades: Dict[str, Dict[str, Any]] = {}
+
+    def _groups(self, engine: str, stage: str) -> list[Dict[str, float]]:
+        if engine not in self.engines:
+            self.engines[engine] = empty_counters()
+        if stage not in self.stages:
+            self.stages[stage] = empty_counters()
+        groups = [self.total, self.engines[engine], self.stages[stage]]
+        endpoint = _endpoint.get()
+        if endpoint is not None:
+            if endpoint not in self.endpoints:
+                self.endpoints[endpoint] = empty_counters()
+            groups.append(self.endpoints[endpoint])
+        return groups
+
+    def record_lookup(self, engine: str, stage: str, prompt: str, seconds: float, hit: Optional[str]) -> None:
+        """ Record a cache lookup, where `hit` is 'memo', 'disk' or None for a miss. """
+        with self._lock:
+            for counters in self._groups(engine, stage):
+                counters['calls'] += 1
+                counters['lookup_seconds'] += seconds
+                counters['prompt_chars'] += len(prompt)
+                if hit == 'memo':
+                    counters['memo_hits'] += 1
+                elif hit == 'disk':
+                    counters['disk_hits'] += 1
+                else:
+                    counters['misses'] += 1
+
+    def record_remote(self, engine: str, stage: str, prompt: str, completion: str, seconds: float, prompt_chars: Optional[int] = None) -> None:
+        """ Record a completion from the provider; `prompt_chars` is its share of a packed prompt, if it was packed. """
+        with self._lock:
+            for counters in self._groups(engine, stage):
+                counters['remote_seconds'] += seconds
+                counters['max_remote_seconds'] = max(counters['max_remote_seconds'], seconds)
+                counters['remote_prompt_chars'] += len(prompt) if prompt_chars is None else prompt_chars
+                counters['completion_chars'] += len(completion)
+
+    def record_wait(self, engine: str, stage: str, seconds: float) -> None:
+        """ Record the time a caller was blocked on a completion (lookup, rate limits and request included). """
+        with self._lock:
+            for counters in self._groups(engine, stage):
+                counters['wait_seconds'] += seconds
+
+    def record_coalesced(self, engine: str, stage: str) -> None:
+        """ Record a miss that was answered by an identical request already in flight. """
+        with self._lock:
+            for counters in self._groups(engine, stage):
+                counters['coalesced'] += 1
+
+    def _engine_groups(self, engine: str) -> list[Dict[str, float]]:
+        if engine not in self.engines:
+            self.engines[engine] = empty_counters()
+        return [self.total, self.engines[engine]]
+
+    def record_request(self, engine: str) -> None:
+        """ Record one request to the provider (which may carry several prompts when batched). """
+        with self._lock:
+            for counters in self._engine_groups(engine):
+                counters['remote_requests'] += 1
+
+    def record_retry(self, engine: str) -> None:
+        with self._lock:
+            for counters in self._engine_groups(engine):
+                counters['retries'] += 1
+
+    def record_throttle(self, engine: str, seconds: float) -> None:
+        """ Record time spent waiting for the rate limit budget. """
+        with self._lock:
+            for counters in self._engine_groups(engine):
+                counters['throttled_seconds'] += seconds
+
+    def record_cascade(self, stage: str, engines: list[str], valid: bool) -> None:
+        """ Record the engines a cascade went through before getting a valid answer (or none). """
+        with self._lock:
+            if stage not in self.cascades:
+                self.cascades[stage] = {'calls': 0, 'escalated': 0, 'failed': 0, 'answered_by': {}}
+            entry = self.cascades[stage]
+            entry['calls'] += 1
+            if len(engines) > 1:
+                entry['escalated'] += 1
+            if valid:
+                entry['answered_by'][engines[-1]] = entry['answered_by'].get(engines[-1], 0) + 1
+            else:
+                entry['failed'] += 1
+
+    def record_path(self, stage: str, line: str, path: str) -> None:
+        """ Record whether a line was handled by a local parser ('local') or had to go to the model ('llm'). """
+        with self._lock:
+            if stage not in self.paths:
+                self.paths[stage] = {'local': 0, 'llm': 0, 'llm_lines': []}
+            entry = self.paths[stage]
+            entry[path] += 1
+            line = line.strip()
+            if path == 'llm' and line not in entry['llm_lines'] and len(entry['llm_lines']) < MAX_REPORTED_LINES:
+                entry['llm_lines'].append(line)
+
+    def summary(self) -> Dict[str, Any]:
+        """ A JSON-serializable snapshot of all counters, with derived hit rates. """
+
+        def finish(counters: Dict[str, float]) -> Dict[str, Any]:
+            out: Dict[str, Any] = dict(counters)
+            hits = counters['memo_hits'] + counters['disk_hits']
+            out['hit_rate'] = hits / counters['calls'] if counters['calls'] > 0 else None
+            out['prompt_tokens'] = (int(counters['prompt_chars']) + 3) // 4
+            out['remote_prompt_tokens'] = (int(counters['remote_prompt_chars']) + 3) // 4
+            out['completion_tokens'] = (int(counters['completion_chars']) + 3) // 4
+            return out
+
+        with self._lock:
+            return {
+                'total': finish(self.total),
+                'engines': {name: finish(c) for name, c in sorted(self.engines.items())},
+                'stages': {name: finish(c) for name, c in sorted(self.stages.items())},
+                'endpoints': {name: finish(c) for name, c in self.endpoints.items()},
+                'paths': {name: {'local': p['local'], 'llm': p['llm'], 'llm_lines': list(p['llm_lines'])}
+                          for name, p in sorted(self.paths.items())},
+                'cascades': {name: {'calls': c['calls'], 'escalated': c['escalated'], 'failed': c['failed'],
+                                    'escalation_rate': c['escalated'] / c['calls'], 'answered_by': dict(c['answered_by'])}
+                             for name, c in sorted(self.cascades.items())},
+            }
+
+
+_stats = CompletionStats()
+
+
+def get_stats() -> CompletionStats:
+    return _stats
+
+
+def reset_stats() -> None:
+    _stats.reset()
+
+
+def stats_summary() -> Dict[str, Any]:
+    return _stats.summary()
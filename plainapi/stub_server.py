@@ -0,0 +1,57 @@
+from typing import Any
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import time
+
+from plainapi.providers import stub_answer
+
+
+def serve_stub(host: str = 'localhost', port: int = 8700, latency: float = 0.0) -> None:
+    """
+    Run a local server that mimics the completions endpoint of the OpenAI API
+    (`POST .../engines/<engine>/completions`), answering every prompt with `stub_answer`
+    after `latency` seconds. Point `openai_api_base` in plain.ini at it to benchmark
+    the whole pipeline, HTTP included, without a network.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            parts = self.path.rstrip('/').split('/')
+            if len(parts) < 3 or parts[-1] != 'completions' or parts[-3] != 'engines':
+                self.send_error(404, f'Unknown path {self.path}')
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            body: Any = json.loads(self.rfile.read(length) or b'{}')
+            prompts = body.get('prompt', '')
+            if isinstance(prompts, str):
+                prompts = [prompts]
+            if latency > 0:
+                time.sleep(latency)
+            response = {
+                'id': 'stub',
+                'object': 'text_completion',
+                'model': parts[-2],
+                'choices': [
+                    {'index': idx, 'text': stub_answer(prompt), 'logprobs': None, 'finish_reason': 'stop'}
+                    for idx, prompt in enumerate(prompts)
+                ],
+            }
+            data = json.dumps(response).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format: str, *args: Any) -> None:
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f'Stub completion server listening on http://{host}:{port} (latency {latency}s)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
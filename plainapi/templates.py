@@ -0,0 +1,271 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+import itertools
+import math
+import re
+import threading
+
+from plainapi.cache import CompletionCache
+from plainapi.gpt3 import get_cache
+from plainapi.packing import split_few_shot
+from plainapi.parse_sql import Table, name_words, parse_schema, referenced_tables, valid_sql
+
+
+# Number of cached translations (with different tables or columns) a template needs before it is used.
+MIN_SUPPORT = 2
+
+# Sentences with more combinations of slots than this are left to the model.
+MAX_SHAPES = 64
+
+SQL_RESERVED = {
+    'select', 'from', 'where', 'and', 'or', 'not', 'null', 'is', 'in', 'like', 'insert', 'into', 'values',
+    'update', 'set', 'delete', 'order', 'by', 'group', 'having', 'limit', 'offset', 'asc', 'desc', 'join',
+    'inner', 'left', 'outer', 'on', 'as', 'distinct', 'count', 'sum', 'avg', 'min', 'max', 'true', 'false',
+    'returning', 'exists', 'between', 'case', 'when', 'then', 'else', 'end', 'with', 'replace', 'lower', 'upper',
+}
+
+# string literals are skipped, identifiers are (maybe) slots
+SQL_PART_PATTERN = re.compile(r"'(?:[^']|'')*'|\"[^\"]*\"|\b[A-Za-z_]\w*\b")
+SLOT_PATTERN = re.compile(r'\{([tc])(\d+)\}')
+SENTENCE_TOKEN_PATTERN = re.compile(r'\{[^}]*\}|\w+|[^\w\s]')
+
+TABLE_SLOT = '<table>'
+COLUMN_SLOT = '<column>'
+VARIABLE_SLOT = '{}'
+
+# A sentence with its table and column words replaced by slots: ("get", "a", "<table>", "with", "<column>", "{}")
+Shape = Tuple[str, ...]
+
+
+def sentence_tokens(sentence: str) -> List[str]:
+    """ The lowercase tokens of the English part of a statement ("user <- sql: get a user" -> get, a, user). """
+    sentence = sentence.strip()
+    if '<-' in sentence:
+        sentence = sentence.split('<-', 1)[1].strip()
+    if sentence.lower().startswith('sql:'):
+        sentence = sentence[4:]
+    return [token if token.startswith('{') else token.lower() for token in SENTENCE_TOKEN_PATTERN.findall(sentence)]
+
+
+def same_name(word: str, name: str) -> bool:
+    """ Whether a word of a sentence names an identifier ("users" names "user", "is_admin" names "is_admin"). """
+    words = name_words(name)
+    return len(words) > 0 and name_words(word) == words
+
+
+def induce(sentence: str, sql: str) -> Optional[Tuple[Shape, str, Tuple[str, ...]]]:
+    """
+    Generalize a translation into a template: the sentence's shape, the SQL with its table and column
+    names replaced by the slots {t0}, {c0}... (numbered in the order of the sentence), and the names
+    they replace. Returns None for translations that don't generalize.
+    """
+
+    sql = sql.strip()
+    if not valid_sql(sql) or '{' in sql:
+        return None
+    tokens = sentence_tokens(sentence)
+    placeholders = sum(1 for token in tokens if token.startswith('{'))
+    if placeholders != sql.count('?'):
+        return None
+    tables = referenced_tables(sql)
+    identifiers = {m.group(0).lower() for m in SQL_PART_PATTERN.finditer(sql) if m.group(0)[0] not in '\'"'}
+    columns = identifiers - tables - SQL_RESERVED
+
+    shape: List[str] = []
+    slots: Dict[str, str] = {}
+    fillers: List[str] = []
+    for token in tokens:
+        if token.startswith('{'):
+            shape.append(VARIABLE_SLOT)
+            continue
+        table = next((t for t in sorted(tables) if same_name(token, t)), None)
+        column = next((c for c in sorted(columns) if same_name(token, c)), None)
+        if table is not None and table not in slots:
+            slots[table] = f't{sum(1 for s in slots.values() if s[0] == "t")}'
+            shape.append(TABLE_SLOT)
+            fillers.append(table)
+        elif table is None and column is not None and column not in slots:
+            slots[column] = f'c{sum(1 for s in slots.values() if s[0] == "c")}'
+            shape.append(COLUMN_SLOT)
+            fillers.append(column)
+        else:
+            shape.append(token)
+    if len(slots) == 0:
+        return None
+
+    def replace(m: re.Match) -> str:
+        part = m.group(0)
+        if part[0] in '\'"' or part.lower() not in slots:
+            return part
+        return '{' + slots[part.lower()] + '}'
+
+    return tuple(shape), SQL_PART_PATTERN.sub(replace, sql), tuple(fillers)
+
+
+class TemplateIndex:
+    """
+    The templates induced from the cached English to SQL translations, with the (distinct) slot fillers
+    of the translations that support each of them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.templates: Dict[Shape, Dict[str, set[Tuple[str, ...]]]] = {}
+        # a sentence translated in different ways (e.g. for different schemas) can't be generalized
+        self.translations: Dict[Tuple[str, ...], set[str]] = {}
+        self.shapes: Dict[Tuple[str, ...], set[Shape]] = {}
+        self.conflicted: set[Shape] = set()
+
+    def add(self, sentence: str, sql: str) -> None:
+        induced = induce(sentence, sql)
+        if induced is None:
+            return
+        shape, pattern, fillers = induced
+        tokens = tuple(sentence_tokens(sentence))
+        with self._lock:
+            self.templates.setdefault(shape, {}).setdefault(pattern, set()).add(fillers)
+            translations = self.translations.setdefault(tokens, set())
+            shapes = self.shapes.setdefault(tokens, set())
+            translations.add(' '.join(sql.split()))
+            shapes.add(shape)
+            if len(translations) > 1:
+                self.conflicted.update(shapes)
+
+    def add_all(self, entries: Iterable[Tuple[str, str, str]]) -> None:
+        for _, prompt, answer in entries:
+            parts = split_few_shot(prompt)
+            if parts is None:
+                continue
+            _, query, label = parts
+            if label == 'SQL:' and query.startswith('English:'):
+                self.add(query[len('English:'):], answer)
+
+    def confident(self, shape: Shape, min_support: int) -> Optional[str]:
+        """
+        The SQL pattern of a shape, if there are enough translations of the shape,
+        they agree on it, and none of their sentences was translated otherwise.
+        """
+        with self._lock:
+            patterns = self.templates.get(shape)
+            if patterns is None or len(patterns) != 1 or shape in self.conflicted:
+                return None
+            pattern, supports = next(iter(patterns.items()))
+            return pattern if len(supports) >= min_support else None
+
+
+_index: Optional[TemplateIndex] = None
+_index_cache: Optional[CompletionCache] = None
+_index_lock = threading.Lock()
+_min_support = MIN_SUPPORT
+
+
+def configure_templates(min_support: int = MIN_SUPPORT) -> None:
+    global _min_support
+    if min_support < 1:
+        raise ValueError(f'Expected a positive template support, got {min_support}')
+    _min_support = min_support
+
+
+def templates_options() -> str:
+    return f'template_support={_min_support}'
+
+
+def get_templates() -> TemplateIndex:
+    """ The template index, built from the completion cache on first use (and again if another cache is swapped in). """
+    global _index, _index_cache
+    with _index_lock:
+        cache = get_cache()
+        if _index is None or _index_cache is not cache:
+            _index = TemplateIndex()
+            _index.add_all(cache.items())
+            _index_cache = cache
+        return _index
+
+
+def learn_translation(sentence: str, sql: str) -> None:
+    get_templates().add(sentence, sql)
+
+
+def fill_template(pattern: str, tokens: List[str], shape: Shape, tables: List[Table]) -> Optional[str]:
+    """
+    Fill a template's slots with the tables and columns of the schema that the sentence names,
+    and check that every name the SQL uses is in the schema. Returns None when it doesn't fit.
+    """
+
+    table_words = [token for token, slot in zip(tokens, shape) if slot == TABLE_SLOT]
+    column_words = [token for token, slot in zip(tokens, shape) if slot == COLUMN_SLOT]
+    slot_tables: List[Table] = []
+    for word in table_words:
+        table = next((t for t in tables if same_name(word, t['name'])), None)
+        if table is None:
+            return None
+        slot_tables.append(table)
+    # columns are looked up in the tables of the sentence first
+    candidates = slot_tables + [t for t in tables if t not in slot_tables]
+    slot_columns: List[str] = []
+    for word in column_words:
+        column = next((c['name'] for t in candidates for c in t['columns'] if same_name(word, c['name'])), None)
+        if column is None:
+            return None
+        slot_columns.append(column)
+
+    def fill(m: re.Match) -> str:
+        idx = int(m.group(2))
+        return slot_tables[idx]['name'] if m.group(1) == 't' else slot_columns[idx]
+
+    sql = SLOT_PATTERN.sub(fill, pattern)
+
+    # checked against the schema: the tables exist, and the other names are columns of these tables
+    schema_tables = {t['name'].lower(): t for t in tables}
+    used = referenced_tables(sql)
+    if not valid_sql(sql) or not used <= schema_tables.keys():
+        return None
+    known = {c['name'].lower() for name in used for c in schema_tables[name]['columns']}
+    for m in SQL_PART_PATTERN.finditer(sql):
+        part = m.group(0)
+        if part[0] in '\'"':
+            continue
+        if part.lower() not in SQL_RESERVED and part.lower() not in used and part.lower() not in known:
+            return None
+    return sql
+
+
+def match_sql_template(sentence: str, schema_text: str) -> Optional[str]:
+    """
+    Translate a sentence with a confident template of the cached translations of sentences of the same shape,
+    e.g. "get a post with id {id}" from "get a user with id {id}" and "get a user with email {email}"
+    (SELECT * FROM posts WHERE id = ?). Returns None when no template fits the sentence and the schema.
+    """
+
+    try:
+        tables = parse_schema(schema_text)
+    except ValueError:
+        return None
+    if len(tables) == 0:
+        return None
+    tokens = sentence_tokens(sentence)
+    templates = get_templates()
+
+    # each word may be a table, a column, or itself
+    options: List[List[str]] = []
+    for token in tokens:
+        if token.startswith('{'):
+            options.append([VARIABLE_SLOT])
+            continue
+        choices = [token]
+        if any(same_name(token, t['name']) for t in tables):
+            choices.append(TABLE_SLOT)
+        if any(same_name(token, c['name']) for t in tables for c in t['columns']):
+            choices.append(COLUMN_SLOT)
+        options.append(choices)
+    if math.prod(len(choices) for choices in options) > MAX_SHAPES:
+        return None
+    # the shapes with the most slots first
+    shapes = sorted(itertools.product(*options), key=lambda shape: -sum(1 for slot in shape if slot in [TABLE_SLOT, COLUMN_SLOT]))
+    for shape in shapes:
+        pattern = templates.confident(shape, _min_support)
+        if pattern is None:
+            continue
+        sql = fill_template(pattern, tokens, shape, tables)
+        if sql is not None:
+            return ' ' + sql
+    return None
@@ -1,8 +1,32 @@
+from typing import Dict, Optional, Tuple
+import os
 import subprocess
 
 
+# The last schema read from each database, with the state of the database files it was read from.
+_schemas: Dict[str, Tuple[Tuple[Optional[Tuple[int, int]], ...], str]] = {}
+
+
+def db_files_state(db_name: str) -> Tuple[Optional[Tuple[int, int]], ...]:
+    states = []
+    for filename in [db_name, db_name + '-wal']:
+        try:
+            st = os.stat(filename)
+            states.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            states.append(None)
+    return tuple(states)
+
+
 def get_db_schema_text(db_name: str) -> str:
-    return str(subprocess.check_output(['sqlite3', db_name, '.schema']), 'utf-8')
+    """ The schema of the database (from the sqlite3 CLI), read again only when the database files change. """
+    key = os.path.abspath(db_name)
+    state = db_files_state(db_name)
+    if key in _schemas and _schemas[key][0] == state and state[0] is not None:
+        return _schemas[key][1]
+    schema_text = str(subprocess.check_output(['sqlite3', db_name, '.schema']), 'utf-8')
+    _schemas[key] = (state, schema_text)
+    return schema_text
 
 
 def text2valid_id(text: str) -> str:
@@ -12,3 +36,20 @@ def text2valid_id(text: str) -> str:
     if combined[0].isnumeric():
         combined = 'func_' + combined
     return combined
+
+
+def parse_duration(text: str) -> float:
+    """
+    Parse a duration in seconds, optionally with a unit suffix.
+
+    90 -> 90.0
+    15m -> 900.0
+    30d -> 2592000.0
+
+    """
+
+    units = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+    text = text.strip().lower()
+    if len(text) > 0 and text[-1] in units:
+        return float(text[:-1]) * units[text[-1]]
+    return float(text)
@@ -0,0 +1,104 @@
+from typing import Dict, List, Optional, Tuple
+import os
+import sys
+import time
+import socket
+import subprocess
+
+
+WATCH_INTERVAL = 0.2
+WATCH_DEBOUNCE = 0.3
+
+FileState = Optional[Tuple[int, int]]
+
+
+def file_states(filenames: List[str]) -> Dict[str, FileState]:
+    """ The (mtime, size) of each file, or None for a missing file. """
+    states: Dict[str, FileState] = {}
+    for filename in filenames:
+        try:
+            st = os.stat(filename)
+            states[filename] = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            states[filename] = None
+    return states
+
+
+def wait_for_changes(states: Dict[str, FileState],
+                     interval: float = WATCH_INTERVAL,
+                     debounce: float = WATCH_DEBOUNCE) -> Tuple[Dict[str, FileState], List[str], float]:
+    """
+    Poll the files until some of them change, then until they have been left alone for `debounce`
+    seconds (editors often save in several steps). Returns the new states, the changed files,
+    and the time of the last edit.
+    """
+
+    filenames = list(states.keys())
+    while True:
+        time.sleep(interval)
+        current = file_states(filenames)
+        if current != states:
+            break
+    while True:
+        time.sleep(debounce)
+        latest = file_states(filenames)
+        if latest == current:
+            break
+        current = latest
+    changed = [filename for filename in filenames if current[filename] != states[filename]]
+    mtimes = []
+    for filename in changed:
+        state = current[filename]
+        if state is not None:
+            mtimes.append(state[0] / 1e9)
+    edited_at = max(mtimes) if len(mtimes) > 0 else time.time()
+    return current, changed, edited_at
+
+
+class AppServer:
+    """
+    The generated app, served by uvicorn in a subprocess, and restarted whenever it is regenerated.
+    """
+
+    def __init__(self, target_filename: str, host: str, port: int):
+        self.app_dir = os.path.dirname(os.path.abspath(target_filename))
+        self.module = os.path.splitext(os.path.basename(target_filename))[0]
+        self.host = host
+        self.port = port
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self) -> None:
+        self.process = subprocess.Popen([sys.executable, '-m', 'uvicorn', f'{self.module}:app',
+                                         '--app-dir', self.app_dir, '--host', self.host, '--port', str(self.port)])
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    def running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def restart(self) -> None:
+        self.stop()
+        self.start()
+
+    def wait_until_ready(self, timeout: float = 30.0) -> bool:
+        """ Wait until the server accepts connections. Returns False if it exited (e.g. the app failed to import) or timed out. """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if not self.running():
+                return False
+            try:
+                with socket.create_connection((self.host, self.port), timeout=0.2):
+                    return True
+            except OSError:
+                time.sleep(0.05)
+        return False
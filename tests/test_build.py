@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+
+from plainapi.build import BuildCache, block_fingerprint, write_if_changed
+
+
+ENDPOINT = {
+    'header': {'method': 'GET', 'url': '/users'},
+    'requirements': {'inputs': [], 'outputs': []},
+    'implementation': [{'type': 'output', 'value': '{users}'}],
+}
+
+BLOCK = 'GET at url /users\n* requires nothing *\n    return {users}'
+SCHEMA = 'CREATE TABLE users (id INTEGER PRIMARY KEY);'
+
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        build_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(build_dir.cleanup)
+        self.build_dir = build_dir.name
+
+    def test_fingerprint(self):
+        fingerprint = block_fingerprint(BLOCK, SCHEMA, 'options')
+        self.assertEqual(block_fingerprint(BLOCK, SCHEMA, 'options'), fingerprint)
+        cases = [
+            (BLOCK + ' sorted by id', SCHEMA, 'options'),
+            (BLOCK, SCHEMA.replace(');', ', email TEXT);'), 'options'),
+            (BLOCK, SCHEMA, 'other options'),
+        ]
+        for block, schema_text, options in cases:
+            with self.subTest(block=block, schema_text=schema_text, options=options):
+                self.assertNotEqual(block_fingerprint(block, schema_text, options), fingerprint)
+
+    def test_save_and_load(self):
+        fingerprint = block_fingerprint(BLOCK, SCHEMA)
+        BuildCache(self.build_dir).save(fingerprint, ENDPOINT)
+        self.assertEqual(BuildCache(self.build_dir).load(fingerprint), ENDPOINT)
+        self.assertIsNone(BuildCache(self.build_dir).load(block_fingerprint(BLOCK, '')))
+
+    def test_corrupted_artifact_is_rebuilt(self):
+        build_cache = BuildCache(self.build_dir)
+        build_cache.save('abc', ENDPOINT)
+        with open(build_cache.path('abc'), 'w') as f:
+            f.write('{"format": "plainapi-ir", "ver')
+        self.assertIsNone(build_cache.load('abc'))
+
+    def test_memory(self):
+        memory: dict[str, str] = {}
+        BuildCache(self.build_dir, memory=memory).save('abc', ENDPOINT)
+        os.remove(BuildCache(self.build_dir).path('abc'))
+        self.assertEqual(BuildCache(self.build_dir, memory=memory).load('abc'), ENDPOINT)
+        self.assertIsNone(BuildCache(self.build_dir).load('abc'))
+
+    def test_prune(self):
+        memory: dict[str, str] = {}
+        build_cache = BuildCache(self.build_dir, memory=memory)
+        for fingerprint in ['abc', 'def', 'ghi']:
+            build_cache.save(fingerprint, ENDPOINT)
+        self.assertEqual(build_cache.prune({'def'}), 2)
+        self.assertEqual(sorted(memory), ['def'])
+        self.assertEqual(os.listdir(build_cache.endpoints_dir), ['def.json'])
+
+    def test_write_if_changed(self):
+        filename = os.path.join(self.build_dir, 'app.py')
+        self.assertTrue(write_if_changed(filename, 'print(1)\n'))
+        self.assertFalse(write_if_changed(filename, 'print(1)\n'))
+        self.assertTrue(write_if_changed(filename, 'print(2)\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
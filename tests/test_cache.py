@@ -0,0 +1,143 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from plainapi.cache import (CACHE_LAYOUT_MARKER, CACHE_SEPARATOR, DirectoryCache, ReadOnlyCache, SQLiteCache, import_directory,
+                            make_cache_key, split_cache_key)
+
+
+def write_legacy_file(cache_dir: str, name: str, cache_key: str, result: str) -> None:
+    with open(os.path.join(cache_dir, name), 'w') as f:
+        f.write(cache_key + CACHE_SEPARATOR + result)
+
+
+def listing(cache_dir: str) -> list[tuple[str, float]]:
+    return sorted((os.path.join(root, name), os.stat(os.path.join(root, name)).st_mtime)
+                  for root, _, names in os.walk(cache_dir) for name in names)
+
+
+class TestDirectoryCache(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = cache_dir.name
+
+    def test_hit_and_miss(self):
+        cache = DirectoryCache(self.cache_dir)
+        cache.put('davinci', 'prompt', ' answer')
+        cases = [
+            ('davinci', 'prompt', ' answer'),
+            ('curie', 'prompt', None),
+            ('davinci', 'another prompt', None),
+        ]
+        for engine, prompt, expected in cases:
+            with self.subTest(engine=engine, prompt=prompt):
+                self.assertEqual(cache.get(engine, prompt), expected)
+                self.assertEqual(DirectoryCache(self.cache_dir).get(engine, prompt, touch=False), expected)
+        self.assertEqual(list(cache.items()), [('davinci', 'prompt', ' answer')])
+
+    def test_corrupted_entry_is_a_miss(self):
+        cache = DirectoryCache(self.cache_dir)
+        cache.put('davinci', 'prompt', ' answer')
+        cache.put('davinci', 'other prompt', ' other answer')
+        with open(cache.path(make_cache_key('davinci', 'prompt')), 'w') as f:
+            f.write('davinci###prom')
+        self.assertIsNone(cache.get('davinci', 'prompt'))
+        self.assertEqual(list(cache.items()), [('davinci', 'other prompt', ' other answer')])
+
+    def test_migration(self):
+        write_legacy_file(self.cache_dir, 'a1b2', make_cache_key('davinci', 'prompt'), ' answer')
+        write_legacy_file(self.cache_dir, 'c3d4', make_cache_key('curie', 'prompt'), ' curie answer')
+        # written by the backend, without the engine
+        write_legacy_file(self.cache_dir, 'e5f6', 'backend prompt', ' backend answer')
+        with open(os.path.join(self.cache_dir, 'truncated'), 'w') as f:
+            f.write('davinci###trunc')
+        cache = DirectoryCache(self.cache_dir)
+        self.assertEqual(cache.get('davinci', 'prompt'), ' answer')
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, CACHE_LAYOUT_MARKER)))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'a1b2')))
+        self.assertEqual(sorted(cache.items()), [
+            ('curie', 'prompt', ' curie answer'),
+            ('davinci', 'backend prompt', ' backend answer'),
+            ('davinci', 'prompt', ' answer'),
+        ])
+        # already migrated
+        self.assertEqual(DirectoryCache(self.cache_dir).migrate(), 0)
+
+    def test_concurrent_migration(self):
+        write_legacy_file(self.cache_dir, 'a1b2', make_cache_key('davinci', 'prompt'), ' answer')
+        # another process migrates the file between our read and our remove
+        with mock.patch('plainapi.cache.os.remove', side_effect=FileNotFoundError()):
+            self.assertEqual(DirectoryCache(self.cache_dir).migrate(), 0)
+        self.assertEqual(DirectoryCache(self.cache_dir).get('davinci', 'prompt'), ' answer')
+
+    def test_read_only_lookups_of_a_legacy_cache(self):
+        write_legacy_file(self.cache_dir, 'a1b2', make_cache_key('davinci', 'prompt'), ' answer')
+        write_legacy_file(self.cache_dir, 'e5f6', 'backend prompt', ' backend answer')
+        before = listing(self.cache_dir)
+        cache = ReadOnlyCache(DirectoryCache(self.cache_dir))
+        self.assertEqual(cache.get('davinci', 'prompt'), ' answer')
+        self.assertEqual(cache.get('davinci', 'backend prompt'), ' backend answer')
+        self.assertIsNone(cache.get('curie', 'prompt'))
+        cache.put('curie', 'prompt', ' curie answer')
+        self.assertEqual(listing(self.cache_dir), before)
+
+    def test_split_cache_key(self):
+        cases = [
+            ('davinci###prompt', ('davinci', 'prompt')),
+            ('curie###a ### b', ('curie', 'a ### b')),
+            ('a backend prompt', ('davinci', 'a backend prompt')),
+        ]
+        for cache_key, expected in cases:
+            with self.subTest(cache_key=cache_key):
+                self.assertEqual(split_cache_key(cache_key), expected)
+
+
+class TestSQLiteCache(unittest.TestCase):
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.cache = SQLiteCache(os.path.join(self.tmp_dir, 'gpt_cache.sqlite3'))
+        self.addCleanup(self.cache.close)
+
+    def test_hit_and_miss(self):
+        self.cache.put('davinci', 'prompt', ' answer')
+        self.cache.put('davinci', 'prompt', ' new answer')
+        cases = [
+            ('davinci', 'prompt', ' new answer'),
+            ('curie', 'prompt', None),
+            ('davinci', 'another prompt', None),
+        ]
+        for engine, prompt, expected in cases:
+            with self.subTest(engine=engine, prompt=prompt):
+                self.assertEqual(self.cache.get(engine, prompt), expected)
+        self.assertEqual(list(self.cache.items()), [('davinci', 'prompt', ' new answer')])
+        self.cache.remove('davinci', 'prompt')
+        self.assertIsNone(self.cache.get('davinci', 'prompt'))
+
+    def test_read_only_lookups(self):
+        self.cache.put('davinci', 'prompt', ' answer')
+        before = [entry['accessed_at'] for entry in self.cache.entries()]
+        cache = ReadOnlyCache(self.cache)
+        self.assertEqual(cache.get('davinci', 'prompt'), ' answer')
+        cache.put('curie', 'prompt', ' curie answer')
+        self.assertEqual([entry['accessed_at'] for entry in self.cache.entries()], before)
+        self.assertIsNone(self.cache.get('curie', 'prompt'))
+
+    def test_import_directory(self):
+        cache_dir = os.path.join(self.tmp_dir, 'gpt_cache')
+        DirectoryCache(cache_dir).put('curie', 'prompt', ' curie answer')
+        write_legacy_file(cache_dir, 'e5f6', 'backend prompt', ' backend answer')
+        self.assertEqual(import_directory(self.cache, cache_dir), 2)
+        self.assertEqual(sorted(self.cache.items()), [
+            ('curie', 'prompt', ' curie answer'),
+            ('davinci', 'backend prompt', ' backend answer'),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import tempfile
+import unittest
+
+from plainapi.cache import DirectoryCache
+from plainapi.gpt3 import use_cache, use_provider
+from plainapi.parse_code import code_block_type_prompt, determine_code_block_type, prefetch_code_block_types
+from plainapi.providers import ReplayProvider
+
+
+class TestPrefetch(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache = DirectoryCache(cache_dir.name)
+        for context in [use_cache(self.cache), use_provider(ReplayProvider())]:
+            context.__enter__()
+            self.addCleanup(context.__exit__, None, None, None)
+
+    def test_davinci_only_cache(self):
+        # a cache written when davinci was the only engine: nothing is requested from curie
+        lines = ['report sql: all the users from the db', 'send an email to {email}']
+        answers = [' exception', ' something-else']
+        for line, answer in zip(lines, answers):
+            self.cache.put('davinci', code_block_type_prompt(line), answer)
+        prefetch_code_block_types(lines)
+        self.assertEqual([determine_code_block_type(line) for line in lines], ['exception', 'something-else'])
+
+
+if __name__ == '__main__':
+    unittest.main()
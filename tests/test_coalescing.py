@@ -0,0 +1,73 @@
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from plainapi.cache import DirectoryCache
+from plainapi.gpt3 import cached_complete, use_cache, use_provider
+from plainapi.providers import CompletionProvider
+
+
+class SlowProvider(CompletionProvider):
+    """ Answers after a delay, counting the requests (or fails every one of them). """
+
+    name = 'slow'
+
+    def __init__(self, delay: float, error: bool = False):
+        self.delay = delay
+        self.error = error
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def complete(self, prompt: str, engine: str, stop: str, max_tokens: int) -> str:
+        with self._lock:
+            self.requests += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise ValueError('bad request')
+        return ' answer to ' + prompt
+
+
+class TestCoalescing(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache = DirectoryCache(cache_dir.name)
+        context = use_cache(self.cache)
+        context.__enter__()
+        self.addCleanup(context.__exit__, None, None, None)
+
+    def complete_concurrently(self, prompts: list[str]) -> list:
+        def complete(prompt: str):
+            try:
+                return cached_complete(prompt, engine='davinci')
+            except ValueError as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=len(prompts)) as pool:
+            return list(pool.map(complete, prompts))
+
+    def test_identical_requests_are_sent_once(self):
+        provider = SlowProvider(0.2)
+        with use_provider(provider):
+            results = self.complete_concurrently(['a', 'a', 'a', 'a', 'b'])
+            self.assertEqual(results, [' answer to a'] * 4 + [' answer to b'])
+            self.assertEqual(provider.requests, 2)
+            # and then answered from the cache
+            self.assertEqual(cached_complete('a', engine='davinci'), ' answer to a')
+            self.assertEqual(provider.requests, 2)
+        self.assertEqual(self.cache.get('davinci', 'a'), ' answer to a')
+
+    def test_errors_reach_every_waiter(self):
+        provider = SlowProvider(0.2, error=True)
+        with use_provider(provider):
+            results = self.complete_concurrently(['a', 'a', 'a'])
+        self.assertTrue(all(isinstance(result, ValueError) for result in results))
+        self.assertEqual(provider.requests, 1)
+        self.assertIsNone(self.cache.get('davinci', 'a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
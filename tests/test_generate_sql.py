@@ -0,0 +1,48 @@
+import tempfile
+import unittest
+
+from plainapi.cache import DirectoryCache
+from plainapi.generate_sql import english2sql
+from plainapi.gpt3 import use_cache, use_provider
+from plainapi.providers import CompletionProvider
+
+
+class SQLProvider(CompletionProvider):
+    """ Answers every prompt with the same statement, remembering the prompts. """
+
+    name = 'sql'
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.prompts: list[str] = []
+
+    def complete(self, prompt: str, engine: str, stop: str, max_tokens: int) -> str:
+        self.prompts.append(prompt)
+        return ' ' + self.sql
+
+
+class TestEnglish2SQL(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.provider = SQLProvider('SELECT * FROM users WHERE id = ?')
+        for context in [use_cache(DirectoryCache(cache_dir.name)), use_provider(self.provider)]:
+            context.__enter__()
+            self.addCleanup(context.__exit__, None, None, None)
+
+    def test_schemas(self):
+        cases = [
+            'CREATE TABLE users (id INTEGER PRIMARY KEY, email TEXT);',
+            # types the schema parser doesn't know are pasted into the prompt as they are
+            'CREATE TABLE users (id INTEGER PRIMARY KEY, meta JSON);',
+            'CREATE TABLE users (id UUID PRIMARY KEY, email TEXT);',
+        ]
+        for schema_text in cases:
+            with self.subTest(schema_text=schema_text):
+                self.assertEqual(english2sql('get the user with id {id}', schema_text).strip(), 'SELECT * FROM users WHERE id = ?')
+                self.assertIn('English: get the user with id {id}', self.provider.prompts[-1])
+
+
+if __name__ == '__main__':
+    unittest.main()
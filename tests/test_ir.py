@@ -0,0 +1,77 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from plainapi.ir import IR_VERSION, dump_application, dumps_endpoint, dumps_ir, load_application, loads_endpoint, loads_ir
+
+
+ENDPOINT = {
+    'header': {'method': 'GET', 'url': '/users/{id}'},
+    'requirements': {
+        'inputs': [{'name': 'current_user', 'type': 'User'}, {'name': 'id', 'type': 'int'}],
+        'outputs': [{'name': 'unknown', 'type': 'User'}],
+    },
+    'implementation': [
+        {
+            'type': 'if',
+            'condition': {'type': 'python-conditional', 'original': 'if the current user is not an admin', 'code': 'not current_user.is_admin'},
+            'case_true': [{'type': 'exception', 'code': 403, 'message': '"Forbidden"'}],
+            'case_false': None,
+        },
+        {
+            'type': 'assignment',
+            'name': 'user',
+            'value': {'type': 'sql', 'original': 'sql: get a user with id {id}', 'sql': ' SELECT * FROM users WHERE id = ?'},
+        },
+        {'type': 'output', 'value': '{user}'},
+    ],
+}
+
+APPLICATION = {'title': 'My App', 'endpoints': [ENDPOINT]}
+
+SCHEMA = 'CREATE TABLE users (id INTEGER PRIMARY KEY, email TEXT, is_admin BOOLEAN);'
+
+
+class TestIR(unittest.TestCase):
+
+    def test_endpoint_round_trip(self):
+        self.assertEqual(loads_endpoint(dumps_endpoint(ENDPOINT)), ENDPOINT)
+
+    def test_application_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in ['app.ir.json', 'app.ir.json.gz']:
+                with self.subTest(name=name):
+                    filename = os.path.join(tmp_dir, name)
+                    dump_application(APPLICATION, SCHEMA, filename)
+                    self.assertEqual(load_application(filename), (APPLICATION, SCHEMA))
+
+    def test_invalid_ir(self):
+        cases = [
+            ('not IR', json.dumps({'endpoint': ENDPOINT})),
+            ('another kind', dumps_ir('application', APPLICATION)),
+            ('a newer version', dumps_endpoint(ENDPOINT).replace(f'"version":{IR_VERSION}', f'"version":{IR_VERSION + 1}')),
+            ('no upgrade', dumps_endpoint(ENDPOINT).replace(f'"version":{IR_VERSION}', '"version":0')),
+        ]
+        for description, text in cases:
+            with self.subTest(description):
+                with self.assertRaises(ValueError):
+                    loads_ir(text, 'endpoint')
+
+    def test_upgrade(self):
+        def upgrade(payload):
+            payload['endpoint']['header']['url'] = payload['endpoint']['header'].pop('path')
+            return payload
+
+        old = json.loads(dumps_endpoint(ENDPOINT))
+        old['version'] = IR_VERSION - 1
+        old['endpoint']['header']['path'] = old['endpoint']['header'].pop('url')
+        with mock.patch.dict('plainapi.ir.UPGRADES', {IR_VERSION - 1: upgrade}):
+            payload = loads_ir(json.dumps(old), 'endpoint')
+        self.assertEqual(payload['version'], IR_VERSION)
+        self.assertEqual(payload['endpoint'], ENDPOINT)
+
+
+if __name__ == '__main__':
+    unittest.main()
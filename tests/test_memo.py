@@ -0,0 +1,54 @@
+import unittest
+
+from plainapi.gpt3 import LRUMemo
+
+
+class TestLRUMemo(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        memo = LRUMemo(max_entries=2)
+        memo.put('davinci', 'a', ' 1')
+        memo.put('davinci', 'b', ' 2')
+        # a is now more recent than b
+        self.assertEqual(memo.get('davinci', 'a'), ' 1')
+        memo.put('davinci', 'c', ' 3')
+        self.assertEqual(len(memo), 2)
+        self.assertEqual(memo.get('davinci', 'a'), ' 1')
+        self.assertIsNone(memo.get('davinci', 'b'))
+        self.assertEqual(memo.get('davinci', 'c'), ' 3')
+
+    def test_byte_limit(self):
+        size = LRUMemo.entry_size('davinci', 'a', ' 1')
+        memo = LRUMemo(max_bytes=2 * size)
+        for prompt in ['a', 'b', 'c']:
+            memo.put('davinci', prompt, ' 1')
+        self.assertEqual(len(memo), 2)
+        self.assertEqual(memo.size_bytes, 2 * size)
+        self.assertIsNone(memo.get('davinci', 'a'))
+        # bigger than the whole memo: not kept, and nothing is evicted for it
+        memo.put('davinci', 'd', ' ' + 'x' * 2 * size)
+        self.assertIsNone(memo.get('davinci', 'd'))
+        self.assertEqual(len(memo), 2)
+
+    def test_replace_and_clear(self):
+        memo = LRUMemo()
+        memo.put('davinci', 'a', ' 1')
+        memo.put('davinci', 'a', ' 22')
+        self.assertEqual(memo.get('davinci', 'a'), ' 22')
+        self.assertEqual(memo.size_bytes, LRUMemo.entry_size('davinci', 'a', ' 22'))
+        memo.clear()
+        self.assertEqual((len(memo), memo.size_bytes), (0, 0))
+
+    def test_engines_are_kept_apart(self):
+        memo = LRUMemo()
+        memo.put('davinci', 'a', ' 1')
+        self.assertIsNone(memo.get('curie', 'a'))
+
+    def test_disabled(self):
+        memo = LRUMemo(max_entries=0)
+        memo.put('davinci', 'a', ' 1')
+        self.assertIsNone(memo.get('davinci', 'a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
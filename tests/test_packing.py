@@ -0,0 +1,48 @@
+import unittest
+
+from plainapi.packing import pack_prompt, split_few_shot, unpack_answers
+
+
+PREAMBLE = '''Determine the type of each statement.
+
+Statement: return {user}
+Type: output'''
+
+
+class TestPacking(unittest.TestCase):
+
+    def test_split_few_shot(self):
+        cases = [
+            (PREAMBLE + '\n\nStatement: user <- get a user\nType:', (PREAMBLE, 'Statement: user <- get a user', 'Type:')),
+            # the query isn't the last block
+            (PREAMBLE, None),
+            ('Statement: user <- get a user\nType:', None),
+            (PREAMBLE + '\n\nStatement: user <- get a user\nType: assignment', None),
+        ]
+        for prompt, expected in cases:
+            with self.subTest(prompt=prompt[-40:]):
+                self.assertEqual(split_few_shot(prompt), expected)
+
+    def test_pack_prompt(self):
+        packed = pack_prompt(PREAMBLE, ['Statement: raise 404', 'Statement: let x be 1'], 'Type:')
+        self.assertTrue(packed.startswith(PREAMBLE + '\n\n'))
+        self.assertIn('1. Statement: raise 404\n2. Statement: let x be 1', packed)
+        self.assertTrue(packed.endswith('\n\n1. Type:'))
+
+    def test_unpack_answers(self):
+        cases = [
+            (' exception\n2. Type: assignment', 2, [' exception', ' assignment']),
+            # out of order, with surrounding noise
+            (' exception\n\n3. Type: output\n2. Type:  assignment \nthat is all', 3, [' exception', ' assignment', ' output']),
+            # missing and extra answers
+            (' exception\n4. Type: output', 3, [' exception', None, None]),
+            # the first answer is kept
+            (' exception\n1. Type: output', 1, [' exception']),
+        ]
+        for completion, count, expected in cases:
+            with self.subTest(completion=completion):
+                self.assertEqual(unpack_answers(completion, 'Type:', count), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
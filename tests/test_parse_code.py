@@ -0,0 +1,119 @@
+import unittest
+from unittest import mock
+
+from plainapi.parse_code import (classify_statement_locally, configure_statement_workers, match_assignment, match_else_or_elif,
+                                 match_exception, match_output, parse_code_block, strip_sql_prefix)
+
+
+class TestParseCode(unittest.TestCase):
+
+    def test_classify_statement_locally(self):
+        cases = [
+            ('if {password} is too short', 'if'),
+            ('user <- get a user', 'assignment'),
+            ('let x be the oldest user', 'assignment'),
+            ('return {user}', 'output'),
+            ('output the oldest user', 'output'),
+            ('raise 404', 'exception'),
+            ('throw "Not enough data", 500', 'exception'),
+            ('report 400: "Forbidden"', 'exception'),
+            ('report "Bad password"', 'exception'),
+            ('report sql: all users', None),
+            ('go to the moon', None),
+        ]
+        for text, expected in cases:
+            with self.subTest(text=text):
+                self.assertEqual(classify_statement_locally(text), expected)
+
+
+    def test_match_else_or_elif(self):
+        cases = [
+            ('else', ('else', None)),
+            ('otherwise:', ('else', None)),
+            ('otherwise, if the current user is not logged in', ('elif', 'the current user is not logged in')),
+            ('elif {id} is 0:', ('elif', '{id} is 0')),
+            ('return {user}', ('n/a', None)),
+            ('otherwise go to the moon', None),
+            ('go to the moon', None),
+        ]
+        for text, expected in cases:
+            with self.subTest(text=text):
+                self.assertEqual(match_else_or_elif(text), expected)
+
+
+    def test_match_exception(self):
+        cases = [
+            ('report 400: "Forbidden"', {'type': 'exception', 'code': 400, 'message': '"Forbidden"'}),
+            ('report "Bad password"', {'type': 'exception', 'code': None, 'message': '"Bad password"'}),
+            ('raise 404', {'type': 'exception', 'code': 404, 'message': None}),
+            ('throw "Not enough data", 500', {'type': 'exception', 'code': 500, 'message': '"Not enough data"'}),
+            ('raise 403: Not allowed', {'type': 'exception', 'code': 403, 'message': '"Not allowed"'}),
+            ('report the error to {user}', None),
+            ('return {user}', None),
+        ]
+        for text, expected in cases:
+            with self.subTest(text=text):
+                self.assertEqual(match_exception(text), expected)
+
+
+    def test_match_assignment(self):
+        cases = [
+            ('hashed password <- hash {password}', ('hashed password', 'hash {password}')),
+            ('user <- sql: get a user with id {id}', ('user', 'sql: get a user with id {id}')),
+            ('let oldest user be the oldest user in the database', ('oldest user', 'the oldest user in the database')),
+            ('"last post" <- the most recent post', ('last post', 'the most recent post')),
+            ('user <-', None),
+            ('Assign "last post" to the most recent post', None),
+        ]
+        for text, expected in cases:
+            with self.subTest(text=text):
+                self.assertEqual(match_assignment(text), expected)
+
+
+    def test_match_output(self):
+        cases = [
+            ('return {user}', '{user}'),
+            ('Output the oldest user', 'the oldest user'),
+            ('return', None),
+            ('give back {user}', None),
+        ]
+        for text, expected in cases:
+            with self.subTest(text=text):
+                self.assertEqual(match_output(text), expected)
+
+
+    def test_strip_sql_prefix(self):
+        cases = [
+            ('sql: get a user with id {id}', 'get a user with id {id}'),
+            ('SQL get all users', 'get all users'),
+            ('get all users', 'get all users'),
+        ]
+        for value, expected in cases:
+            with self.subTest(value=value):
+                self.assertEqual(strip_sql_prefix(value), expected)
+
+
+
+class TestParseCodeBlock(unittest.TestCase):
+
+    # statements that are parsed locally
+    LINES = [
+        'report 403: "Forbidden"',
+        'raise 404: Not found',
+        'return {user}',
+    ]
+
+    def parse(self, workers: int):
+        configure_statement_workers(workers)
+        self.addCleanup(configure_statement_workers, 1)
+        return parse_code_block(self.LINES, {'variables': []}, '', 0)
+
+    def test_one_worker_parses_inline(self):
+        with mock.patch('plainapi.parse_code.ThreadPoolExecutor') as executor:
+            inline = self.parse(1)
+        executor.assert_not_called()
+        self.assertEqual(inline, self.parse(4))
+
+
+if __name__ == '__main__':
+    unittest.main()
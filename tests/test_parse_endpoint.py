@@ -0,0 +1,41 @@
+import unittest
+
+from plainapi.parse_endpoint import match_header, match_requirements
+
+
+class TestParseEndpoint(unittest.TestCase):
+
+    def test_match_header(self):
+        cases = [
+            ('GET at url /users/{id}', 'GET /users/{id}'),
+            ('post /users', 'POST /users'),
+            ('DELETE at /users/{id}  # remove a user', 'DELETE /users/{id}'),
+            ('get the users', None),
+            ('PUT /users', None),
+        ]
+        for text, expected in cases:
+            with self.subTest(text=text):
+                self.assertEqual(match_header(text), expected)
+
+
+    def test_match_requirements(self):
+        cases = [
+            ('* requires auth *', '(auth: Any) -> ()'),
+            ('* requires email, password (string) *', '(email: str, password: str) -> ()'),
+            ('requires id (integer), returns string', '(id: int) -> (str)'),
+            ('* requires nothing *', '() -> ()'),
+            ('requires none, returns nothing', '() -> ()'),
+            ('requires nothing, returns an integer', '() -> (int)'),
+            ('requires auth, returns none', '(auth: Any) -> ()'),
+            ('requires no parameters', None),
+            ('returns a list of users and their posts', None),
+            ('anyone can call this', None),
+        ]
+        for text, expected in cases:
+            with self.subTest(text=text):
+                self.assertEqual(match_requirements(text), expected)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+from unittest import mock
+
+from plainapi.gpt3 import CompletionScheduler, TokenBucket
+from plainapi.providers import TransientCompletionError
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_refill_and_spend(self):
+        bucket = TokenBucket(60)
+        start = bucket.updated
+        cases = [
+            # (seconds later, amount, expected wait)
+            (0, 1, 1.0),
+            (0.5, 1, 0.5),
+            (2, 1, 0.0),
+            (2, 3, 1.0),
+            # more than the capacity only needs a full bucket
+            (10, 120, 50.0),
+        ]
+        for later, amount, expected in cases:
+            with self.subTest(later=later, amount=amount):
+                bucket.updated = start
+                bucket.level = 0
+                bucket.refill(start + later)
+                self.assertAlmostEqual(bucket.wait_time(amount), expected)
+
+    def test_refill_is_capped(self):
+        bucket = TokenBucket(60)
+        bucket.refill(bucket.updated + 3600)
+        self.assertEqual(bucket.level, 60)
+
+
+class TestCompletionScheduler(unittest.TestCase):
+
+    def test_unlimited(self):
+        scheduler = CompletionScheduler()
+        self.assertEqual(scheduler.acquire(10 ** 6, priority=0), 0.0)
+        self.assertEqual(scheduler.run(lambda: 'answer', engine='davinci', tokens=10), 'answer')
+
+    def test_waits_for_the_budget(self):
+        scheduler = CompletionScheduler(tokens_per_minute=600)
+        self.assertLess(scheduler.acquire(600, priority=0), 0.05)
+        # 10 tokens a second
+        self.assertGreaterEqual(scheduler.acquire(1, priority=0), 0.05)
+
+    def test_backoff(self):
+        scheduler = CompletionScheduler(base_delay=1.0, max_delay=8.0)
+        cases = [
+            # (attempt, retry_after, lowest, highest)
+            (0, None, 0.0, 1.0),
+            (2, None, 0.0, 4.0),
+            (10, None, 0.0, 8.0),
+            (0, 30.0, 30.0, 30.0),
+        ]
+        for attempt, retry_after, lowest, highest in cases:
+            with self.subTest(attempt=attempt, retry_after=retry_after):
+                for _ in range(20):
+                    delay = scheduler.backoff(attempt, retry_after)
+                    self.assertGreaterEqual(delay, lowest)
+                    self.assertLessEqual(delay, highest)
+
+    def test_retries_transient_errors(self):
+        scheduler = CompletionScheduler(max_retries=2)
+        calls = []
+
+        def flaky() -> str:
+            calls.append(1)
+            if len(calls) < 3:
+                raise TransientCompletionError('rate limited', retry_after=0.5)
+            return 'answer'
+
+        with mock.patch('plainapi.gpt3.time.sleep') as sleep:
+            self.assertEqual(scheduler.run(flaky, engine='davinci', tokens=10), 'answer')
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertTrue(all(call.args[0] >= 0.5 for call in sleep.call_args_list))
+
+    def test_gives_up_after_max_retries(self):
+        scheduler = CompletionScheduler(max_retries=1)
+
+        def failing() -> str:
+            raise TransientCompletionError('overloaded')
+
+        with mock.patch('plainapi.gpt3.time.sleep'):
+            with self.assertRaises(TransientCompletionError):
+                scheduler.run(failing, engine='davinci', tokens=10)
+
+    def test_other_errors_are_not_retried(self):
+        scheduler = CompletionScheduler()
+        calls = []
+
+        def broken() -> str:
+            calls.append(1)
+            raise ValueError('bad request')
+
+        with self.assertRaises(ValueError):
+            scheduler.run(broken, engine='davinci', tokens=10)
+        self.assertEqual(len(calls), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
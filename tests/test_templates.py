@@ -0,0 +1,150 @@
+import tempfile
+import unittest
+from unittest import mock
+
+from plainapi.cache import DirectoryCache
+from plainapi.gpt3 import use_cache, use_provider
+from plainapi.parse_code import parse_assignment
+from plainapi.providers import CompletionProvider
+from plainapi.parse_sql import parse_schema
+from plainapi.templates import fill_template, induce, learn_translation, match_sql_template
+
+
+SCHEMA = '''
+CREATE TABLE users (id INTEGER PRIMARY KEY, email TEXT, name TEXT);
+CREATE TABLE posts (id INTEGER PRIMARY KEY, title TEXT, user_id INTEGER);
+'''
+
+GET_BY_COLUMN = ('get', 'a', '<table>', 'with', '<column>', '{}')
+
+
+class TestInduce(unittest.TestCase):
+
+    def test_induce(self):
+        cases = [
+            ('get a user with id {id}', 'SELECT * FROM users WHERE id = ?',
+             (GET_BY_COLUMN, 'SELECT * FROM {t0} WHERE {c0} = ?', ('users', 'id'))),
+            ('user <- sql: get a user with email {email}', 'SELECT * FROM users WHERE email = ?',
+             (GET_BY_COLUMN, 'SELECT * FROM {t0} WHERE {c0} = ?', ('users', 'email'))),
+            ('get all of the apples', 'SELECT * FROM apples',
+             (('get', 'all', 'of', 'the', '<table>'), 'SELECT * FROM {t0}', ('apples',))),
+            # as many placeholders as parameters
+            ('get a user with id {id}', 'SELECT * FROM users WHERE id = ? AND name = ?', None),
+            ('get a user', 'not sql', None),
+            # nothing to generalize
+            ('get the answer', 'SELECT 42', None),
+        ]
+        for sentence, sql, expected in cases:
+            with self.subTest(sentence=sentence, sql=sql):
+                self.assertEqual(induce(sentence, sql), expected)
+
+
+class TestFillTemplate(unittest.TestCase):
+
+    def test_fill_template(self):
+        tables = parse_schema(SCHEMA)
+        cases = [
+            ('SELECT * FROM {t0} WHERE {c0} = ?', ['get', 'a', 'post', 'with', 'title', '{title}'],
+             'SELECT * FROM posts WHERE title = ?'),
+            ('SELECT * FROM {t0} WHERE {c0} = ?', ['get', 'a', 'user', 'with', 'name', '{name}'],
+             'SELECT * FROM users WHERE name = ?'),
+            # a column of another table
+            ('SELECT * FROM {t0} WHERE {c0} = ?', ['get', 'a', 'post', 'with', 'email', '{email}'], None),
+            # a table that isn't in the schema
+            ('SELECT * FROM {t0} WHERE {c0} = ?', ['get', 'a', 'comment', 'with', 'id', '{id}'], None),
+            # a column that isn't in the schema
+            ('SELECT * FROM {t0} WHERE {c0} = ? AND deleted = 0', ['get', 'a', 'post', 'with', 'id', '{id}'], None),
+        ]
+        for pattern, tokens, expected in cases:
+            with self.subTest(pattern=pattern, tokens=tokens):
+                self.assertEqual(fill_template(pattern, tokens, GET_BY_COLUMN, tables), expected)
+
+
+class TestMatchSqlTemplate(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        # the template index is rebuilt for (and from) each new cache, and the previous cache is restored afterwards
+        context = use_cache(DirectoryCache(cache_dir.name))
+        context.__enter__()
+        self.addCleanup(context.__exit__, None, None, None)
+
+    def test_match_sql_template(self):
+        learn_translation('get a user with id {id}', 'SELECT * FROM users WHERE id = ?')
+        learn_translation('get a user with email {email}', 'SELECT * FROM users WHERE email = ?')
+        cases = [
+            ('get a post with id {id}', ' SELECT * FROM posts WHERE id = ?'),
+            ('sql: get a post with title {title}', ' SELECT * FROM posts WHERE title = ?'),
+            ('get a comment with id {id}', None),
+            ('delete a user with id {id}', None),
+        ]
+        for sentence, expected in cases:
+            with self.subTest(sentence=sentence):
+                self.assertEqual(match_sql_template(sentence, SCHEMA), expected)
+
+    def test_needs_support(self):
+        learn_translation('get a user with id {id}', 'SELECT * FROM users WHERE id = ?')
+        self.assertIsNone(match_sql_template('get a post with id {id}', SCHEMA))
+
+    def test_rejects_column_outside_schema(self):
+        learn_translation('get a user with id {id}', 'SELECT * FROM users WHERE id = ? AND deleted = 0')
+        learn_translation('get a user with email {email}', 'SELECT * FROM users WHERE email = ? AND deleted = 0')
+        self.assertIsNone(match_sql_template('get a post with id {id}', SCHEMA))
+
+    def test_conflicting_translations(self):
+        learn_translation('get a user with id {id}', 'SELECT * FROM users WHERE id = ?')
+        learn_translation('get a user with email {email}', 'SELECT * FROM users WHERE email = ?')
+        learn_translation('get a user with id {id}', 'SELECT name FROM users WHERE id = ?')
+        self.assertIsNone(match_sql_template('get a post with id {id}', SCHEMA))
+
+
+class RecordingProvider(CompletionProvider):
+    """ Translates the sentences it knows, remembering the ones it was asked. """
+
+    name = 'recording'
+
+    def __init__(self, translations: dict[str, str]):
+        self.translations = translations
+        self.sentences: list[str] = []
+
+    def complete(self, prompt: str, engine: str, stop: str, max_tokens: int) -> str:
+        sentence = prompt.rsplit('English:', 1)[1].split('\n')[0].strip()
+        self.sentences.append(sentence)
+        return ' ' + self.translations.get(sentence, 'SELECT 1')
+
+
+class TestAssignments(unittest.TestCase):
+
+    def setUp(self):
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.provider = RecordingProvider({
+            'get a user with id {id}': 'SELECT * FROM users WHERE id = ?',
+            'get a user with email {email}': 'SELECT * FROM users WHERE email = ?',
+        })
+        for context in [use_cache(DirectoryCache(cache_dir.name)), use_provider(self.provider)]:
+            context.__enter__()
+            self.addCleanup(context.__exit__, None, None, None)
+
+    def translate(self, text: str) -> str:
+        value = parse_assignment(text, {'variables': []}, SCHEMA)['value']
+        assert value['type'] == 'sql'
+        return value['sql']
+
+    def test_translated_with_a_template(self):
+        self.translate('user <- sql: get a user with id {id}')
+        self.translate('user <- sql: get a user with email {email}')
+        self.assertEqual(self.translate('post <- sql: get a post with id {id}'), ' SELECT * FROM posts WHERE id = ?')
+        self.assertEqual(self.provider.sentences, ['get a user with id {id}', 'get a user with email {email}'])
+
+    def test_cached_translations_skip_the_templates(self):
+        self.translate('user <- sql: get a user with id {id}')
+        with mock.patch('plainapi.parse_code.match_sql_template') as match:
+            self.assertEqual(self.translate('user <- sql: get a user with id {id}'), ' SELECT * FROM users WHERE id = ?')
+        match.assert_not_called()
+        self.assertEqual(self.provider.sentences, ['get a user with id {id}'])
+
+
+if __name__ == '__main__':
+    unittest.main()